@@ -0,0 +1,43 @@
+"""
+How minimizer.greedy scales with the number of stores
+
+  $ python benchmarks/greedy_scaling.py --n-items 500 --max-stores 4000
+"""
+import argparse
+import contextlib
+import io
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brickrake import minimizer
+from brickrake import synthetic
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-items', default=500, type=int, help='number of wanted lots')
+    parser.add_argument('--min-stores', default=250, type=int, help='smallest number of stores')
+    parser.add_argument('--max-stores', default=4000, type=int, help='largest number of stores')
+    args = parser.parse_args()
+
+    print('%8s %8s %10s %8s %10s' % ('stores', 'lots', 'seconds', 'n_used', 'exponent'))
+    previous = None
+    n_stores = args.min_stores
+    while n_stores <= args.max_stores:
+        wanted_parts = synthetic.parts_list(args.n_items)
+        price_guide = synthetic.price_guide(wanted_parts, n_stores)
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            solution = minimizer.greedy(wanted_parts, price_guide)[0]
+        elapsed = time.time() - start
+
+        # empirical exponent of running time vs. number of stores
+        exponent = '' if previous is None else '%.2f' % (math.log(elapsed / previous) / math.log(2))
+        print('%8d %8d %10.3f %8d %10s' % (n_stores, len(price_guide), elapsed, len(solution['store_ids']), exponent))
+        previous = elapsed
+        n_stores *= 2
@@ -0,0 +1,227 @@
+"""
+Time the minimizer and loaders on synthetic workloads, and compare with a
+baseline
+
+  $ python benchmarks/run.py --save results.json
+  $ python benchmarks/run.py --sizes small medium --compare benchmarks/baseline.json
+
+Every benchmark is timed by its fastest run, then run again under
+tracemalloc for peak memory allocated by Python and NumPy, which leaves
+out the ILP solver's own (skip with --no-memory). Costs are parts only,
+lower bounds count shipping. Compared with a baseline, a benchmark
+regresses if it's more than --tolerance times slower, or finds a lower
+bound or a solution that's more expensive once shipping is counted.
+"""
+import argparse
+import contextlib
+import io as pyio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from brickrake import io
+from brickrake import minimizer
+from brickrake import synthetic
+
+# (wanted items, stores) of each workload
+SIZES = {
+    'small': (25, 40),
+    'medium': (150, 400),
+    'large': (600, 2000),
+}
+
+# shipping cost per store the minimizer's objective counts, as in main.py
+SHIPPING_COST = 10.0
+
+
+def load_price_guide(wanted_parts, price_guide, stores):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        io.save_price_guide(f, price_guide)
+    try:
+        start = time.time()
+        io.load_price_guide(open(f.name))
+        return {'seconds': time.time() - start}
+    finally:
+        os.remove(f.name)
+
+
+def covers(wanted_parts, price_guide, stores):
+    minimizer.covers(wanted_parts, price_guide)
+    return {}
+
+
+def min_cost(wanted_parts, price_guide, stores):
+    return {'cost': minimizer.min_cost(wanted_parts, price_guide)[0]}
+
+
+def presolve(wanted_parts, price_guide, stores):
+    lots, stats = minimizer.presolve(wanted_parts, price_guide, stores)
+    return {'n_lots': stats['n_lots'], 'n_stores': stats['n_stores']}
+
+
+def greedy(wanted_parts, price_guide, stores):
+    solution = minimizer.greedy(wanted_parts, price_guide)[0]
+    return {'cost': solution['cost'], 'n_stores': len(solution['store_ids'])}
+
+
+def brute_force(wanted_parts, price_guide, stores):
+    solutions = minimizer.brute_force(wanted_parts, price_guide, 4, top=1)
+    if len(solutions) == 0:
+        return {'cost': None}
+    return {'cost': solutions[0]['cost'], 'n_stores': len(solutions[0]['store_ids'])}
+
+
+def lower_bound(wanted_parts, price_guide, stores):
+    return {'bound': minimizer.lower_bound(wanted_parts, price_guide, stores, shipping_cost=SHIPPING_COST)}
+
+
+def ilp(wanted_parts, price_guide, stores):
+    solutions = minimizer.integer_program(wanted_parts, price_guide, stores, shipping_cost=SHIPPING_COST,
+                                          time_limit=30.0)
+    if len(solutions) == 0:
+        return {'cost': None}
+    return {'cost': solutions[0]['cost'], 'n_stores': len(solutions[0]['store_ids'])}
+
+
+def lns(wanted_parts, price_guide, stores):
+    solutions = minimizer.lns(wanted_parts, price_guide, stores, shipping_cost=SHIPPING_COST, time_limit=30.0)
+    if len(solutions) == 0:
+        return {'cost': None}
+    return {'cost': solutions[0]['cost'], 'n_stores': len(solutions[0]['store_ids'])}
+
+
+# benchmark name -> (function, sizes it runs on). Functions take a workload
+# and return what they found; 'seconds' overrides the measured time.
+BENCHMARKS = {
+    'load_price_guide': (load_price_guide, ['small', 'medium', 'large']),
+    'covers': (covers, ['small', 'medium', 'large']),
+    'min_cost': (min_cost, ['small', 'medium', 'large']),
+    'presolve': (presolve, ['small', 'medium', 'large']),
+    'greedy': (greedy, ['small', 'medium', 'large']),
+    'brute_force': (brute_force, ['small']),
+    'lower_bound': (lower_bound, ['small', 'medium', 'large']),
+    'ilp': (ilp, ['small', 'medium']),
+    'lns': (lns, ['medium', 'large']),
+}
+
+
+def run(name, size, workload, memory=True, repeat=5):
+    """Run one benchmark on one workload. Quick ones are repeated, up to
+    repeat times or a second in all, and timed by their fastest run."""
+    function = BENCHMARKS[name][0]
+    with contextlib.redirect_stdout(pyio.StringIO()):
+        times = []
+        while len(times) < repeat and sum(times) < 1.0:
+            start = time.time()
+            result = dict(function(*workload))
+            times.append(result.get('seconds', time.time() - start))
+
+        peak = None
+        if memory:
+            tracemalloc.start()
+            function(*workload)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    result.update({'benchmark': name, 'size': size, 'seconds': min(times),
+                   'peak_mb': None if peak is None else peak / 1e6})
+    return result
+
+
+def objective(result):
+    """What the minimizer pays for a result: its cost plus shipping from
+    every store it buys from"""
+    if result.get('cost') is None:
+        return None
+    return result['cost'] + SHIPPING_COST * result.get('n_stores', 0)
+
+
+def compare(result, baseline, tolerance, min_seconds=0.01):
+    """How a result is worse than the baseline's, as a list of strings.
+    Differences in time below min_seconds are noise."""
+    problems = []
+    if (result['seconds'] > tolerance * baseline['seconds'] and
+            result['seconds'] - baseline['seconds'] > min_seconds):
+        problems.append('%.1fx slower' % (result['seconds'] / baseline['seconds'],))
+
+    # lower objectives and higher bounds are better. A solution may cost
+    # more in parts if it saves more in shipping.
+    values = lambda x: {'objective': objective(x), 'bound': x.get('bound')}
+    for (key, sign) in [('objective', 1), ('bound', -1)]:
+        new, old = values(result)[key], values(baseline)[key]
+        if new is None and old is not None:
+            problems.append('no %s, was %.2f' % (key, old))
+        elif new is not None and old is not None and sign * (new - old) > 1e-6 * max(abs(old), 1):
+            problems.append('%s %.2f, was %.2f' % (key, new, old))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=sorted(SIZES),
+                        help='workloads to run on')
+    parser.add_argument('--benchmarks', nargs='+', default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS),
+                        help='benchmarks to run')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic workloads')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='run benchmarks taking less than a second up to this many times')
+    parser.add_argument('--no-memory', action='store_true', help='skip measuring peak memory')
+    parser.add_argument('--compare', default=None, help='results saved earlier to compare with')
+    parser.add_argument('--tolerance', default=1.5, type=float,
+                        help='how many times slower than the baseline counts as a regression')
+    parser.add_argument('--save', default=None, help='save results here')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        saved = json.load(open(args.compare))
+        baseline = dict(((e['benchmark'], e['size']), e) for e in saved['results'])
+        if saved['seed'] != args.seed:
+            print('WARNING: baseline used seed %d' % (saved['seed'],))
+
+    print('%-18s %-7s %9s %9s %12s %8s %10s  %s' % (
+        'benchmark', 'size', 'seconds', 'peak MB', 'cost/bound', 'n_stores', 'baseline', 'regressions'))
+    results = []
+    n_regressions = 0
+    for size in args.sizes:
+        workload = synthetic.workload(*SIZES[size], seed=args.seed)
+        for name in args.benchmarks:
+            if size not in BENCHMARKS[name][1]:
+                continue
+            result = run(name, size, workload, memory=not args.no_memory, repeat=args.repeat)
+            results.append(result)
+
+            old = baseline.get((name, size))
+            problems = [] if old is None else compare(result, old, args.tolerance)
+            n_regressions += len(problems) > 0
+            value = result.get('cost', result.get('bound'))
+            print('%-18s %-7s %9.3f %9s %12s %8s %10s  %s' % (
+                name, size, result['seconds'],
+                '' if result['peak_mb'] is None else '%.1f' % result['peak_mb'],
+                '' if value is None else '%.2f' % value,
+                result.get('n_stores', ''),
+                '' if old is None else '%.3f' % old['seconds'],
+                ", ".join(problems)))
+            sys.stdout.flush()
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'seed': args.seed,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'processor': platform.processor(),
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare is not None:
+        print('%d regressions' % (n_regressions,))
+        if n_regressions > 0:
+            sys.exit(1)
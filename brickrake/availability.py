@@ -0,0 +1,269 @@
+"""
+Indexes over price guides: lots by store and item, and which wanted items
+every store can supply
+"""
+import numpy as np
+
+
+class PriceGuide(object):
+    """Lots for sale, indexed by store, by wanted item and by lot
+
+    Behaves like the list of lots it holds, so it can go anywhere a price
+    guide can. Each index is built by hashing the first time it's used and
+    kept, so build one of these to share a price guide between many calls.
+    Indexes map keys to lot positions, in the order lots are listed.
+
+    Parameters
+    ----------
+    lots : list of dict
+        lots for sale
+    """
+
+    def __init__(self, lots):
+        self.lots = list(lots)
+        self._by_store = None
+        self._by_item = None
+        self._by_lot = None
+
+    @classmethod
+    def wrap(cls, price_guide):
+        """price_guide if it's already a PriceGuide, else a new one holding it"""
+        if isinstance(price_guide, cls):
+            return price_guide
+        return cls(price_guide)
+
+    def __len__(self):
+        return len(self.lots)
+
+    def __iter__(self):
+        return iter(self.lots)
+
+    def __getitem__(self, p):
+        return self.lots[p]
+
+    def _index(self, kf):
+        result = {}
+        for (p, lot) in enumerate(self.lots):
+            result.setdefault(kf(lot), []).append(p)
+        return result
+
+    @property
+    def by_store(self):
+        """Maps a store id to the positions of its lots"""
+        if self._by_store is None:
+            self._by_store = self._index(lambda x: x['store_id'])
+        return self._by_store
+
+    @property
+    def by_item(self):
+        """Maps (item_id, wanted_color_id) to the positions of its lots"""
+        if self._by_item is None:
+            self._by_item = self._index(lambda x: (x['item_id'], x['wanted_color_id']))
+        return self._by_item
+
+    @property
+    def by_lot(self):
+        """Maps (store_id, item_id, wanted_color_id, color_id, cost_per_unit)
+        to the positions of the lots that are the same but for quantity"""
+        if self._by_lot is None:
+            self._by_lot = self._index(
+                lambda x: (x['store_id'], x['item_id'], x['wanted_color_id'], x['color_id'], x['cost_per_unit']))
+        return self._by_lot
+
+    def store_ids(self):
+        """Ids of all stores with at least one lot"""
+        return list(self.by_store)
+
+    def positions(self, items=None, store_ids=None):
+        """Positions of the lots of the given items, (item_id, wanted_color_id)
+        pairs, sold by the given stores, in the order they're listed. None
+        means all."""
+        if items is None and store_ids is None:
+            return list(range(len(self.lots)))
+        if items is not None:
+            positions = [p for k in set(items) for p in self.by_item.get(k, [])]
+            if store_ids is not None:
+                store_ids = set(store_ids)
+                positions = [p for p in positions if self.lots[p]['store_id'] in store_ids]
+        else:
+            positions = [p for s in set(store_ids) for p in self.by_store.get(s, [])]
+        return sorted(positions)
+
+    def select(self, items=None, store_ids=None):
+        """Only the lots of the given items sold by the given stores, see
+        positions()"""
+        return PriceGuide([self.lots[p] for p in self.positions(items, store_ids)])
+
+
+class Availability(object):
+    """Quantities and prices of wanted items, store by store, as NumPy arrays
+
+    Build this once per set of wanted parts and price guide, then ask it
+    about any subset of stores. Stores are referred to by their position in
+    store_ids, which is sorted. Wanted lots are assumed to be unique per
+    (ItemID, ColorID), as io.load_bsx and io.load_xml make them.
+
+    Parameters
+    ----------
+    wanted_parts : list of dict
+        wanted lots
+    price_guide : list of dict or PriceGuide
+        lots for sale
+
+    Attributes
+    ----------
+    store_ids : list
+        every store with at least one lot, sorted
+    keys : list of (item_id, color_id)
+        every wanted item, in the order it was wanted
+    quantities : [n_stores, n_keys] array
+        how much of each wanted item each store has
+    cheapest : [n_stores, n_keys] array
+        lowest unit price of each wanted item at each store, inf if it has
+        none
+    needed : [n_keys] array
+        how much of each item is wanted
+    ladder_starts : [n_keys + 1] array
+        the lots of wanted item j are ladder_*[ladder_starts[j]:ladder_starts[j + 1]],
+        cheapest first. ladder_positions, ladder_stores, ladder_quantities and
+        ladder_prices hold each lot's position, store, quantity and unit
+        price.
+    """
+
+    def __init__(self, wanted_parts, price_guide):
+        kf2 = lambda x: (x['ItemID'], x['ColorID'])
+
+        price_guide = PriceGuide.wrap(price_guide)
+        self.wanted_parts = wanted_parts
+        self.lots = price_guide.lots
+        self.store_ids = list(sorted(price_guide.store_ids()))
+        self.keys = list(dict.fromkeys(kf2(item) for item in wanted_parts))
+        self.store_index = dict((s, i) for (i, s) in enumerate(self.store_ids))
+        self.key_index = dict((k, j) for (j, k) in enumerate(self.keys))
+
+        n_stores, n_keys = len(self.store_ids), len(self.keys)
+        self.quantities = np.zeros((n_stores, n_keys), dtype=np.int64)
+        self.cheapest = np.full((n_stores, n_keys), np.inf)
+        self.needed = np.zeros(n_keys, dtype=np.int64)
+        for item in wanted_parts:
+            j = self.key_index[kf2(item)]
+            self.needed[j] = max(self.needed[j], item['Qty'])
+
+        # every lot of a wanted item, grouped by item, then cheapest first and
+        # among lots with the same price, the one listed last first
+        positions, stores, keys, quantities, prices = [], [], [], [], []
+        for (j, key) in enumerate(self.keys):
+            for p in price_guide.by_item.get(key, []):
+                lot = self.lots[p]
+                positions.append(p)
+                stores.append(self.store_index[lot['store_id']])
+                keys.append(j)
+                quantities.append(lot['quantity_available'])
+                prices.append(lot['cost_per_unit'])
+        positions = np.array(positions, dtype=np.int64)
+        prices = np.array(prices, dtype=float)
+        order = np.lexsort((-positions, prices, np.array(keys, dtype=np.int64)))
+
+        self.ladder_positions = positions[order]
+        self.ladder_stores = np.array(stores, dtype=np.int64)[order]
+        self.ladder_keys = np.array(keys, dtype=np.int64)[order]
+        self.ladder_quantities = np.array(quantities, dtype=np.int64)[order]
+        self.ladder_prices = prices[order]
+        self.ladder_starts = np.searchsorted(self.ladder_keys, np.arange(n_keys + 1))
+
+        np.add.at(self.quantities, (self.ladder_stores, self.ladder_keys), self.ladder_quantities)
+        np.minimum.at(self.cheapest, (self.ladder_stores, self.ladder_keys), self.ladder_prices)
+
+        # positions of the lots each store has of each wanted item, cheapest first
+        self.lots_by_store_item = {}
+        for (p, i, j) in zip(self.ladder_positions.tolist(), self.ladder_stores.tolist(), self.ladder_keys.tolist()):
+            self.lots_by_store_item.setdefault((i, j), []).append(p)
+
+    def stores(self, store_ids):
+        """Positions of stores, given their ids"""
+        return [self.store_index[s] for s in store_ids]
+
+    def covers(self, stores=None):
+        """True if the given stores (all if None) can cover all desired items"""
+        quantities = self.quantities if stores is None else self.quantities[list(stores)]
+        return bool(np.all(quantities.sum(axis=0) >= self.needed))
+
+    def coverage(self, remaining, stores=None):
+        """How many of the remaining wanted parts each store could supply"""
+        quantities = self.quantities if stores is None else self.quantities[stores]
+        return np.minimum(quantities, remaining).sum(axis=-1)
+
+    def _climb(self, stores):
+        """Quantity on offer from the given stores (all if None) of every
+        lot on the ladders, how much of the same item cheaper lots offer, and
+        how much of each item there is in all"""
+        quantities = self.ladder_quantities
+        if stores is not None:
+            mask = np.zeros(len(self.store_ids), dtype=bool)
+            mask[list(stores)] = True
+            quantities = np.where(mask[self.ladder_stores], quantities, 0)
+
+        # running total within each item's ladder
+        total = np.concatenate([[0], np.cumsum(quantities)])
+        below = total[:-1] - total[self.ladder_starts[:-1]][self.ladder_keys]
+        have = total[self.ladder_starts[1:]] - total[self.ladder_starts[:-1]]
+        return (quantities, below, have)
+
+    def last_unit_prices(self):
+        """Price of the last wanted unit of every item, buying the cheapest
+        units first from any store. 0 for items there aren't enough of."""
+        quantities, below, _ = self._climb(None)
+        needed = self.needed[self.ladder_keys]
+        last = (below < needed) & (below + quantities >= needed)
+        prices = np.zeros(len(self.keys))
+        prices[self.ladder_keys[last]] = self.ladder_prices[last]
+        return prices
+
+    def cost(self, stores=None):
+        """Cost of buying all wanted parts as cheaply as possible from the
+        given stores (all if None), or inf if they don't have enough. Same
+        as min_cost(stores)[0], up to rounding, but much faster."""
+        quantities, below, have = self._climb(stores)
+        if np.any(have < self.needed):
+            return float('inf')
+        bought = np.clip(self.needed[self.ladder_keys] - below, 0, quantities)
+        return float(np.dot(bought, self.ladder_prices))
+
+    def min_cost(self, stores=None):
+        """Greedily minimize the cost of all wanted parts, buying only from the
+        given stores (all if None)
+
+        Returns
+        -------
+        (cost, allocation) : tuple
+            same as minimizer.min_cost
+        """
+        kf2 = lambda x: (x['ItemID'], x['ColorID'])
+        quantities, below, _ = self._climb(stores)
+
+        result = []
+        cost = 0.0
+        for item in self.wanted_parts:
+            j = self.key_index[kf2(item)]
+            start, end = self.ladder_starts[j], self.ladder_starts[j + 1]
+
+            # take as much inventory as possible, starting with the lowest price, until
+            # the requested quantity is filled
+            bought = np.clip(item['Qty'] - below[start:end], 0, quantities[start:end])
+            for k in np.flatnonzero(bought):
+                next = self.lots[self.ladder_positions[start + k]]
+                amount = int(bought[k])
+                result.append({
+                    'item_id': next['item_id'],
+                    'color_id': next['color_id'],
+                    'store_id': next['store_id'],
+                    'quantity': amount,
+                    'cost_per_unit': next['cost_per_unit']
+                })
+                cost += amount * next['cost_per_unit']
+
+            if bought.sum() < item['Qty']:
+                print('WARNING: couldn\'t find enough inventory to purchase %s' % (item['ItemName'],))
+                cost = float('inf')
+
+        return (cost, result)
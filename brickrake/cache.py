@@ -0,0 +1,168 @@
+"""
+On-disk cache for pages fetched from bricklink.com
+"""
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+
+# which kind of page lives at each path on bricklink.com
+KINDS = {
+    '/catalogPG.asp': 'price_guide',
+    '/store.asp': 'store',
+    '/browse.asp': 'browse',
+}
+
+# how long each kind of page stays fresh, in seconds
+TTL = {
+    'price_guide': 24 * 60 * 60,
+    'store': 7 * 24 * 60 * 60,
+    'browse': 7 * 24 * 60 * 60,
+    None: 24 * 60 * 60,
+}
+
+
+class OfflineError(IOError):
+    """A page was requested that isn't in the cache, and we're offline"""
+
+
+def normalize(url):
+    """Canonical form of a URL, so the same page always gets the same key.
+
+    The scheme is dropped, the host is lower-cased and GET parameters are
+    sorted."""
+    parsed = urllib.parse.urlparse(url)
+    path = '/' + parsed.path.lstrip('/')
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)))
+    return parsed.netloc.lower() + path + ('?' + query if query else '')
+
+
+def kind(url):
+    """Kind of page a URL points to, or None if unknown"""
+    path = '/' + urllib.parse.urlparse(url).path.lstrip('/')
+    return KINDS.get(path)
+
+
+class PageCache(object):
+    """Size-bounded, least-recently-used cache of web pages on disk
+
+    Each page is stored in a file named by the SHA-1 of its normalized URL.
+    A file's modification time is when the page was fetched and its access
+    time, which the cache sets itself rather than trusting the mount to, is
+    when it was last read. When the cache is opened, every page's size and
+    last use are read into memory once, so evicting never has to walk the
+    directory. Pages other processes add meanwhile are only counted once
+    they're read.
+
+    Parameters
+    ----------
+    directory : str
+        folder to keep pages in
+    max_bytes : int
+        when the cache grows beyond this, evict least recently used pages
+        until it's down to low_water times this, so that the next pages put
+        don't each trigger another eviction
+    ttl : dict
+        seconds a page stays fresh, by page kind. Defaults to TTL.
+    offline : bool
+        if True, serve stale pages and never go to the network
+    low_water : float
+        fraction of max_bytes to evict down to
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, ttl=None, offline=False, low_water=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = dict(TTL, **(ttl or {}))
+        self.offline = offline
+        self.low_water = low_water
+        self.n_hits = 0
+        self.n_misses = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # path -> (last used, size in bytes) of every page
+        self._pages = {}
+        for path in self._paths():
+            try:
+                stat = os.stat(path)
+                self._pages[path] = (stat.st_atime, stat.st_size)
+            except OSError:
+                pass
+        self._size = sum(size for (_, size) in self._pages.values())
+
+    def path(self, url):
+        """Where the page for a URL is stored"""
+        key = hashlib.sha1(normalize(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url):
+        """Cached contents of a page, or None if it is missing or stale.
+
+        Raises OfflineError instead of returning None when offline."""
+        path = self.path(url)
+        try:
+            stat = os.stat(path)
+            fresh = self.offline or (time.time() - stat.st_mtime) < self.ttl[kind(url)]
+            if fresh:
+                with open(path, encoding='utf-8') as f:
+                    text = f.read()
+                # mark as recently used
+                now = time.time()
+                os.utime(path, (now, stat.st_mtime))
+                with self._lock:
+                    self._size += stat.st_size - self._pages.get(path, (None, 0))[1]
+                    self._pages[path] = (now, stat.st_size)
+                    self.n_hits += 1
+                return text
+        except (OSError, IOError):
+            pass
+
+        with self._lock:
+            self.n_misses += 1
+        if self.offline:
+            raise OfflineError('Not in cache: %s' % (url,))
+        return None
+
+    def put(self, url, text):
+        """Save a page's contents"""
+        path = self.path(url)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        # write to a temporary file first so readers never see half a page
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._size += size - self._pages.get(path, (None, 0))[1]
+            self._pages[path] = (time.time(), size)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _paths(self):
+        for (folder, _, files) in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(folder, name)
+
+    def _evict(self):
+        """Delete least recently used pages until the cache is down to its
+        low water mark"""
+        target = self.low_water * self.max_bytes
+        for (path, (_, size)) in sorted(self._pages.items(), key=lambda x: x[1][0]):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self._pages[path]
+            self._size -= size
@@ -1,38 +1,191 @@
 """
 Functions for finding similar colors
 """
+import bisect
+import hashlib
 import json
-import math
 import os
 
-from colormath.color_objects import LabColor
-from colormath.color_diff import delta_e_cie2000
+import numpy as np
+
+DATA = os.path.split(__file__)[0] + '/data/'
+CACHE = os.path.expanduser('~/.cache/brickrake/')
 
 # mapping from ColorID to Lab color space. Made using colors extracted from
 # http://www.bricklink.com/catalogColors.asp and code from
 # http://www.cse.unr.edu/~quiroz/inc/colortransforms.py
 COLORS = dict(
     (int(k), v) for (k, v)
-    in list(json.load(open(os.path.split(__file__)[0] + '/data/colors.json')).items())
+    in list(json.load(open(DATA + 'colors.json')).items())
 )
 
 
-def similar_to(color_id):
-    """Get a list of similar colors, by color id"""
+def delta_e_cie2000(lab1, lab2):
+    """Color distance as defined by CIEDE2000, for every pair of colors
+
+    Follows colormath's implementation exactly, including which of the two
+    colors plays the role of the reference.
+
+    Parameters
+    ----------
+    lab1 : [n, 3] array
+        Lab colors
+    lab2 : [m, 3] array
+        Lab colors
+
+    Returns
+    -------
+    distances : [n, m] array
+        distances[i, j] is the distance from lab1[i] to lab2[j]
+    """
+    lab1 = np.asarray(lab1, dtype=float)[:, np.newaxis, :]
+    lab2 = np.asarray(lab2, dtype=float)[np.newaxis, :, :]
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    avg_Lp = (L1 + L2) / 2.0
+
+    C1 = np.sqrt(a1 ** 2 + b1 ** 2)
+    C2 = np.sqrt(a2 ** 2 + b2 ** 2)
+    avg_C1_C2 = (C1 + C2) / 2.0
+
+    G = 0.5 * (1 - np.sqrt(avg_C1_C2 ** 7.0 / (avg_C1_C2 ** 7.0 + 25.0 ** 7.0)))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+
+    C1p = np.sqrt(a1p ** 2 + b1 ** 2)
+    C2p = np.sqrt(a2p ** 2 + b2 ** 2)
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = h1p + (h1p < 0) * 360
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = h2p + (h2p < 0) * 360
+
+    avg_Hp = (((np.fabs(h1p - h2p) > 180) * 360) + h1p + h2p) / 2.0
+
+    T = 1 - 0.17 * np.cos(np.radians(avg_Hp - 30)) + \
+        0.24 * np.cos(np.radians(2 * avg_Hp)) + \
+        0.32 * np.cos(np.radians(3 * avg_Hp + 6)) - \
+        0.2 * np.cos(np.radians(4 * avg_Hp - 63))
+
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180) * 360
+    delta_hp = delta_hp - (h2p > h1p) * 720
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + ((0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2.0))
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(((avg_Hp - 275) / 25) ** 2.0))
+    R_C = np.sqrt(avg_C1p_C2p ** 7.0 / (avg_C1p_C2p ** 7.0 + 25.0 ** 7.0))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt(
+        (delta_Lp / S_L) ** 2 +
+        (delta_Cp / S_C) ** 2 +
+        (delta_Hp / S_H) ** 2 +
+        R_T * (delta_Cp / S_C) * (delta_Hp / S_H))
+
+
+def similarity_table(colors=COLORS):
+    """Rank every color by its distance to every other color
+
+    Returns
+    -------
+    table : dict
+        maps a color id to a list of (color id, distance) pairs, closest
+        first
+    """
+    ids = np.array(sorted(colors))
+    labs = np.array([colors[i]['lab'] for i in ids])
+
+    # distances[i, j] is the distance from ids[i] to the wanted color ids[j]
+    distances = delta_e_cie2000(labs, labs)
+
+    table = {}
+    for (j, color_id) in enumerate(ids):
+        order = np.lexsort((ids, distances[:, j]))
+        table[int(color_id)] = [(int(ids[i]), float(distances[i, j])) for i in order]
+    return table
+
+
+def colors_key(colors=COLORS):
+    """Hash of every color's id and Lab value, to tell when a table is stale"""
+    labs = [[int(k), [float(x) for x in colors[k]['lab']]] for k in sorted(colors)]
+    return hashlib.sha1(json.dumps(labs).encode('utf-8')).hexdigest()
+
+
+def load_similarity_table(f, key=None):
+    """Load a table made by similarity_table()
+
+    Raises ValueError if key is given and the table was made from other colors
+    """
+    saved = json.load(f)
+    if key is not None and saved.get('colors') != key:
+        raise ValueError('similarity table was made from other colors')
+    return dict((int(k), [tuple(e) for e in v]) for (k, v) in saved['table'].items())
+
+
+def save_similarity_table(f, table, key=None):
+    """Save a table made by similarity_table(), with colors_key() of its colors"""
+    json.dump({
+        'colors': colors_key() if key is None else key,
+        'table': dict((str(k), [[c, round(d, 6)] for (c, d) in v]) for (k, v) in sorted(table.items())),
+    }, f)
+
+
+def _neighbors(table):
+    # split each ranking into parallel tuples so lookups can bisect on distance
+    return dict((k, (tuple(e[0] for e in v), tuple(e[1] for e in v))) for (k, v) in table.items())
+
+
+def _load_neighbors():
+    # precomputed ranking of similar colors, from "python main.py colors" or
+    # shipped with the package. Recomputed if colors.json has changed since.
+    key = colors_key()
+    for path in [CACHE + 'similar_colors.json', DATA + 'similar_colors.json']:
+        try:
+            with open(path) as f:
+                return _neighbors(load_similarity_table(f, key=key))
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+    return _neighbors(similarity_table())
+
+
+NEIGHBORS = _load_neighbors()
+
+
+def similar_to(color_id, n=None, max_distance=None):
+    """Get a list of similar colors, by color id, closest first
+
+    Parameters
+    ----------
+    color_id : int
+        wanted color
+    n : int or None
+        return at most this many colors
+    max_distance : float or None
+        only return colors at most this far from the wanted color
+    """
     if color_id == 0:
         color_id = 9  # light grey
 
-    color = COLORS[color_id]
-    distances = sorted(
-        (distance(color2['lab'], color['lab']), id)
-        for (id, color2) in list(COLORS.items())
-    )
-    return [e[1] for e in distances]
+    ids, distances = NEIGHBORS[color_id]
+    end = len(ids) if n is None else n
+    if max_distance is not None:
+        end = min(end, bisect.bisect_right(distances, max_distance))
+    return list(ids[:end])
 
 
 def distance(color1, color2):
-    """Color distance as defined by CIE76 (L2 norm)"""
-    return delta_e_cie2000(LabColor(*color1), LabColor(*color2))
+    """Color distance as defined by CIEDE2000"""
+    return float(delta_e_cie2000([color1], [color2])[0, 0])
 
 
 def name(color_id):
@@ -0,0 +1,440 @@
+"""
+Integer linear program for choosing stores, independent of the solver used
+"""
+import time
+
+import numpy as np
+
+from . import profiling
+from .availability import PriceGuide
+
+
+class Model(object):
+    """Mixed integer linear program
+
+        minimize    objective . x
+        subject to  constraint_lower <= A x <= constraint_upper
+                    lower <= x <= upper
+                    x[i] is an integer wherever integrality[i] is 1
+
+    A is stored row by row: the non-zeros of row r are coefficients[k] in
+    columns columns[k], for k in range(row_starts[r], row_starts[r + 1]).
+
+    The first len(lots) variables are how much to buy of each lot, and the
+    next len(store_ids) are 1 if a store is used and 0 otherwise.
+    """
+
+    def __init__(self, lots, store_ids):
+        self.lots = lots
+        self.store_ids = store_ids
+        self.objective = None
+        self.lower = None
+        self.upper = None
+        self.integrality = None
+        self.row_starts = None
+        self.columns = None
+        self.coefficients = None
+        self.constraint_lower = None
+        self.constraint_upper = None
+        self.variable_names = []
+        self.constraint_names = []
+
+    @property
+    def n_variables(self):
+        return len(self.objective)
+
+    @property
+    def n_constraints(self):
+        return len(self.constraint_lower)
+
+    def variable_name(self, j):
+        """Name of variable j, or a made-up one if the model has no names"""
+        return self.variable_names[j] if self.variable_names else 'x%d' % (j,)
+
+    def activity(self, x):
+        """A x, computed without scipy"""
+        rows = np.repeat(np.arange(self.n_constraints), np.diff(self.row_starts))
+        return np.bincount(rows, self.coefficients * np.asarray(x)[self.columns], minlength=self.n_constraints)
+
+    def is_feasible(self, x, tolerance=1e-6):
+        """True if x satisfies every bound and constraint"""
+        x = np.asarray(x)
+        integral = self.integrality == 1
+        activity = self.activity(x)
+        return bool(
+            np.all(x >= self.lower - tolerance) and np.all(x <= self.upper + tolerance) and
+            np.all(np.abs(x[integral] - np.round(x[integral])) <= tolerance) and
+            np.all(activity >= self.constraint_lower - tolerance) and
+            np.all(activity <= self.constraint_upper + tolerance))
+
+    def matrix(self):
+        """A as a scipy.sparse CSR matrix"""
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.coefficients, self.columns, self.row_starts),
+                          shape=(self.n_constraints, self.n_variables))
+
+
+def build(wanted_parts, available_parts, stores=None, shipping_cost=10.0, names=False, integral_lots=True):
+    """Build the program choosing which lots to buy and which stores to buy them from
+
+    Parameters
+    ----------
+    wanted_parts : list of dict
+        wanted lots
+    available_parts : list of dict
+        lots for sale
+    stores : list of dict or None
+        store metadata, for each store's minimum purchase. If None, no store
+        has a minimum.
+    shipping_cost : float
+        estimated cost of shipping from each store used
+    names : bool
+        also name every variable and constraint, which is handy for
+        debugging but slow for large price guides
+    integral_lots : bool
+        make the quantity bought of lots in stores with a minimum purchase
+        integers. If False, the model is much easier to solve, but fractional
+        quantities get rounded up, which may cost a little more than needed.
+
+    Returns
+    -------
+    model : Model
+    """
+    kf1 = lambda x: (x['item_id'], x['wanted_color_id'])
+    kf2 = lambda x: (x['ItemID'], x['ColorID'])
+
+    lots = list(available_parts)
+    store_ids = list(sorted(set(e['store_id'] for e in lots)))
+    store_index = dict((s, i) for (i, s) in enumerate(store_ids))
+    minimum_buy = dict((s['store_id'], s['minimum_buy']) for s in (stores or []))
+
+    n_lots, n_stores = len(lots), len(store_ids)
+    quantity = np.array([e['quantity_available'] for e in lots], dtype=float)
+    unit_cost = np.array([e['cost_per_unit'] for e in lots], dtype=float)
+    lot_store = np.array([store_index[e['store_id']] for e in lots], dtype=np.int64)
+    wanted_index = dict((kf2(e), i) for (i, e) in enumerate(wanted_parts))
+    lot_key = np.array([wanted_index.get(kf1(e), -1) for e in lots], dtype=np.int64)
+    wanted_key = np.array([wanted_index[kf2(e)] for e in wanted_parts], dtype=np.int64)
+    use_store = n_lots + lot_store  # column of the variable saying lot's store is used
+    lot_columns = np.arange(n_lots)
+
+    # most of a lot that's worth buying: what's wanted, plus enough to make a
+    # store's minimum purchase on its own. The tighter this is, the closer
+    # the relaxation the solver starts from is to the real thing.
+    needed = np.zeros(len(wanted_parts) + 1)  # the last one is for unwanted lots, whose lot_key is -1
+    np.maximum.at(needed, wanted_key, [e['Qty'] for e in wanted_parts])
+    store_minimum = np.array([minimum_buy.get(s, 0.0) for s in store_ids], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        top_up = np.where(unit_cost > 0, np.ceil(store_minimum[lot_store] / unit_cost), np.inf)
+    top_up[store_minimum[lot_store] <= 0] = 0
+    quantity = np.minimum(quantity, needed[lot_key] + top_up)
+
+    model = Model(lots, store_ids)
+
+    # a variable for how much to buy of each lot, and one for if anything was
+    # bought from each store. if 1, then pay shipping cost and all store
+    # inventory is available; if 0, then don't pay for shipping and every lot
+    # in it has 0 quantity available
+    model.objective = np.concatenate([unit_cost, np.full(n_stores, shipping_cost)])
+    model.lower = np.zeros(n_lots + n_stores)
+    model.upper = np.concatenate([quantity, np.ones(n_stores)])
+    # without minimum purchases, some cheapest purchase buys whole numbers of
+    # every lot anyway, so only lots in stores with a minimum need to be
+    # integers
+    lot_integral = ((store_minimum[lot_store] > 0) & integral_lots).astype(np.int64)
+    model.integrality = np.concatenate([lot_integral, np.ones(n_stores, dtype=np.int64)])
+    if names:
+        model.variable_names = (
+            ["quantity-store=%s-item=%s-color=%s" % (e['store_id'], e['item_id'], e['color_id']) for e in lots] +
+            ["use-store=%s" % (s,) for s in store_ids]
+        )
+
+    rows, columns, coefficients, lower, upper = [], [], [], [], []
+
+    # for every lot in every store, a constraint for how much can be bought
+    rows += [lot_columns, lot_columns]
+    columns += [lot_columns, use_store]
+    coefficients += [np.ones(n_lots), -quantity]
+    lower.append(np.full(n_lots, -np.inf))
+    upper.append(np.zeros(n_lots))
+
+    # for every wanted lot, a constraint saying amount bought >= wanted amount.
+    # Lots are sorted by the wanted item they match, so each row's columns are
+    # one contiguous run of by_key.
+    by_key = np.argsort(lot_key, kind='stable')
+    key_starts = np.searchsorted(lot_key[by_key], np.arange(len(wanted_parts) + 1))
+    counts = key_starts[wanted_key + 1] - key_starts[wanted_key]
+    run_starts = np.cumsum(counts) - counts
+    positions = np.arange(counts.sum()) + np.repeat(key_starts[wanted_key] - run_starts, counts)
+    rows.append(n_lots + np.repeat(np.arange(len(wanted_parts)), counts))
+    columns.append(by_key[positions])
+    coefficients.append(np.ones(len(positions)))
+    lower.append(np.array([lot['Qty'] for lot in wanted_parts], dtype=float))
+    upper.append(np.full(len(wanted_parts), np.inf))
+
+    # for every store, a constraint saying "if I purchased from this store, I
+    # bought the minimum amount or more"
+    first = n_lots + len(wanted_parts)
+    rows += [first + lot_store, first + np.arange(n_stores)]
+    columns += [lot_columns, n_lots + np.arange(n_stores)]
+    coefficients += [unit_cost, -store_minimum]
+    lower.append(np.zeros(n_stores))
+    upper.append(np.full(n_stores, np.inf))
+
+    if names:
+        model.constraint_names = (
+            ["maxquantity-store=%s-item=%s-color-%s" % (e['store_id'], e['item_id'], e['color_id']) for e in lots] +
+            ["wantedamount-item=%s-color=%s" % (e['ItemID'], e['ColorID']) for e in wanted_parts] +
+            ["minbuy-store=%s" % (s,) for s in store_ids]
+        )
+
+    # sort non-zeros by row
+    rows = np.concatenate(rows).astype(np.int64)
+    columns = np.concatenate(columns).astype(np.int64)
+    coefficients = np.concatenate(coefficients)
+    order = np.lexsort((columns, rows))
+    n_constraints = first + n_stores
+
+    model.row_starts = np.searchsorted(rows[order], np.arange(n_constraints + 1))
+    model.columns = columns[order]
+    model.coefficients = coefficients[order]
+    model.constraint_lower = np.concatenate(lower)
+    model.constraint_upper = np.concatenate(upper)
+    return model
+
+
+def solution(model, x, verbose=True):
+    """Turn the values of a model's variables into a purchase"""
+    x = np.asarray(x)[:len(model.lots)]
+
+    # most lot variables are continuous, so they might not actually be
+    # integral. If they're "almost" integral, just round. Otherwise, round up,
+    # which keeps every constraint satisfied, and print this warning.
+    # According to theory the optimal solution is for all continuous
+    # variables to be integral unless a store's minimum purchase is involved.
+    fractional = np.abs(x - np.round(x)) > 1e-3
+    for p in np.flatnonzero(fractional & verbose):
+        print('Uh oh. Variable %s has value %f. Rounding up.' % (model.variable_name(p), x[p]))
+
+    # save quantity to buy if it's > 0
+    quantities = np.where(fractional, np.ceil(x), np.round(x)).astype(np.int64)
+    result = []
+    for p in np.flatnonzero(quantities > 0):
+        lot = model.lots[p]
+        result.append({
+            'store_id': lot['store_id'],
+            'item_id': lot['item_id'],
+            'wanted_color_id': lot['wanted_color_id'],
+            'color_id': lot['color_id'],
+            'quantity_available': lot['quantity_available'],
+            'cost_per_unit': lot['cost_per_unit'],
+            'quantity': int(quantities[p])
+        })
+
+    cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
+    store_ids = list(set(e['store_id'] for e in result))
+    return {
+        'cost': cost,
+        'allocation': result,
+        'store_ids': store_ids
+    }
+
+
+def from_allocation(model, allocation):
+    """Values of a model's variables that make the given purchase, e.g. to
+    start the solver from a solution found by another algorithm"""
+    kf = lambda x: (x['store_id'], x['item_id'], x['wanted_color_id'], x['color_id'], x['cost_per_unit'])
+    lots_by_id = PriceGuide(model.lots).by_lot
+
+    x = np.zeros(model.n_variables)
+    for e in allocation:
+        # spread the quantity over the matching lots, in case presolve or
+        # the other algorithm saw them differently
+        n_remaining = e['quantity']
+        for p in lots_by_id.get(kf(e), []):
+            amount = min(n_remaining, model.upper[p] - x[p])
+            x[p] += amount
+            n_remaining -= amount
+    store_index = dict((s, i) for (i, s) in enumerate(model.store_ids))
+    for e in allocation:
+        if e['store_id'] in store_index:
+            x[len(model.lots) + store_index[e['store_id']]] = 1.0
+    return x
+
+
+################################################################################
+
+def highs(model, gap=0.01, time_limit=None, threads=None, start=None, callback=None, verbose=True):
+    """Solve a model with HiGHS, through scipy.optimize.milp
+
+    scipy doesn't let HiGHS use more than one thread, start from a given
+    solution or report solutions as they're found, so threads, start and
+    callback are ignored.
+
+    Returns
+    -------
+    x : array or None
+        value of every variable, or None if no solution was found
+    """
+    from scipy.optimize import Bounds, LinearConstraint, milp
+
+    options = {'mip_rel_gap': gap, 'disp': False}
+    if time_limit is not None:
+        options['time_limit'] = time_limit
+
+    began = time.time()
+    result = milp(model.objective,
+                  integrality=model.integrality,
+                  bounds=Bounds(model.lower, model.upper),
+                  constraints=LinearConstraint(model.matrix(), model.constraint_lower, model.constraint_upper),
+                  options=options)
+    if verbose:
+        print('HiGHS: %s' % (result.message,))
+    profiling.solver(backend='highs', status=result.message, seconds=time.time() - began,
+                     n_variables=model.n_variables, n_constraints=model.n_constraints,
+                     objective=result.fun, bound=result.get('mip_dual_bound'), gap=result.get('mip_gap'),
+                     n_nodes=result.get('mip_node_count'))
+    return result.x
+
+
+def gurobi(model, gap=0.01, time_limit=None, threads=None, start=None, callback=None, verbose=True):
+    """Solve a model with Gurobi, through its matrix API. Needs gurobipy 9
+    or newer and a license.
+
+    start is used as a MIP start, and callback is called with the values of
+    all variables every time Gurobi finds a better solution.
+
+    Returns
+    -------
+    x : array or None
+        value of every variable, or None if no solution was found
+    """
+    import gurobipy
+    from gurobipy import GRB
+
+    began = time.time()
+    m = gurobipy.Model()
+    if not verbose:
+        m.setParam(GRB.Param.OutputFlag, 0)
+    binary = (model.integrality == 1) & (model.lower == 0) & (model.upper == 1)
+    vtype = np.where(binary, GRB.BINARY, np.where(model.integrality == 1, GRB.INTEGER, GRB.CONTINUOUS))
+    x = m.addMVar(model.n_variables, lb=model.lower, ub=model.upper, obj=model.objective, vtype=vtype)
+
+    # Gurobi constraints are one-sided, so a row bounded on both sides
+    # becomes two constraints
+    A = model.matrix()
+    lower, upper = model.constraint_lower, model.constraint_upper
+    equal = np.flatnonzero(lower == upper)
+    less = np.flatnonzero((upper < np.inf) & (lower != upper))
+    greater = np.flatnonzero((lower > -np.inf) & (lower != upper))
+    rows = np.concatenate([equal, less, greater])
+    sense = np.array([GRB.EQUAL] * len(equal) + [GRB.LESS_EQUAL] * len(less) + [GRB.GREATER_EQUAL] * len(greater))
+    rhs = np.concatenate([upper[equal], upper[less], lower[greater]])
+    m.addMConstr(A[rows], x, sense, rhs)
+    m.update()
+
+    if model.variable_names:
+        m.setAttr('VarName', m.getVars(), model.variable_names)
+    if model.constraint_names:
+        m.setAttr('ConstrName', m.getConstrs(), [model.constraint_names[r] for r in rows])
+    if verbose:
+        print('Handed model to Gurobi in %.2fs' % (time.time() - began,))
+
+    m.setParam(GRB.Param.MIPGap, gap)  # stop when duality gap <= gap
+    if time_limit is not None:
+        m.setParam(GRB.Param.TimeLimit, time_limit)
+    if threads:
+        m.setParam(GRB.Param.Threads, threads)
+    if start is not None:
+        m.setAttr('Start', m.getVars(), start.tolist())
+
+    if callback is None:
+        m.optimize()
+    else:
+        variables = m.getVars()
+
+        def on_event(m_, where):
+            if where == GRB.Callback.MIPSOL:
+                callback(np.array(m_.cbGetSolution(variables)))
+        m.optimize(on_event)
+
+    profiling.solver(backend='gurobi', status=m.Status, seconds=m.Runtime,
+                     n_variables=model.n_variables, n_constraints=model.n_constraints,
+                     objective=m.ObjVal if m.SolCount > 0 else None,
+                     bound=m.ObjBound if m.SolCount > 0 else None,
+                     gap=m.MIPGap if m.SolCount > 0 else None,
+                     n_nodes=m.NodeCount, n_iterations=m.IterCount)
+    if m.SolCount == 0:
+        return None
+    return x.X
+
+
+# solvers that can be used, by name
+BACKENDS = {
+    'gurobi': gurobi,
+    'highs': highs,
+}
+
+
+def default_backend():
+    """Gurobi if it's installed, otherwise HiGHS"""
+    try:
+        import gurobipy
+        return 'gurobi'
+    except ImportError:
+        return 'highs'
+
+
+def solve(model, backend='highs', gap=0.01, time_limit=None, threads=None, start=None, on_incumbent=None,
+          verbose=True):
+    """Solve a model with one of BACKENDS
+
+    Parameters
+    ----------
+    model : Model
+    backend : str
+        name of the solver to use
+    gap : float
+        stop once the solution is provably within this fraction of optimal
+    time_limit : float or None
+        stop after this many seconds, with the best solution so far
+    threads : int or None
+        number of threads the solver may use. None lets the solver decide.
+    start : array or None
+        values of all variables to start from, e.g. from from_allocation().
+        If it's feasible, the result is never worse than it.
+    on_incumbent : function or None
+        called with every improving purchase found, as returned by
+        solution(), starting with start's. Not every backend reports the
+        solutions it finds along the way.
+    verbose : bool
+        let the solver print its progress
+
+    Returns
+    -------
+    solution : dict or None
+        purchase, as returned by solution(), or None if there is none
+    """
+    # with no lots at all there's nothing to solve, and solvers reject empty
+    # models. That's a purchase only if nothing is wanted.
+    if model.n_variables == 0:
+        return solution(model, []) if np.all(model.constraint_lower <= 0) else None
+
+    if start is not None and not model.is_feasible(start):
+        if verbose:
+            print('Starting solution is infeasible, so it can only be a hint')
+    elif start is not None and on_incumbent is not None:
+        on_incumbent(solution(model, start, verbose))
+
+    callback = None
+    if on_incumbent is not None:
+        callback = lambda x: on_incumbent(solution(model, x, verbose))
+
+    x = BACKENDS[backend](model, gap=gap, time_limit=time_limit, threads=threads, start=start, callback=callback,
+                         verbose=verbose)
+    if start is not None and model.is_feasible(start):
+        if x is None or np.dot(model.objective, start) < np.dot(model.objective, x):
+            x = start
+    if x is None:
+        return None
+    return solution(model, x, verbose)
@@ -1,9 +1,15 @@
 """
 Functions for loading/saving data
 """
+import gc
 import json
+import os
+import sys
+import time
 import xml.etree.ElementTree as ETree
 
+import numpy as np
+
 from . import color
 from . import utils
 
@@ -46,7 +52,7 @@ def load_bsx(f):
     # Consolidate them together now.
     by_item = utils.groupby(items, lambda x: (x['ItemID'], x['ColorID']))
     result = []
-    for ((item_id, color_id), same) in by_item.items():
+    for ((item_id, color_id), same) in sorted(by_item.items()):
         prototype = same[0]
         prototype['Qty'] = sum(e['Qty'] for e in same)
         result.append(prototype)
@@ -71,7 +77,7 @@ def load_xml(f):
     # Consolidate them together now.
     by_item = utils.groupby(items, lambda x: (x['ItemID'], x['ColorID']))
     result = []
-    for ((item_id, color_id), same) in by_item.items():
+    for ((item_id, color_id), same) in sorted(by_item.items()):
         prototype = same[0]
         prototype['Qty'] = sum(e['Qty'] for e in same)
         result.append(prototype)
@@ -124,24 +130,407 @@ def save_xml_per_vendor(folder, solution, stores):
             lot['wanted_list_id'] = wanted_list
 
     # write file
-    allocation = utils.flatten(list(allocation.values()))
+    allocation = utils.flatten(group for (_, group) in sorted(allocation.items()))
     with open(folder, 'w') as f:
         save_xml(f, allocation)
 
 
+class Lot(object):
+    """A lot for sale
+
+    Reads and writes like the dict it replaces, e.g. lot['cost_per_unit'],
+    and converts to one with dict(lot), but takes a fraction of the memory.
+    Item ids are interned, so lots of the same item share one string. Fields
+    other than FIELDS are kept in a dict of their own, which only lots that
+    have some pay for.
+    """
+    FIELDS = ('item_id', 'wanted_color_id', 'color_id', 'store_id', 'quantity_available', 'cost_per_unit')
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, item_id, wanted_color_id, color_id, store_id, quantity_available, cost_per_unit,
+                 extra=None):
+        if isinstance(item_id, str):
+            item_id = sys.intern(item_id)
+        self.item_id = item_id
+        self.wanted_color_id = wanted_color_id
+        self.color_id = color_id
+        self.store_id = store_id
+        self.quantity_available = quantity_available
+        self.cost_per_unit = cost_per_unit
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, lot):
+        """A Lot holding the same as a dict, or the dict itself if it's
+        missing any of FIELDS"""
+        if any(k not in lot for k in cls.FIELDS):
+            return lot
+        extra = None
+        if len(lot) > len(cls.FIELDS):
+            extra = dict((k, v) for (k, v) in lot.items() if k not in cls.FIELDS)
+        return cls(*[lot[k] for k in cls.FIELDS], extra=extra)
+
+    def keys(self):
+        if self.extra is None:
+            return self.FIELDS
+        return self.FIELDS + tuple(self.extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.FIELDS) + (0 if self.extra is None else len(self.extra))
+
+    def __contains__(self, key):
+        return key in self.FIELDS or (self.extra is not None and key in self.extra)
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __eq__(self, other):
+        if isinstance(other, (Lot, dict)):
+            return dict(self) == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Lot(%s)' % (", ".join('%s=%r' % (k, self[k]) for k in self.keys()),)
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for (k, v) in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+
 def load_price_guide(f):
-    """Load pricing output"""
-    return json.load(f)
+    """Load pricing output, as Lots. Lots with the same store or price share
+    one object for it."""
+    stores = {}
+    prices = {}
+
+    def to_lot(lot):
+        if len(lot) != len(Lot.FIELDS):
+            return Lot.from_dict(lot)
+        try:
+            store_id = lot['store_id']
+            cost_per_unit = lot['cost_per_unit']
+            return Lot(lot['item_id'], lot['wanted_color_id'], lot['color_id'], stores.setdefault(store_id, store_id),
+                       lot['quantity_available'], prices.setdefault(cost_per_unit, cost_per_unit))
+        except KeyError:
+            return lot
+
+    # none of the objects made here can be garbage, so don't let the garbage
+    # collector scan them over and over while there are more and more of them
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return json.load(f, object_hook=to_lot)
+    finally:
+        if collecting:
+            gc.enable()
 
 
 def save_price_guide(f, price_guide):
     """Save pricing output"""
-    json.dump(price_guide, f, indent=2)
+    json.dump([dict(e) for e in price_guide], f, indent=2)
+
+
+class PriceGuideJournal(object):
+    """Append-only log of scraped lots, written as JSON lines
+
+    Each line holds every lot found for one wanted item, so an interrupted
+    scrape loses at most the items that weren't synced to disk yet. Syncing is
+    batched: the file is fsync'd every sync_every items or sync_interval
+    seconds, whichever comes first.
+
+    Parameters
+    ----------
+    f : file-like object
+        file opened for appending
+    """
+
+    def __init__(self, f, sync_every=20, sync_interval=5.0):
+        self.f = f
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+
+        # start on a fresh line in case a crash left half a line behind
+        if f.tell() > 0:
+            f.write("\n")
+
+    def append(self, item_id, wanted_color_id, lots):
+        """Record all lots found for a wanted item"""
+        self.f.write(json.dumps({
+            'item_id': item_id,
+            'wanted_color_id': wanted_color_id,
+            'lots': [dict(e) for e in lots]
+        }) + "\n")
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Make sure everything appended so far is on disk"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._n_unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def load_price_guide_journal(f):
+    """Index the items recorded in a price guide journal
+
+    Returns
+    -------
+    lots : dict
+        maps (item_id, wanted_color_id) to the lots found for it. If an item
+        was recorded more than once, the last record wins. A truncated last
+        line, as left behind by a crash, is ignored.
+    """
+    result = {}
+    for line in f:
+        try:
+            entry = json.loads(line, object_hook=Lot.from_dict)
+        except ValueError:
+            continue
+        result[(entry['item_id'], entry['wanted_color_id'])] = entry['lots']
+    return result
+
+
+def compact_price_guide_journal(f):
+    """Turn a price guide journal into a price guide"""
+    return utils.flatten(load_price_guide_journal(f).values())
+
+
+# one row per lot in a columnar price guide. item and store index into the
+# item id and store id tables saved alongside.
+LOT_DTYPE = np.dtype([
+    ('item', '<i4'),
+    ('wanted_color_id', '<i4'),
+    ('color_id', '<i4'),
+    ('store', '<i4'),
+    ('quantity_available', '<i4'),
+    ('cost_per_unit', '<f8'),
+])
+
+
+class PriceGuideColumns(object):
+    """A price guide stored column by column
+
+    Parameters
+    ----------
+    lots : structured array with dtype LOT_DTYPE
+        one row per lot
+    items : list
+        item ids, indexed by lots['item']
+    stores : list
+        store ids, indexed by lots['store']
+    """
+
+    def __init__(self, lots, items, stores):
+        self.lots = lots
+        self.items = items
+        self.stores = stores
+
+    def __len__(self):
+        return len(self.lots)
+
+    @classmethod
+    def from_records(cls, price_guide):
+        """Convert a price guide in its usual form, a list of dicts"""
+        items = list(dict.fromkeys(e['item_id'] for e in price_guide))
+        stores = list(dict.fromkeys(e['store_id'] for e in price_guide))
+        item_index = dict((k, i) for (i, k) in enumerate(items))
+        store_index = dict((k, i) for (i, k) in enumerate(stores))
+        lots = np.array([(item_index[e['item_id']], e['wanted_color_id'], e['color_id'],
+                          store_index[e['store_id']], e['quantity_available'], e['cost_per_unit'])
+                         for e in price_guide],
+                        dtype=LOT_DTYPE)
+        return cls(lots, items, stores)
+
+    def to_records(self):
+        """Convert to a price guide in its usual form, a list of Lots"""
+        columns = [self.lots[k].tolist() for k in LOT_DTYPE.names]
+        items, stores = self.items, self.stores
+        return [Lot(items[item], wanted_color_id, color_id, stores[store], quantity, cost_per_unit)
+                for (item, wanted_color_id, color_id, store, quantity, cost_per_unit) in zip(*columns)]
+
+    def store_ids(self):
+        """Ids of all stores with at least one lot"""
+        return [self.stores[i] for i in np.unique(self.lots['store'])]
+
+    def select(self, store_ids):
+        """Only the lots sold by the given stores"""
+        store_ids = set(store_ids)
+        allowed = np.array([s in store_ids for s in self.stores] + [False])
+        return PriceGuideColumns(self.lots[allowed[self.lots['store']]], self.items, self.stores)
+
+
+def is_price_guide_columns(path):
+    """True if path holds a price guide saved by save_price_guide_columns"""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'lots.npy'))
+
+
+def load_price_guide_columns(path, mmap=True):
+    """Load a columnar price guide
+
+    Parameters
+    ----------
+    path : str
+        folder written by save_price_guide_columns
+    mmap : bool
+        memory map the lots instead of reading them into memory
+    """
+    lots = np.load(os.path.join(path, 'lots.npy'), mmap_mode='r' if mmap else None)
+    with open(os.path.join(path, 'tables.json')) as f:
+        tables = json.load(f)
+    return PriceGuideColumns(lots, tables['items'], tables['stores'])
+
+
+def save_price_guide_columns(path, price_guide):
+    """Save a price guide column by column
+
+    Lots go in a NumPy structured array (lots.npy) that can be memory mapped.
+    Item and store ids are interned in tables.json.
+
+    Parameters
+    ----------
+    path : str
+        folder to save to. Created if it doesn't exist.
+    price_guide : list of dict or PriceGuideColumns
+        price guide to save
+    """
+    if not isinstance(price_guide, PriceGuideColumns):
+        price_guide = PriceGuideColumns.from_records(price_guide)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'lots.npy'), np.asarray(price_guide.lots, dtype=LOT_DTYPE))
+    with open(os.path.join(path, 'tables.json'), 'w') as f:
+        json.dump({'items': price_guide.items, 'stores': price_guide.stores}, f)
 
 
 def load_store_metadata(f):
-    """Load metadata associated with stores"""
-    return json.load(f)
+    """Load metadata associated with stores
+
+    A minimum purchase the scraper couldn't read, in a currency it doesn't
+    know, is saved as None. It's loaded as 0.0, no minimum purchase, so the
+    store can still be used; BrickLink enforces the real minimum at
+    checkout.
+    """
+    metadata = json.load(f)
+    for store in metadata:
+        if store.get('minimum_buy', 0.0) is None:
+            store['minimum_buy'] = 0.0
+    return metadata
+
+
+class StoreTable(object):
+    """Store metadata indexed to pick stores by country, destination and
+    feedback quickly
+
+    Each country and destination maps to a bitmap over stores, and stores
+    are also kept sorted by feedback, so any combination of filters is a
+    few array operations however many stores there are.
+
+    Parameters
+    ----------
+    metadata : list of dict
+        store metadata, as returned by load_store_metadata
+
+    Attributes
+    ----------
+    metadata : list of dict
+        same as the input
+    store_ids : [n_stores] array
+        every store's id
+    countries : dict
+        maps a country name to a bitmap of the stores in it
+    ships_to : dict
+        maps a destination to a bitmap of the stores that list it
+    worldwide : [n_stores] array
+        bitmap of the stores that ship to all countries and nowhere else
+    """
+
+    def __init__(self, metadata):
+        self.metadata = list(metadata)
+        n_stores = len(self.metadata)
+        self.store_ids = np.array([s['store_id'] for s in self.metadata])
+        self.countries = {}
+        self.ships_to = {}
+        for (i, store) in enumerate(self.metadata):
+            self.countries.setdefault(store['country_name'], np.zeros(n_stores, dtype=bool))[i] = True
+            for destination in store['ships']:
+                self.ships_to.setdefault(destination, np.zeros(n_stores, dtype=bool))[i] = True
+        self.worldwide = np.array([s['ships'] == ['All Countries WorldWide'] for s in self.metadata], dtype=bool)
+
+        # stores by increasing feedback
+        feedback = np.array([s['feedback'] for s in self.metadata])
+        self._by_feedback = np.argsort(feedback, kind='stable')
+        self._feedback = feedback[self._by_feedback]
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def select(self, source_country=None, target_country=None, feedback=None, exclude=None):
+        """Bitmap of the stores that pass every given filter
+
+        Parameters
+        ----------
+        source_country : str or None
+            only stores in this country
+        target_country : str or None
+            only stores that ship to this country
+        feedback : int or None
+            only stores with at least this much feedback
+        exclude : iterable or None
+            store ids to leave out
+        """
+        n_stores = len(self.metadata)
+        nowhere = np.zeros(n_stores, dtype=bool)
+        mask = np.ones(n_stores, dtype=bool)
+        if source_country is not None:
+            mask &= self.countries.get(source_country, nowhere)
+        if target_country is not None:
+            mask &= self.ships_to.get(target_country, nowhere) | self.worldwide
+        if feedback is not None and feedback > 0:
+            enough = np.zeros(n_stores, dtype=bool)
+            enough[self._by_feedback[np.searchsorted(self._feedback, feedback):]] = True
+            mask &= enough
+        if exclude is not None:
+            mask &= ~np.isin(self.store_ids, list(exclude))
+        return mask
+
+    def filter(self, **filters):
+        """Metadata of the stores that pass the filters, see select()"""
+        return [self.metadata[i] for i in np.flatnonzero(self.select(**filters))]
+
+    def ids(self, **filters):
+        """Set of ids of the stores that pass the filters, see select()"""
+        return set(self.store_ids[self.select(**filters)].tolist())
 
 
 def save_store_metadata(f, metadata):
@@ -149,6 +538,36 @@ def save_store_metadata(f, metadata):
     json.dump(metadata, f, indent=2)
 
 
+def save_store_changes(f, changes):
+    """Save what changed between two store lists (scraper.store_changes)"""
+    json.dump(changes, f, indent=2)
+
+
+def append_store_metadata(f, link, entry):
+    """Append one store's metadata to a partial store list (JSON lines)"""
+    f.write("\n" + json.dumps([link, entry]) + "\n")
+    f.flush()
+
+
+def load_partial_store_metadata(f):
+    """Load a partial store list written by append_store_metadata
+
+    Returns
+    -------
+    entries : dict
+        maps link to a store's page to its metadata. A truncated last line,
+        as left behind by a crash, is ignored.
+    """
+    result = {}
+    for line in f:
+        try:
+            link, entry = json.loads(line)
+        except ValueError:
+            continue
+        result[link] = entry
+    return result
+
+
 def load_solution(f):
     """Load a set of buying recommendations"""
     return json.load(f)
@@ -2,148 +2,378 @@
 Algorithms for minimizing cost of a purchase
 """
 import copy
-import itertools
+import decimal
+import heapq
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import ilp, profiling, utils
+from .availability import Availability, PriceGuide
+
+
+@profiling.timed
+def presolve(wanted_parts, price_guide, stores=None, top_k=None):
+    """Remove lots and stores that can't be part of a cheapest purchase
+
+    Reductions, in order:
+
+    1) lots of items that aren't wanted are dropped
+    2) identical lots (same store, item, colors and price) are merged
+    3) a store's lots of an item are dropped once cheaper lots of the same
+       item in that store already cover the wanted quantity
+    4) if top_k is given, only the top_k cheapest lots of each item are kept.
+       Unlike the others, this can make the best purchase more expensive.
+    5) a store is dropped if another store without a minimum purchase can
+       supply the full wanted quantity of every item the first one has, at
+       no more than the first store's lowest price for it
+
+    Reductions 3 and 5 could make minimum purchases impossible, so stores
+    with a minimum purchase keep all their lots in 3 and can't stand in for
+    another store in 5. Pass stores=None for algorithms that ignore minimum
+    purchases.
+
+    Parameters
+    ----------
+    wanted_parts : list of dict
+        wanted lots
+    price_guide : list of dict or PriceGuide
+        lots for sale
+    stores : list of dict or None
+        store metadata, for each store's minimum purchase
+    top_k : int or None
+        keep at most this many lots of each wanted item
+
+    Returns
+    -------
+    (lots, stats) : tuple
+        lots that remain, and a dict with the number of lots and stores
+        before ('n_lots_before', 'n_stores_before') and after ('n_lots',
+        'n_stores'), and the number removed by each reduction
+    """
+    kf2 = lambda x: (x['ItemID'], x['ColorID'])
+
+    price_guide = PriceGuide.wrap(price_guide)
+    stats = {
+        'n_lots_before': len(price_guide),
+        'n_stores_before': len(price_guide.by_store),
+    }
+
+    # unwanted lots
+    wanted = price_guide.select(items=[kf2(e) for e in wanted_parts])
+    stats['n_unwanted'] = len(price_guide) - len(wanted)
+
+    # identical lots
+    lots = []
+    for positions in wanted.by_lot.values():
+        lot = wanted[positions[0]]
+        if len(positions) > 1:
+            lot = copy.copy(lot)
+            lot['quantity_available'] = sum(wanted[p]['quantity_available'] for p in positions)
+        lots.append(lot)
+    stats['n_merged'] = len(wanted) - len(lots)
+
+    availability = Availability(wanted_parts, lots)
+    minimum_buy = dict((s['store_id'], s['minimum_buy']) for s in (stores or []))
+    flexible = np.array([minimum_buy.get(s, 0.0) <= 0 for s in availability.store_ids], dtype=bool)
+
+    # lots each store has of each item, cheapest first, and how much of the
+    # item cheaper lots in the same store have
+    order = np.lexsort((np.arange(len(availability.ladder_keys)), availability.ladder_stores, availability.ladder_keys))
+    lot_stores, lot_keys = availability.ladder_stores[order], availability.ladder_keys[order]
+    quantities = availability.ladder_quantities[order]
+    total = np.cumsum(quantities)
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (lot_stores[1:] != lot_stores[:-1]) | (lot_keys[1:] != lot_keys[:-1])
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+    below = total - quantities - (total - quantities)[group_start]
+    needed = availability.needed[lot_keys]
+
+    keep = np.ones(len(lots), dtype=bool)
+    dominated = (below >= needed) & flexible[lot_stores]
+    keep[availability.ladder_positions[order[dominated]]] = False
+    stats['n_dominated_lots'] = int(dominated.sum())
+
+    # lots beyond the top_k cheapest of each item
+    stats['n_beyond_top_k'] = 0
+    if top_k is not None:
+        kept = keep[availability.ladder_positions]
+        rank = np.cumsum(kept) - 1
+        rank -= np.concatenate([[0], np.cumsum(kept)])[availability.ladder_starts[:-1]][availability.ladder_keys]
+        beyond = kept & (rank >= top_k)
+        keep[availability.ladder_positions[beyond]] = False
+        stats['n_beyond_top_k'] = int(beyond.sum())
+
+    # unit price at which each store can first supply all of each item, or
+    # inf if it can't
+    kept = keep[availability.ladder_positions[order]]
+    full_price = np.full(availability.quantities.shape, np.inf)
+    reaches = kept & (below < needed) & (below + quantities >= needed)
+    full_price[lot_stores[reaches], lot_keys[reaches]] = availability.ladder_prices[order[reaches]]
+
+    cheapest = np.full(availability.quantities.shape, np.inf)
+    np.minimum.at(cheapest, (lot_stores[kept], lot_keys[kept]), availability.ladder_prices[order[kept]])
+    has = cheapest < np.inf
+
+    # dominated stores. A store that's dropped can't stand in for another,
+    # which is safe because anything it could stand in for, the store that
+    # made it redundant can too. Only stores that can supply all of store i's
+    # rarest item are checked against it, as only they could stand in for it.
+    removed = ~has.any(axis=1)
+    supplies = (full_price < np.inf) & flexible[:, None]
+    suppliers = [np.flatnonzero(column) for column in supplies.T]
+    n_suppliers = supplies.sum(axis=0)
+    for i in range(len(availability.store_ids)):
+        if removed[i]:
+            continue
+        j = np.flatnonzero(has[i])
+        candidates = suppliers[j[np.argmin(n_suppliers[j])]]
+        candidates = candidates[~removed[candidates] & (candidates != i)]
+        if len(candidates) > 0:
+            removed[i] = np.all(full_price[np.ix_(candidates, j)] <= cheapest[i, j], axis=1).any()
+    stats['n_dominated_stores'] = int(removed.sum() - (~has.any(axis=1)).sum())
+    keep &= ~removed[[availability.store_index[e['store_id']] for e in lots]]
+
+    lots = [e for (e, k) in zip(lots, keep) if k]
+    stats['n_lots'] = len(lots)
+    stats['n_stores'] = len(set(e['store_id'] for e in lots))
+    profiling.count(**stats)
+    return (lots, stats)
+
+
+################################################################################
+
+@profiling.timed
+def brute_force(wanted_parts, price_guide, k, top=None, n_jobs=1, availability=None):
+    """Find the cheapest combinations of k stores by branch and bound
+
+    Combinations are enumerated in the same order as itertools.combinations,
+    but whole branches are skipped when the stores left can't cover the
+    wanted parts, or, once top solutions are known, when even buying from
+    every store left couldn't beat the worst of them. With top, stores that
+    could supply the most are tried first, to find cheap solutions early.
+    A combination is also skipped if it costs no less than a smaller
+    combination it contains; its extra stores are useless.
+
+    The bound on cost ignores how much stores have, so the search still
+    grows quickly with k. With 40 wanted items and 200 stores after
+    presolve, top=10 takes under a second for k=3, about a second for k=4
+    and 40 for k=5; with 150 items and 360 stores, k=4 takes 30 seconds.
+    Beyond that, use the ILP or LNS.
+
+    Parameters
+    ----------
+    wanted_parts : list of dict
+        wanted lots
+    price_guide : list of dict
+        lots for sale
+    k : int
+        number of stores to buy from
+    top : int or None
+        only return this many of the cheapest solutions, cheapest first. If
+        None, return all solutions in enumeration order.
+    n_jobs : int
+        number of processes to split the search over, by first store
+    availability : Availability or None
+        index over the same inputs, to reuse one that's already built
+    """
+    if availability is None:
+        availability = Availability(wanted_parts, price_guide)
+    threshold = multiprocessing.Value('d', float('inf'))
+    args = (availability, k, top, threshold)
+    roots = range(len(availability.store_ids))
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_brute_force, initargs=args) as pool:
+            results = utils.flatten(pool.map(_brute_force, roots))
+    else:
+        _init_brute_force(*args)
+        results = utils.flatten(_brute_force(first) for first in roots)
+
+    if top is not None:
+        results = list(sorted(results, key=lambda x: x['cost']))[0:top]
+    profiling.count(k=k, n_solutions=len(results))
+    return results
 
-from . import utils
 
+# state shared by brute force searches in the same process
+_BRUTE_FORCE = {}
 
-def brute_force(wanted_parts, price_guide, k):
-    """Enumerate all possible combinations of k stores"""
-    by_store = utils.groupby(price_guide, lambda x: x['store_id'])
+
+def _init_brute_force(availability, k, top, threshold):
+    # with top, stores that could supply the most are searched first, as
+    # they make the cheap solutions that let the rest be skipped
+    if top is None:
+        order = np.arange(len(availability.store_ids))
+    else:
+        order = np.argsort(-availability.coverage(availability.needed), kind='stable')
+
+    # an extra store that sells nothing, so suffixes past the last store work
+    quantities = np.vstack([availability.quantities[order], np.zeros_like(availability.needed)])
+    prices = np.vstack([availability.cheapest[order], np.full(len(availability.needed), np.inf)])
+
+    _BRUTE_FORCE.update({
+        'availability': availability,
+        'order': order.tolist(),
+        'k': k,
+        'top': top,
+        'threshold': threshold,
+        'quantities': quantities,
+        'prices': prices,
+        # the same, over all stores from the i-th one onwards
+        'remaining': np.cumsum(quantities[::-1], axis=0)[::-1],
+        'cheapest': np.minimum.accumulate(prices[::-1], axis=0)[::-1],
+        'needed': availability.needed,
+    })
+
+
+def _brute_force(first):
+    """Search all combinations whose first store is the first-th in search
+    order"""
+    state = _BRUTE_FORCE
+    availability = state['availability']
+    store_ids, order = availability.store_ids, state['order']
+    k, top, threshold = state['k'], state['top'], state['threshold']
+    quantities, remaining, needed = state['quantities'], state['remaining'], state['needed']
+    prices, cheapest = state['prices'], state['cheapest']
+    n_stores = len(store_ids)
 
     results = []
-    for selected_stores in itertools.combinations(list(by_store.keys()), k):
-        # get items sold by these stores only
-        inventory = utils.flatten(by_store[s] for s in selected_stores)
-        if covers(wanted_parts, inventory):
-            # calculate minimum cost to buy everything using these stores
-            cost, allocation = min_cost(wanted_parts, inventory)
-            results.append({
-                'cost': cost,
-                'allocation': allocation,
-                'store_ids': selected_stores
-            })
-            # print 'Solution: k=%d, cost=%8.2f, store_ids=%40s' % (k, cost, selected_stores)
+    best = []  # max-heap of the costs of the cheapest solutions found
+
+    def worst_allowed():
+        # cost a solution must beat to be among the top found in any process
+        if top is None:
+            return float('inf')
+        if len(best) == top:
+            with threshold.get_lock():
+                threshold.value = min(threshold.value, -best[0])
+        return threshold.value
+
+    def leaf(selected):
+        selected = sorted(order[i] for i in selected)
+        cost = availability.cost(selected)
+        if cost > worst_allowed():
+            return
+        # a store is useless if the others cover everything as cheaply.
+        # Leaving out one store at a time covers every smaller combination,
+        # as more stores never cost more.
+        for j in range(len(selected)):
+            others = selected[:j] + selected[j + 1:]
+            if len(others) > 0 and availability.covers(others) and availability.cost(others) <= cost + 1e-9:
+                return
+
+        cost, allocation = availability.min_cost(selected)
+        results.append({
+            'cost': cost,
+            'allocation': allocation,
+            'store_ids': tuple(store_ids[i] for i in selected)
+        })
+        if top is not None:
+            heapq.heappush(best, -cost)
+            if len(best) > top:
+                heapq.heappop(best)
+
+    def visit(selected, have, lowest_price):
+        # every store that could come next, all at once
+        candidates = np.arange(selected[-1] + 1, n_stores - (k - len(selected)) + 1)
+        with_store = have + quantities[candidates]
+        with_price = np.minimum(lowest_price, prices[candidates])
+        if len(selected) == k - 1:
+            # the last store must cover what's left, and buying everything
+            # at the lowest unit price of the stores chosen must be cheap
+            # enough
+            fits = np.all(with_store >= needed, axis=1)
+            bounds = with_price.dot(needed)
+        else:
+            # the same, for the store plus every store after it
+            fits = np.all(with_store + remaining[candidates + 1] >= needed, axis=1)
+            bounds = np.minimum(with_price, cheapest[candidates + 1]).dot(needed)
+
+        for c in np.flatnonzero(fits).tolist():
+            # solutions found meanwhile may have raised the bar
+            if bounds[c] > worst_allowed():
+                continue
+            if len(selected) == k - 1:
+                leaf(selected + [int(candidates[c])])
+            else:
+                visit(selected + [int(candidates[c])], with_store[c], with_price[c])
+
+    if n_stores - first >= k:
+        if k == 1:
+            if np.all(quantities[first] >= needed):
+                leaf([first])
         else:
-            # print 'Unable to fill quote using store_ids=%40s' % (selected_stores,)
-            pass
+            visit([first], quantities[first], prices[first])
+
+    if top is not None:
+        results = list(sorted(results, key=lambda x: x['cost']))[0:top]
     return results
 
 
 def min_cost(wanted_parts, available_parts):
     """Greedily minimize the cost of all wanted parts"""
-    kf = lambda x: (x['item_id'], x['wanted_color_id'])
-    available_parts = utils.groupby(available_parts, kf)
-
-    result = []
-    cost = 0.0
-    for item in wanted_parts:
-        item_id = item['ItemID']
-        color_id = item['ColorID']
-        matching = available_parts.get((item_id, color_id), [])
-        matching = list(sorted(matching, key=lambda x: -1 * x['cost_per_unit']))
-
-        # take as much inventory as possible, starting with the lowest price, until
-        # the requested quantity is filled
-        n_remaining = item['Qty']
-        while n_remaining > 0:
-            if len(matching) == 0:
-                print('WARNING: couldn\'t find enough inventory to purchase %s' % (item['ItemName'],))
-                cost = float('inf')
-                break
-
-            next = matching.pop()
-            amount = min(n_remaining, next['quantity_available'])
-            r = {
-                'item_id': next['item_id'],
-                'color_id': next['color_id'],
-                'store_id': next['store_id'],
-                'quantity': amount,
-                'cost_per_unit': next['cost_per_unit']
-            }
-            result.append(r)
-            n_remaining -= amount
-            cost += amount * next['cost_per_unit']
-
-    return (cost, result)
+    return Availability(wanted_parts, available_parts).min_cost()
 
 
 def covers(wanted_parts, available_parts):
     """True if the given stores can cover all desired items"""
-    kf = lambda x: (x['item_id'], x['wanted_color_id'])
-    available_parts = utils.groupby(available_parts, kf)
-
-    for item in wanted_parts:
-        item_id = item['ItemID']
-        color_id = item['ColorID']
-        quantity = item['Qty']
-        available = available_parts.get((item_id, color_id), [])
-        inventory = sum(e['quantity_available'] for e in available)
-
-        if inventory < quantity:
-            return False
-    return True
+    return Availability(wanted_parts, available_parts).covers()
 
 
 ################################################################################
 
-def greedy(wanted_parts, price_guide):
+@profiling.timed
+def greedy(wanted_parts, price_guide, availability=None):
     """Greedy Set-Cover algorithm to minimize number of stores purchased from.
-    Disregards prices in decisions."""
-    result = []
-
-    available_parts = utils.groupby(price_guide, lambda x: x['store_id'])
-    available_parts = copy.deepcopy(available_parts)
-
-    wanted_parts = copy.deepcopy(wanted_parts)
-    wanted_by_item = utils.groupby(wanted_parts, lambda x: (x['ItemID'], x['ColorID']))
+    Disregards prices in decisions.
 
-    # while we don't have all the parts we need
-    while len(wanted_parts) > 0 and len(available_parts) > 0:
-        # calculate how many parts each vendor can cover
-        def coverage(inventory):
-            kf = lambda x: (x['item_id'], x['wanted_color_id'])
-            # only worry about items wanted
-            wanted = [x for x in inventory if kf(x) in wanted_by_item]
-
-            # count up how much there is of each (item_id, color_id) pair
-            wanted = utils.groupby(wanted, kf)
-            wanted = [(x[0], sum(e['quantity_available'] for e in x[1])) for x in iter(wanted.items())]
+    A store's coverage (how many wanted parts it could supply) can only shrink
+    as parts are bought elsewhere, so a coverage computed earlier is an upper
+    bound on its current value. Stores wait in a max-heap keyed by that bound
+    and are only re-evaluated when they reach the top. Ties go to the largest
+    store id.
 
-            # count how much of each item I'd buy
-            tot = 0
-            for (k, v) in wanted:
-                if k in wanted_by_item:
-                    tot += min(wanted_by_item[k][0]['Qty'], v)
+    availability is an Availability index over the same inputs, to reuse one
+    that's already built."""
+    kf2 = lambda x: (x['ItemID'], x['ColorID'])
+    if availability is None:
+        availability = Availability(wanted_parts, price_guide)
+    result = []
 
-            return tot
+    # how many parts we still need of each item
+    remaining = availability.needed.copy()
 
-        coverages = [(k, v, coverage(v)) for (k, v) in available_parts.items()]
-        coverages = list(sorted(coverages, key=lambda x: x[2]))
+    heap = [(-n_parts, -i, i) for (i, n_parts) in enumerate(availability.coverage(remaining).tolist())]
+    heapq.heapify(heap)
 
+    # while we don't have all the parts we need
+    while np.any(remaining > 0) and len(heap) > 0:
         # use the store that has the most inventory
-        next_store, inventory, n_parts = coverages.pop()
-        # print 'You can buy %d items from %s' % (n_parts, next_store)
+        _, neg_rank, next_store = heapq.heappop(heap)
+        n_parts = int(availability.coverage(remaining, next_store))
+        if len(heap) > 0 and (-n_parts, neg_rank) > heap[0][0:2]:
+            # another store might cover more now
+            heapq.heappush(heap, (-n_parts, neg_rank, next_store))
+            continue
         if n_parts == 0:
             break
 
-        # update the quantities in the wanted parts list
-        by_item = utils.groupby(inventory,
-                                lambda x: (x['item_id'], x['wanted_color_id']))
-        new_wanted_parts = []
-        for item in wanted_parts:
-            # get all lots from next_store matching item
-            item_id = item['ItemID']
-            color_id = item['ColorID']
-            wanted_qty = item['Qty']
-
-            available = by_item.get((item_id, color_id), [])
-            available = list(sorted(available, key=lambda x: -1 * x['cost_per_unit']))
+        # buy from this store, in the order parts were wanted
+        for j in np.flatnonzero((remaining > 0) & (availability.quantities[next_store] > 0)):
+            item_id, color_id = availability.keys[j]
+            wanted_qty = int(remaining[j])
+            available = availability.lots_by_store_item[(next_store, j)]
 
             # keep buying up lots until the wanted_qty is full or the store is bought
             # out
-            while wanted_qty > 0 and len(available) > 0:
-                next = available.pop()
+            for p in available:
+                if wanted_qty <= 0:
+                    break
+                next = availability.lots[p]
 
                 amount_to_buy = min(next['quantity_available'], wanted_qty)
 
@@ -159,25 +389,16 @@ def greedy(wanted_parts, price_guide):
 
                 wanted_qty -= amount_to_buy
 
-            # this store couldn't fill out our order
-            if wanted_qty > 0:
-                item['Qty'] = wanted_qty
-                new_wanted_parts.append(item)
-
-        # update wanted parts list, remove store from inventory
-        wanted_parts = new_wanted_parts
-        wanted_by_item = utils.groupby(wanted_parts,
-                                       lambda x: (x['ItemID'], x['ColorID']))
-        del available_parts[next_store]
-
-        # print 'Wanted parts left: %d' % sum(e['Qty'] for e in wanted_parts)
+            remaining[j] = wanted_qty
 
+    wanted_parts = [item for item in wanted_parts if remaining[availability.key_index[kf2(item)]] > 0]
     if len(wanted_parts) > 0:
         print('WARNING: there wasn\'t enough availability to buy the following items:')
         print(", ".join(e['ItemName'] for e in wanted_parts))
 
     cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
     store_ids = list(set(e['store_id'] for e in result))
+    profiling.count(n_greedy_stores=len(store_ids))
     return [{
         'cost': cost,
         'allocation': result,
@@ -187,123 +408,391 @@ def greedy(wanted_parts, price_guide):
 
 ################################################################################
 
+@profiling.timed
+def integer_program(wanted_parts, available_parts, stores=None, shipping_cost=10.0,
+                    backend='highs', gap=0.01, time_limit=None, threads=None, names=False,
+                    start=None, on_incumbent=None):
+    """Minimize the cost of parts plus shipping exactly, as an integer linear program
+
+    Parameters
+    ----------
+    stores : list of dict or None
+        store metadata, for each store's minimum purchase
+    backend : str
+        solver to use; one of ilp.BACKENDS
+    gap, threads, on_incumbent
+        passed on to ilp.solve()
+    time_limit : float or None
+        seconds to spend in all, including building the model
+    names : bool
+        name the model's variables and constraints, for debugging
+    start : list of dict or None
+        allocation to start from, such as one found by greedy()
+
+    Returns
+    -------
+    solutions : list of dict
+        the best solution found, or nothing if there is none
+    """
+    began = time.time()
+    with profiling.phase('build'):
+        model = ilp.build(wanted_parts, available_parts, stores, shipping_cost=shipping_cost, names=names)
+        profiling.count(n_variables=model.n_variables, n_constraints=model.n_constraints,
+                        n_integer_variables=int(model.integrality.sum()), n_nonzeros=len(model.coefficients))
+    print('Built model with %d variables and %d constraints in %.2fs' %
+          (model.n_variables, model.n_constraints, time.time() - began))
+
+    x0 = None
+    if start is not None:
+        x0 = ilp.from_allocation(model, start)
+    if time_limit is not None:
+        time_limit = max(time_limit - (time.time() - began), 0.0)
+
+    solving = time.time()
+    with profiling.phase('solve'):
+        solution = ilp.solve(model, backend, gap=gap, time_limit=time_limit, threads=threads,
+                             start=x0, on_incumbent=on_incumbent)
+    print('Solved in %.2fs' % (time.time() - solving,))
+    if solution is None:
+        print('No solution :(')
+        return []
+    return [solution]
+
+
 def gurobi(wanted_parts, available_parts, stores, shipping_cost=10.0):
-    from gurobipy import Model, GRB, LinExpr
+    return integer_program(wanted_parts, available_parts, stores, shipping_cost=shipping_cost, backend='gurobi')
 
-    kf1 = lambda x: (x['item_id'], x['wanted_color_id'])
-    kf2 = lambda x: (x['ItemID'], x['ColorID'])
 
-    available_by_store = utils.groupby(available_parts, lambda x: x['store_id'])
-    store_by_id = dict((s['store_id'], s) for s in stores)
-
-    m = Model()
-
-    store_variables = {}  # store id to variable indicating store is used
-    quantity_variables = []  # list of all lot variables + metadata
-
-    # for every store
-    for (store_id, inventory) in available_by_store.items():
-
-        # a variable for if anything was bought from this store. if 1, then pay
-        # shipping cost and all store inventory is available; if 0, then don't pay
-        # for shipping and every lot in it has 0 quantity available
-        store_variables[store_id] = m.addVar(0.0, 1.0, shipping_cost, GRB.BINARY,
-                                             "use-store=%s" % (store_id,))
-
-        for lot in inventory:
-            store_id = lot['store_id']
-            quantity = lot['quantity_available']
-            unit_cost = lot['cost_per_unit']
-            item_id = lot['item_id']
-            color_id = lot['color_id']
-
-            # a variable for how much to buy of this lot
-            v = m.addVar(0.0, quantity, unit_cost, GRB.CONTINUOUS,
-                         "quantity-store=%s-item=%s-color=%s" % (store_id, item_id, color_id))
-
-            # keep a list of all lots
-            quantity_variables.append({
-                'store_id': store_id,
-                'item_id': lot['item_id'],
-                'wanted_color_id': lot['wanted_color_id'],
-                'color_id': lot['color_id'],
-                'variable': v,
-                'quantity_available': quantity,
-                'cost_per_unit': unit_cost
-            })
-
-    # actually put the variables into the model
-    m.update()
-
-    # for every lot in every store
-    for lot in quantity_variables:
-        use_store = store_variables[lot['store_id']]
-        quantity = lot['quantity_available']
-        unit_cost = lot['cost_per_unit']
-        v = lot['variable']
-
-        # a constraint for how much can be bought
-        m.addConstr(LinExpr([1.0, -1 * quantity], [v, use_store]),
-                    GRB.LESS_EQUAL, 0.0,
-                    "maxquantity-store=%s-item=%s-color-%d" % (lot['store_id'], lot['item_id'], lot['color_id']))
-
-    # for every wanted lot
-    variables_by_id = utils.groupby(quantity_variables, kf1)
-    for lot in wanted_parts:
-        # a constraint saying amount bought >= wanted amount
-        variables = [x['variable'] for x in variables_by_id[kf2(lot)]]
-        constants = len(variables) * [1.0]
-        m.addConstr(LinExpr(constants, variables),
-                    GRB.GREATER_EQUAL, lot['Qty'],
-                    "wantedamount-item=%s-color=%s" % (lot['ItemID'], lot['ColorID']))
-
-    # for every store
-    variables_by_store = utils.groupby(quantity_variables, lambda x: x['store_id'])
-    for (store_id, variables) in variables_by_store.items():
-        use_store = store_variables[store_id]
-        minimum_purchase = store_by_id[store_id]['minimum_buy']
-
-        # a constraint saying "if I purchased from this store, I bought the minimum amount or more"
-        constants = [v['cost_per_unit'] for v in variables] + [-1 * minimum_purchase]
-        variables = [v['variable'] for v in variables] + [use_store]
-        m.addConstr(LinExpr(constants, variables),
-                    GRB.GREATER_EQUAL, 0.0,
-                    "minbuy-store=%d" % (store_id,))
-
-    # minimize sum of costs of items bought + shipping costs
-    m.setParam(GRB.param.MIPGap, 0.01)  # stop when duality gap <= 1%
-    m.optimize()
-
-    # get results
-    if m.ObjVal < float('inf'):
-        result = []
-        for lot in quantity_variables:
-            # get variable out
-            v = lot['variable']
-            del lot['variable']
-
-            # lot variables are continuous, so they might not actually be integral.
-            # If they're not, check that they're "almost" integral, so we can just
-            # round. Otherwise, print this warning.  According to theory the optimal
-            # solution is for all continuous variables to be integral.
-            if v.X != int(v.X) and abs(v.X - round(v.X)) > 1e-3:
-                print('Uh oh. Variable %s has value %f. This is a little close for comfort.' % (v.VarName, v.X))
-
-            # save quantity to buy if it's > 0
-            lot['quantity'] = int(round(v.X))
-            if lot['quantity'] > 0:
-                result.append(lot)
-
-        cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
-        store_ids = list(set(e['store_id'] for e in result))
-        return [{
-            'cost': cost,
-            'allocation': result,
-            'store_ids': store_ids
-        }]
+################################################################################
+
+@profiling.timed
+def lns(wanted_parts, available_parts, stores=None, shipping_cost=10.0, time_limit=60.0,
+        n_jobs=1, n_free=3, n_candidates=20, max_stale=20, move_time_limit=5.0, backend='highs',
+        seed=0, start=None, availability=None, on_incumbent=None, lower_bound=None, gap=0.0):
+    """Minimize the cost of parts plus shipping by large neighborhood search
+
+    Starting from greedy()'s solution, repeatedly free a few stores, either
+    chosen at random or because they carry randomly chosen items, and
+    re-solve exactly which stores to use as a small integer program: the
+    stores kept must stay open, while the freed stores and the
+    n_candidates stores best able to replace them are up for grabs. A move
+    is kept if it's cheaper. The more moves in a row fail, the more stores
+    are freed. To keep moves quick, quantities bought are only rounded to
+    whole numbers after solving, so minimum purchases can cost a little
+    more than they would with integer_program().
+
+    Respects minimum purchases and shipping costs like integer_program(),
+    but each program only involves a few dozen stores, so it scales to
+    price guides the full program is too large for.
+
+    Parameters
+    ----------
+    stores : list of dict or None
+        store metadata, for each store's minimum purchase
+    time_limit : float
+        seconds to search for
+    n_jobs : int
+        number of processes trying moves at the same time
+    n_free : int
+        number of stores to free, at first
+    n_candidates : int
+        number of other stores that may replace the freed ones
+    max_stale : int
+        stop after this many rounds of moves without improvement
+    move_time_limit : float
+        seconds to spend on each move, at most
+    backend : str
+        solver for the small programs; one of ilp.BACKENDS
+    seed : int
+        for the random number generator
+    start : list of dict or None
+        allocation to start from instead of greedy()'s. If it misses a
+        minimum purchase, the first move repairs it.
+    availability : Availability or None
+        index over the same inputs, to reuse one that's already built
+    on_incumbent : function or None
+        called with every improving solution found
+    lower_bound : float or None
+        cost, including shipping, no solution can beat, e.g. from
+        lower_bound()
+    gap : float
+        stop once the best solution is within this fraction of lower_bound
+
+    Returns
+    -------
+    solutions : list of dict
+        the best solution found, or nothing if there is none
+    """
+    began = time.time()
+    if availability is None:
+        availability = Availability(wanted_parts, available_parts)
+    if start is None:
+        start = greedy(wanted_parts, available_parts, availability=availability)[0]['allocation']
+    rng = random.Random(seed)
+    args = (wanted_parts, availability, stores, shipping_cost, backend, n_candidates)
+    objective = lambda x: x['cost'] + shipping_cost * len(x['store_ids'])
+
+    _init_lns(*args)
+    if n_jobs > 1:
+        pool = ProcessPoolExecutor(n_jobs, initializer=_init_lns, initargs=args)
+        run = lambda moves: list(pool.map(_lns_move, moves))
     else:
-        print('No solution :(')
-        return []
+        pool = None
+        run = lambda moves: [_lns_move(move) for move in moves]
+
+    try:
+        best = None
+        if is_valid_solution(wanted_parts, start, stores):
+            best = {
+                'cost': sum(e['quantity'] * e['cost_per_unit'] for e in start),
+                'allocation': start,
+                'store_ids': list(set(e['store_id'] for e in start)),
+            }
+
+        # otherwise make the starting stores respect minimum purchases by
+        # letting the program pick among them and the stores most like them,
+        # adding more stores until that works
+        current = set(availability.stores(set(e['store_id'] for e in start)))
+        n_extra = n_candidates
+        while best is None and time.time() - began < time_limit:
+            remaining = min(time_limit - (time.time() - began), move_time_limit)
+            best = _lns_move(([], sorted(current), n_extra, remaining))
+            if n_extra >= len(availability.store_ids):
+                break
+            n_extra *= 2
+        if best is None:
+            print('No solution :(')
+            return []
+        if on_incumbent is not None:
+            on_incumbent(best)
+
+        n_stale = 0
+        n_rounds = 0
+        n_improvements = 0
+        while n_stale < max_stale and time.time() - began < time_limit:
+            if lower_bound is not None and optimality_gap(objective(best), lower_bound) <= gap:
+                print('LNS: within %.1f%% of the lower bound' % (100 * gap,))
+                break
+
+            current = sorted(availability.stores(best['store_ids']))
+            size = min(n_free + n_stale // 2, len(current))
+            remaining = min(max(time_limit - (time.time() - began), 0.0), move_time_limit)
+
+            moves = []
+            for j in range(max(n_jobs, 1)):
+                if j % 2 == 0:
+                    # free random stores
+                    freed = rng.sample(current, size)
+                else:
+                    # free the stores that carry random items
+                    items = rng.sample(range(len(availability.keys)), min(size, len(availability.keys)))
+                    freed = [i for i in current if np.any(availability.quantities[i, items] > 0)]
+                kept = sorted(set(current) - set(freed))
+                moves.append((kept, freed, n_candidates, remaining))
+
+            n_rounds += 1
+            found = [x for x in run(moves) if x is not None]
+            found = min(found, key=objective) if len(found) > 0 else None
+            if found is not None and objective(found) < objective(best) - 1e-6:
+                best = found
+                n_stale = 0
+                n_improvements += 1
+                print('LNS: $%.2f with %d stores after %.1fs' %
+                      (objective(best), len(best['store_ids']), time.time() - began))
+                if on_incumbent is not None:
+                    on_incumbent(best)
+            else:
+                n_stale += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    print('LNS: %d rounds in %.1fs' % (n_rounds, time.time() - began))
+    profiling.count(n_lns_rounds=n_rounds, n_lns_improvements=n_improvements)
+    return [best]
+
+
+# state shared by LNS moves in the same process
+_LNS = {}
+
+
+def _init_lns(wanted_parts, availability, stores, shipping_cost, backend, n_candidates):
+    lots_by_store = {}
+    for (p, lot) in enumerate(availability.lots):
+        lots_by_store.setdefault(availability.store_index[lot['store_id']], []).append(p)
+
+    _LNS.update({
+        'wanted_parts': wanted_parts,
+        'availability': availability,
+        'stores': stores,
+        'shipping_cost': shipping_cost,
+        'backend': backend,
+        'lots_by_store': lots_by_store,
+    })
+
+
+def _lns_move(move):
+    """Re-solve which stores to use, keeping some open and choosing freely
+    among others plus the best stores to replace them
+
+    Returns the solution found, or None if there is none."""
+    kept, freed, n_candidates, time_limit = move
+    state = _LNS
+    availability = state['availability']
+
+    # what the kept stores can't supply, and the other stores that can supply
+    # most of it
+    remaining = np.maximum(availability.needed - availability.quantities[kept].sum(axis=0), 0)
+    coverage = availability.coverage(remaining).astype(float)
+    coverage[kept + freed] = -1
+    candidates = [i for i in np.argsort(-coverage, kind='stable')[:n_candidates] if coverage[i] > 0]
+
+    chosen = sorted(set(kept + freed + candidates))
+    lots = [availability.lots[p] for i in chosen for p in state['lots_by_store'].get(i, [])]
+    if not availability.covers(chosen):
+        return None
+
+    model = ilp.build(state['wanted_parts'], lots, state['stores'], shipping_cost=state['shipping_cost'],
+                      integral_lots=False)
+    fixed = set(availability.store_ids[i] for i in kept)
+    for (i, store_id) in enumerate(model.store_ids):
+        if store_id in fixed:
+            model.lower[len(model.lots) + i] = 1.0
+    return ilp.solve(model, state['backend'], gap=1e-4, time_limit=time_limit, verbose=False)
+
+
+################################################################################
+
+@profiling.timed
+def lower_bound(wanted_parts, available_parts, stores=None, shipping_cost=10.0, method='lagrangian',
+                upper_bound=None, n_iterations=2000, time_limit=60.0, availability=None):
+    """A cost no purchase of the wanted parts can beat, counting shipping
+
+    Parameters
+    ----------
+    stores : list of dict or None
+        store metadata, for each store's minimum purchase. Only used by the
+        'lp' and 'best' methods; the bound holds either way.
+    shipping_cost : float
+        estimated cost of shipping from each store used
+    method : str
+        'lagrangian' relaxes the wanted amounts into prices per item and
+        improves them by subgradient ascent. It needs nothing but NumPy and
+        every step gives a valid bound, but it converges slowly, so it can
+        end well below the best bound of its kind, which is as tight as
+        'lp' without minimum purchases. 'lp' solves the linear relaxation of
+        integer_program()'s model with HiGHS, which needs scipy, and
+        accounts for minimum purchases, but takes much longer on big price
+        guides. 'best' takes the larger of the two, or only 'lagrangian'
+        without scipy. If the relaxation isn't solved in time, 'lp' and
+        'best' give the 'lagrangian' bound.
+    upper_bound : float or None
+        cost of a known purchase, including shipping, which steers the
+        'lagrangian' method. greedy()'s is used if None.
+    n_iterations : int
+        subgradient steps to take, at most
+    time_limit : float or None
+        seconds the linear relaxation may take
+    availability : Availability or None
+        index over the same inputs, to reuse one that's already built
+
+    Returns
+    -------
+    bound : float
+        inf if the wanted parts can't be bought at all
+    """
+    if availability is None:
+        availability = Availability(wanted_parts, available_parts)
+    if not availability.covers():
+        return float('inf')
+
+    if method == 'lp':
+        bound = _lp_bound(wanted_parts, available_parts, stores, shipping_cost, time_limit)
+        if bound is not None:
+            return bound
+
+    if upper_bound is None:
+        solution = greedy(wanted_parts, available_parts, availability=availability)[0]
+        upper_bound = solution['cost'] + shipping_cost * len(solution['store_ids'])
+    bound = _lagrangian_bound(availability, shipping_cost, upper_bound, n_iterations)
+
+    if method == 'best' and bound < upper_bound - 1e-9:
+        try:
+            import scipy.optimize
+        except ImportError:
+            return bound
+        relaxed = _lp_bound(wanted_parts, available_parts, stores, shipping_cost, time_limit)
+        if relaxed is not None:
+            bound = max(bound, relaxed)
+    return bound
+
+
+def _lp_bound(wanted_parts, available_parts, stores, shipping_cost, time_limit):
+    # None if the relaxation isn't solved to optimality, as only then is its
+    # value a bound
+    from scipy.optimize import Bounds, LinearConstraint, milp
+    model = ilp.build(wanted_parts, available_parts, stores, shipping_cost=shipping_cost)
+    options = {} if time_limit is None else {'time_limit': time_limit}
+    result = milp(model.objective,
+                  bounds=Bounds(model.lower, model.upper),
+                  constraints=LinearConstraint(model.matrix(), model.constraint_lower, model.constraint_upper),
+                  options=options)
+    if result.status != 0:
+        print('Linear relaxation not solved, using the Lagrangian bound: %s' % (result.message,))
+        return None
+    # leave some room for the solver's tolerances
+    return result.fun - 1e-6 * abs(result.fun)
+
+
+def _lagrangian_bound(availability, shipping_cost, upper_bound, n_iterations):
+    # Give every wanted unit of item j a price l[j] and let stores sell to us
+    # freely: a store is worth opening if what it sells for less than l is
+    # worth more than shipping. The cost of that, plus l times the wanted
+    # amounts, is a lower bound for any l >= 0. Minimum purchases only make
+    # things more expensive, so they're left out. Buying more of a lot than
+    # is wanted never helps then, so lot quantities are capped at that.
+    lot_keys, lot_stores, prices = availability.ladder_keys, availability.ladder_stores, availability.ladder_prices
+    n_stores, n_keys = len(availability.store_ids), len(availability.keys)
+    needed = availability.needed.astype(float)
+    quantities = np.minimum(availability.ladder_quantities, availability.needed[lot_keys]).astype(float)
+
+    # start from the price of the last wanted unit, if every store were free
+    item_prices = availability.last_unit_prices()
+
+    # Polyak steps towards upper_bound, which overshoot when it's far above
+    # the bound, so steps are halved after 30 in a row that don't help
+    best = -float('inf')
+    step, n_stale = 1.0, 0
+    for iteration in range(n_iterations):
+        gains = quantities * np.minimum(prices - item_prices[lot_keys], 0.0)
+        value = shipping_cost + np.bincount(lot_stores, gains, minlength=n_stores)
+        opened = value < 0
+        bound = float(np.dot(item_prices, needed) + value[opened].sum())
+        if bound > best + 1e-9:
+            best, n_stale = bound, 0
+        else:
+            n_stale += 1
+            if n_stale >= 30:
+                step, n_stale = step / 2, 0
+        if best >= upper_bound - 1e-9 or step < 1e-6:
+            break
+
+        # raise prices of items that are short, lower those that are over-supplied
+        bought = quantities * ((prices < item_prices[lot_keys]) & opened[lot_stores])
+        direction = needed - np.bincount(lot_keys, bought, minlength=n_keys)
+        norm = np.dot(direction, direction)
+        if norm == 0:
+            break
+        item_prices = np.maximum(item_prices + step * (upper_bound - bound) / norm * direction, 0.0)
+    profiling.count(n_bound_iterations=iteration + 1)
+    return best
+
+
+def optimality_gap(cost, bound):
+    """How much more than the lower bound a cost is, as a fraction of the cost"""
+    if cost <= 0:
+        return 0.0
+    return max(cost - bound, 0.0) / cost
 
 
 ################################################################################
@@ -354,8 +843,10 @@ def is_valid_solution(wanted_parts, allocation, stores=None):
             # did we buy at least the minimum purchase?
             if store_id in store_by_id:
                 store = store_by_id[store_id]
-                price = sum(e['cost_per_unit'] * e['quantity'] for e in lots)
-                if price < store['minimum_buy']:
+                # add up prices as the decimals they're listed as, as
+                # floating point can land a hair below a minimum that's met
+                price = sum(decimal.Decimal(repr(float(e['cost_per_unit']))) * int(e['quantity']) for e in lots)
+                if price < decimal.Decimal(repr(float(store['minimum_buy']))):
                     return False
             else:
                 return False
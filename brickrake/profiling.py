@@ -0,0 +1,249 @@
+"""
+Where a run spends its time and memory: phase timers, peak memory, problem
+sizes and solver statistics, saved as a JSON report
+
+Code marks its phases with phase() or timed(), and records what it's
+working on with count() and solver(). These do nothing unless a Profiler is
+running.
+"""
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# the Profiler phases are recorded by, if any
+_ACTIVE = None
+
+
+def rss():
+    """Memory this process uses right now (its resident set size) in bytes,
+    or None where that's unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def max_rss():
+    """Most memory this process has used so far in bytes, or None where
+    that's unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def megabytes(n_bytes):
+    return None if n_bytes is None else n_bytes / 1e6
+
+
+class Profiler(object):
+    """Records the phases of a run while it's used as a context manager
+
+    Phases can nest; a phase's name is its path, e.g. 'ilp/solve'. Memory
+    is sampled in a background thread every interval seconds, so short
+    spikes can be missed. Only this process is measured, not the worker
+    processes some algorithms start.
+
+    Parameters
+    ----------
+    cprofile_dir : str or None
+        also run cProfile over every outermost phase, saving its stats to
+        <cprofile_dir>/<phase>.prof and listing its hot functions in the
+        report. Repeated phases are numbered.
+    interval : float
+        seconds between memory samples
+    n_hot : int
+        hot functions listed per phase, by time spent in the function itself
+    """
+
+    def __init__(self, cprofile_dir=None, interval=0.01, n_hot=15):
+        self.cprofile_dir = cprofile_dir
+        self.interval = interval
+        self.n_hot = n_hot
+        self.phases = []
+        self.solves = []
+        self.began = None
+        self.seconds = None
+        self._open = []  # phases running now, outermost first
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        global _ACTIVE
+        if self.cprofile_dir is not None and not os.path.exists(self.cprofile_dir):
+            os.makedirs(self.cprofile_dir)
+        self.began = time.time()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        _ACTIVE = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _ACTIVE
+        _ACTIVE = None
+        self._stop.set()
+        self._sampler.join()
+        self.seconds = time.time() - self.began
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._update_peaks(rss())
+
+    def _update_peaks(self, current):
+        if current is None:
+            return
+        with self._lock:
+            for record in self._open:
+                record['peak_rss'] = max(record['peak_rss'], current)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase and sample the memory it uses"""
+        current = rss()
+        with self._lock:
+            if len(self._open) > 0:
+                name = self._open[-1]['name'] + '/' + name
+            record = {
+                'name': name,
+                'depth': len(self._open),
+                'start': time.time() - self.began,
+                'seconds': None,
+                'rss_mb': megabytes(current),
+                'peak_rss': current if current is not None else 0,
+                'counters': {},
+            }
+            self.phases.append(record)
+            self._open.append(record)
+
+        profile = None
+        if self.cprofile_dir is not None and record['depth'] == 0:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record['seconds'] = time.time() - self.began - record['start']
+            self._update_peaks(rss())
+            with self._lock:
+                self._open.remove(record)
+            if profile is not None:
+                self._save_profile(record, profile)
+
+    def _save_profile(self, record, profile):
+        n_before = sum(1 for e in self.phases if e['name'] == record['name']) - 1
+        name = record['name'] if n_before == 0 else '%s.%d' % (record['name'], n_before + 1)
+        path = os.path.join(self.cprofile_dir, name + '.prof')
+        profile.dump_stats(path)
+        record['cprofile'] = path
+
+        stats = pstats.Stats(profile)
+        hot = sorted(stats.stats.items(), key=lambda x: -x[1][2])[:self.n_hot]
+        record['hot_functions'] = [{
+            'function': '%s:%d(%s)' % function,
+            'calls': calls,
+            'seconds': total,
+            'cumulative_seconds': cumulative,
+        } for (function, (_, calls, total, cumulative, _)) in hot]
+
+    def count(self, **counters):
+        """Record problem sizes and other counts for the current phase"""
+        with self._lock:
+            if len(self._open) > 0:
+                self._open[-1]['counters'].update(counters)
+
+    def solver(self, **stats):
+        """Record statistics of a solver run"""
+        with self._lock:
+            stats['phase'] = self._open[-1]['name'] if len(self._open) > 0 else None
+            self.solves.append(stats)
+
+    def report(self):
+        """Everything recorded, as a dict of JSON-compatible values
+
+        phases are in the order they started. counters collects every
+        phase's counters, the latest winning, and totals adds up the time of
+        phases run more than once.
+        """
+        phases = []
+        counters = {}
+        totals = {}
+        for record in self.phases:
+            record = dict(record)
+            record['peak_rss_mb'] = megabytes(record.pop('peak_rss') or None)
+            phases.append(record)
+            counters.update(record['counters'])
+            total = totals.setdefault(record['name'], {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += record['seconds'] or 0.0
+        return {
+            'command': sys.argv,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.began)),
+            'seconds': self.seconds if self.seconds is not None else time.time() - self.began,
+            'max_rss_mb': megabytes(max_rss()),
+            'phases': phases,
+            'totals': totals,
+            'counters': counters,
+            'solves': self.solves,
+        }
+
+    def save(self, f):
+        json.dump(self.report(), f, indent=2, default=str)
+
+    def summary(self):
+        """The outermost phases as a table, slowest first"""
+        lines = ['%-24s %6s %9s %12s' % ('Phase', 'Calls', 'Seconds', 'Peak RSS MB')]
+        peaks = {}
+        for record in self.phases:
+            if record['depth'] == 0:
+                peaks[record['name']] = max(peaks.get(record['name'], 0), record['peak_rss'])
+        totals = self.report()['totals']
+        for name in sorted(peaks, key=lambda x: -totals[x]['seconds']):
+            lines.append('%-24s %6d %9.3f %12s' % (
+                name, totals[name]['calls'], totals[name]['seconds'],
+                '%.1f' % (peaks[name] / 1e6,) if peaks[name] > 0 else ''))
+        return '\n'.join(lines)
+
+
+def phase(name):
+    """Context manager timing a phase of the running Profiler, if any"""
+    if _ACTIVE is None:
+        return contextlib.nullcontext()
+    return _ACTIVE.phase(name)
+
+
+def timed(function):
+    """Decorator running every call of a function as a phase named after it"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with phase(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def count(**counters):
+    """Record counts for the running Profiler's current phase, if any"""
+    if _ACTIVE is not None:
+        _ACTIVE.count(**counters)
+
+
+def solver(**stats):
+    """Record solver statistics with the running Profiler, if any"""
+    if _ACTIVE is not None:
+        _ACTIVE.solver(**stats)
@@ -3,18 +3,125 @@ Functions for scraping bricklink.com
 """
 import re
 import ast
-import urllib.error
+import collections
+import html.parser
+import itertools
+import multiprocessing
+import time
 import urllib.parse
-import urllib.request
-
-from bs4 import BeautifulSoup as BS
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from . import color
 from . import utils
 
 
-def price_guide(item, max_cost_quantile=None):
-    """Fetch pricing info for an item"""
+# tags that never have a closing tag
+VOID_TAGS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+
+class PriceGuideParser(html.parser.HTMLParser):
+    """Pull (store id, quantity, price) rows out of a price guide page
+
+    Works in a single pass without building a document tree. A row starts at
+    a <td> with a link to a store as a direct child; the next 2 cells of the
+    same table row hold the quantity available and the price. Cells of tables
+    nested inside those cells don't count, so rows match walking the
+    siblings of each store cell in a document tree.
+    """
+
+    def __init__(self):
+        html.parser.HTMLParser.__init__(self, convert_charrefs=True)
+        self.available = False
+        self._rows = []   # (# of the store cell, [store link, text, ...])
+        self._cells = []  # stack of open cells: [# open children, store link, first link, text, #]
+        self._open = {0: []}  # rows waiting for cells, by nesting depth
+        self._n_cells = 0
+
+    @property
+    def rows(self):
+        return [tuple(row) for (_, row) in sorted(self._rows, key=lambda r: r[0])
+                if len(row) == 3]
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'td':
+            self._cells.append([0, None, None, [], self._n_cells])
+            self._open.setdefault(len(self._cells), [])
+            self._n_cells += 1
+        elif tag == 'tr':
+            self._open[len(self._cells)] = []
+        elif len(self._cells) > 0:
+            cell = self._cells[-1]
+            if tag == 'a':
+                href = dict(attrs).get('href') or ''
+                if cell[2] is None:
+                    cell[2] = href
+                if cell[0] == 0 and cell[1] is None and '/store.asp' in href:
+                    cell[1] = href
+            if tag not in VOID_TAGS:
+                cell[0] += 1
+
+    def handle_endtag(self, tag):
+        if len(self._cells) == 0:
+            return
+        if tag != 'td':
+            if tag not in VOID_TAGS:
+                self._cells[-1][0] = max(0, self._cells[-1][0] - 1)
+            return
+
+        _, store_link, first_link, text, n = self._cells.pop()
+        self._open.pop(len(self._cells) + 1, None)
+        text = ''.join(text)
+        if len(self._cells) > 0:
+            self._cells[-1][3].append(text)
+
+        # cells after a store cell in the same row, then the store cell's own row
+        rows = self._open.setdefault(len(self._cells), [])
+        for row in rows:
+            row.append(text)
+        rows[:] = [row for row in rows if len(row) < 3]
+        if store_link is not None:
+            row = [first_link]
+            self._rows.append((n, row))
+            rows.append(row)
+
+    def handle_data(self, data):
+        if data == 'Currently Available':
+            self.available = True
+        if len(self._cells) > 0:
+            self._cells[-1][3].append(data)
+
+
+def parse_price_guide(html):
+    """Extract lots for sale from a price guide page (catalogPG.asp)
+
+    Returns
+    -------
+    rows : list of (store_id, quantity, cost_per_unit) or None
+        None if the item isn't currently available in this color
+    """
+    parser = PriceGuideParser()
+    parser.feed(html)
+    parser.close()
+    if not parser.available:
+        return None
+
+    return [(int(utils.get_params(store_link)['sID']),
+             int(quantity),
+             float(re.findall('[0-9.]+', price)[0]))
+            for (store_link, quantity, price) in parser.rows]
+
+
+def price_guide(item, max_cost_quantile=None, max_colors=None, max_color_distance=None,
+                limiter=None, cache=None, retries=0, timeout=30.0, parse=parse_price_guide):
+    """Fetch pricing info for an item
+
+    Lots in similar colors are fetched too, closest first, until there's
+    enough of the item. max_colors and max_color_distance limit which colors
+    are tried; see color.similar_to. limiter, cache, retries and timeout
+    are passed on to utils.fetch(). parse turns a page into rows; see
+    parse_price_guide.
+    """
     results = []
 
     if (item['ItemTypeID'] == 'P' and 'stk0' in item['ItemID']) or \
@@ -24,7 +131,7 @@ def price_guide(item, max_cost_quantile=None):
         color_ids = [0]
     else:
         # a normal item
-        color_ids = color.similar_to(item['ColorID'])
+        color_ids = color.similar_to(item['ColorID'], n=max_colors, max_distance=max_color_distance)
 
     for c in color_ids:
         # perform HTTP request
@@ -38,37 +145,24 @@ def price_guide(item, max_cost_quantile=None):
             'prDec': 2
         }
         url = "http://www.bricklink.com/catalogPG.asp?" + urllib.parse.urlencode(parameters)
-        html = urllib.request.urlopen(url).read()
+        html = utils.fetch(url, limiter=limiter, cache=cache, retries=retries, timeout=timeout)
 
         # parse page
-        page = BS(html)
+        rows = parse(html)
 
-        if len(page.find_all(text='Currently Available')) == 0:
+        if rows is None:
             # not available in this color :(
             continue
         else:
-
             # newly found inventory
-            new = []
-
-            for td in page.find_all('td'):
-                if td.find('a', recursive=False, href=re.compile('/store.asp')) is not None:
-                    # find the td element with a link to a store. Its siblings contain
-                    # the interesting bits like price and quantity available
-                    store_url = td.find('a')['href']
-                    store_id = int(utils.get_params(store_url)['sID'])
-                    quantity = int(td.next_sibling.text)
-                    cost_per_unit = float(re.findall('[0-9.]+',
-                                                     td.next_sibling.next_sibling.text)[0])
-
-                    new.append({
-                        'item_id': item['ItemID'],
-                        'wanted_color_id': item['ColorID'],
-                        'color_id': c,
-                        'store_id': store_id,
-                        'quantity_available': quantity,
-                        'cost_per_unit': cost_per_unit
-                    })
+            new = [{
+                'item_id': item['ItemID'],
+                'wanted_color_id': item['ColorID'],
+                'color_id': c,
+                'store_id': store_id,
+                'quantity_available': quantity,
+                'cost_per_unit': cost_per_unit
+            } for (store_id, quantity, cost_per_unit) in rows]
 
             # remove items that cost too much
             if max_cost_quantile is not None and max_cost_quantile < 1.0:
@@ -89,75 +183,229 @@ def price_guide(item, max_cost_quantile=None):
     return results
 
 
-def store_info(country=None):
-    """Fetch metadata for all stores"""
-    browse_page = utils.beautiful_soup('https://www.bricklink.com/browse.asp')
+def price_guides(items, n_workers=8, n_parsers=0, **kwargs):
+    """Fetch pricing info for many items concurrently
+
+    At most n_workers items are in flight at once. Results are yielded in the
+    same order as items. If n_parsers > 0, pages are parsed in that many
+    worker processes so parsing doesn't hold up fetching. Other keyword
+    arguments are passed on to price_guide().
+
+    Yields
+    ------
+    (item, lots, error) : tuple
+        lots is the output of price_guide(item), or None if fetching it raised
+        an exception, in which case error is that exception
+    """
+    def fetch(item):
+        try:
+            return (price_guide(item, **kwargs), None)
+        except Exception as e:
+            return (None, e)
+
+    if n_parsers > 0:
+        parsers = ProcessPoolExecutor(n_parsers, mp_context=multiprocessing.get_context('spawn'))
+        kwargs['parse'] = lambda html: parsers.submit(parse_price_guide, html).result()
+    else:
+        parsers = None
+
+    items = iter(items)
+    try:
+        with ThreadPoolExecutor(n_workers) as pool:
+            # keep a sliding window of in-flight items, oldest first
+            in_flight = collections.deque()
+            for item in itertools.islice(items, n_workers):
+                in_flight.append((item, pool.submit(fetch, item)))
+
+            while len(in_flight) > 0:
+                item, future = in_flight.popleft()
+                for next_item in itertools.islice(items, 1):
+                    in_flight.append((next_item, pool.submit(fetch, next_item)))
+                yield (item,) + future.result()
+    finally:
+        if parsers is not None:
+            parsers.shutdown()
+
+
+def store_links(country=None, n_workers=8, **kwargs):
+    """Find links to every store's page
+
+    Country pages are fetched concurrently. Other keyword arguments are passed
+    on to utils.fetch().
+
+    Returns
+    -------
+    links : list of str
+        relative URL of each store's page, in the order BrickLink lists them
+    """
+    browse_page = utils.beautiful_soup('https://www.bricklink.com/browse.asp', **kwargs)
     country_links = browse_page.find(
         'div', attrs={'class': 'column rightbuy'}).find_all(
         'a', attrs={'href': re.compile('countryID')})
 
-    result = []
+    # skip other countries if we're only gathering data on one country
+    country_urls = ['https://www.bricklink.com' + country_link['href'] for country_link in country_links
+                    if country is None or utils.get_params(country_link['href'])['countryID'] == country]
 
-    for country_link in country_links:
-        country_name = country_link.text
-        country_id = utils.get_params(country_link['href'])['countryID']
+    with ThreadPoolExecutor(n_workers) as pool:
+        country_pages = pool.map(lambda url: utils.beautiful_soup(url, **kwargs), country_urls)
+        return [store_link['href']
+                for country_page in country_pages
+                for store_link in country_page.find_all('a', href=re.compile('store.asp'))]
 
-        # skip this country link if we're only gathering data on one country
-        if country is not None and country_id != country:
-            continue
 
-        country_page = utils.beautiful_soup('https://www.bricklink.com' + country_link['href'])
-        store_links = country_page.find_all('a', href=re.compile('store.asp'))
-
-        for store_link in store_links:
-            store_page = utils.beautiful_soup('https://www.bricklink.com' + '/' + store_link['href'])
-            raw_params = [x.contents[0] for x in store_page.find_all('script') if
-                          (len(x.contents) > 0 and
-                           (re.search('StoreFront.store *=', x.contents[0]) is not None))][0]
-            store_params_str = re.search(
-                r'StoreFront\.store = {[\s\S]*?};', raw_params).group(0)[len('StoreFront.store = ')::]
-            store_params_str = re.sub('\t+\/\/.*\n', '', store_params_str)  # remove //comment lines
-            store_params_str = re.sub('\r\n\r\n', '\r\n', re.sub('\t+\r\n', '', store_params_str))  # remove empty lines
-            store_params_str = re.sub('\n\t+(.+?):',  # encase dict-like keys in parentheses
-                                      lambda match: match.group(0).replace(
-                                          match.group(1), '\'' + match.group(1) + '\''), store_params_str)
-            for old, new in [['false', 'False'], ['true', 'True']]:  # some literal replacements
-                store_params_str = store_params_str.replace(old, new)
+def store_page_info(store_page):
+    """Extract a store's metadata from its page, as parsed by Beautiful Soup"""
+    raw_params = [x.contents[0] for x in store_page.find_all('script') if
+                  (len(x.contents) > 0 and
+                   (re.search('StoreFront.store *=', x.contents[0]) is not None))][0]
+    store_params_str = re.search(
+        r'StoreFront\.store = {[\s\S]*?};', raw_params).group(0)[len('StoreFront.store = ')::]
+    store_params_str = re.sub('\t+\/\/.*\n', '', store_params_str)  # remove //comment lines
+    store_params_str = re.sub('\r\n\r\n', '\r\n', re.sub('\t+\r\n', '', store_params_str))  # remove empty lines
+    store_params_str = re.sub('\n\t+(.+?):',  # encase dict-like keys in parentheses
+                              lambda match: match.group(0).replace(
+                                  match.group(1), '\'' + match.group(1) + '\''), store_params_str)
+    for old, new in [['false', 'False'], ['true', 'True']]:  # some literal replacements
+        store_params_str = store_params_str.replace(old, new)
+    try:
+        store_params = ast.literal_eval(store_params_str[:-1])  # evaluate modified string to python dict
+    except:
+        print(store_params_str)
+        raise
+
+    min_buy_str = store_params['minBuy']
+    if min_buy_str != '':
+        currency_patterns = [  # basic list of currencies to match in minimum buy string, far from exhaustive
+            (r"US \$([0-9.]+)", 1),  # includes estimated conversion to USD
+            (r"US \$([0-9.]+)", 1.24),
+            (r"EUR ([0-9.]+)", 1.08),
+        ]  # TODO add currency conversion / interpretation
+        min_buy = None  # min_buy stays at None if currency was not found
+        for re_pattern, conv_factor in currency_patterns:
+            min_buy_match = re.search(re_pattern, min_buy_str)
+            if min_buy_match is not None:
+                min_buy = float(min_buy_match.group(1)) * conv_factor
+    else:
+        min_buy = 0.0
+
+    return {
+        'store_name': store_params['name'],
+        'store_id': int(store_params['id']),
+        'country_name': store_params['countryName'],
+        'country_id': store_params['countryID'],
+        'seller_name': store_params['username'],
+        'feedback': int(store_params['feedbackScore']),
+        'minimum_buy': min_buy,
+        'ships': store_params['shipsToBuyer']
+    }
+
+
+def iter_store_info(links, n_workers=8, **kwargs):
+    """Fetch metadata for many stores concurrently
+
+    Stores whose page can't be fetched or understood are reported and
+    skipped. Other keyword arguments are passed on to utils.fetch().
+
+    Yields
+    ------
+    (link, entry) : tuple
+        link to a store's page and its metadata, as soon as it's fetched
+    """
+    def fetch(link):
+        store_page = utils.beautiful_soup('https://www.bricklink.com' + '/' + link, **kwargs)
+        return store_page_info(store_page)
+
+    with ThreadPoolExecutor(n_workers) as pool:
+        futures = dict((pool.submit(fetch, link), link) for link in links)
+        for future in as_completed(futures):
+            link = futures[future]
             try:
-                store_params = ast.literal_eval(store_params_str[:-1])  # evaluate modified string to python dict
-            except:
-                print(store_params_str)
-                raise
-
-            min_buy_str = store_params['minBuy']
-            if min_buy_str is not '':
-                currency_patterns = [  # basic list of currencies to match in minimum buy string, far from exhaustive
-                    (r"US \$([0-9.]+)", 1),  # includes estimated conversion to USD
-                    (r"US \$([0-9.]+)", 1.24),
-                    (r"EUR ([0-9.]+)", 1.08),
-                ]  # TODO add currency conversion / interpretation
-                min_buy = None  # min_buy stays at None if currency was not found
-                for re_pattern, conv_factor in currency_patterns:
-                    min_buy_match = re.search(re_pattern, min_buy_str)
-                    if min_buy_match is not None:
-                        min_buy = float(min_buy_match.group(1)) * conv_factor
-            else:
-                min_buy = 0.0
-
-            entry = {
-                'store_name': store_params['name'],
-                'store_id': int(store_params['id']),
-                'country_name': store_params['countryName'],
-                'country_id': store_params['countryID'],
-                'seller_name': store_params['username'],
-                'feedback': int(store_params['feedbackScore']),
-                'minimum_buy': min_buy,
-                'ships': store_params['shipsToBuyer']
-            }
-            print(entry)
-
-            result.append(entry)
+                yield (link, future.result())
+            except Exception as e:
+                print('Failed to get metadata for %s: %s' % (link, e))
+
+
+def stores_to_refresh(previous, links, max_age, now=None):
+    """Decide which stores need to be fetched again
+
+    Parameters
+    ----------
+    previous : list of dict
+        store metadata from an earlier crawl. Stores without a 'link' or
+        'last_checked' are always fetched again.
+    links : list of str
+        links to the stores BrickLink lists now
+    max_age : float
+        fetch stores again if they were last checked more than this many
+        seconds ago
 
+    Returns
+    -------
+    to_fetch : list of str
+        links of stores that are new or stale, in the order of links
+    kept : dict
+        maps link to metadata for stores that are still fresh
+    """
+    if now is None:
+        now = time.time()
+    by_link = dict((e['link'], e) for e in previous if 'link' in e and 'last_checked' in e)
+
+    to_fetch = []
+    kept = {}
+    for link in links:
+        if link in by_link and now - by_link[link]['last_checked'] <= max_age:
+            kept[link] = by_link[link]
+        else:
+            to_fetch.append(link)
+    return (to_fetch, kept)
+
+
+# fields that say nothing about the store itself
+BOOKKEEPING = set(['link', 'last_checked'])
+
+
+def store_changes(old, new):
+    """What changed between two store lists
+
+    Returns
+    -------
+    changes : dict
+        'added' and 'removed' are lists of store metadata. 'changed' lists the
+        stores whose metadata differs, with the old and new value of every
+        field that changed.
+    """
+    old_by_id = dict((e['store_id'], e) for e in old)
+    new_by_id = dict((e['store_id'], e) for e in new)
+
+    changed = []
+    for (store_id, entry) in new_by_id.items():
+        if store_id not in old_by_id:
+            continue
+        previous = old_by_id[store_id]
+        fields = sorted(k for k in set(entry) | set(previous)
+                        if k not in BOOKKEEPING and entry.get(k) != previous.get(k))
+        if len(fields) > 0:
+            changed.append({
+                'store_id': store_id,
+                'seller_name': entry['seller_name'],
+                'changes': dict((k, [previous.get(k), entry.get(k)]) for k in fields)
+            })
+
+    return {
+        'added': [e for e in new if e['store_id'] not in old_by_id],
+        'removed': [e for e in old if e['store_id'] not in new_by_id],
+        'changed': changed,
+    }
+
+
+def store_info(country=None, n_workers=8, **kwargs):
+    """Fetch metadata for all stores"""
+    links = store_links(country=country, n_workers=n_workers, **kwargs)
+    result = []
+    for (link, entry) in iter_store_info(links, n_workers=n_workers, **kwargs):
+        print(entry)
+        result.append(entry)
     return result
 
 
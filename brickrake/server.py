@@ -0,0 +1,144 @@
+"""
+Local HTTP service that answers requests from data kept in memory
+"""
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import traceback
+
+
+def stamp(path):
+    """Modification time and size of a file, or of every file in a folder,
+    to tell when it has changed"""
+    if os.path.isdir(path):
+        return tuple(sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size) for e in os.scandir(path)))
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class DataFiles(object):
+    """Data loaded from files, reloaded when any of them changes
+
+    If reloading fails, for example because a file is half written, the
+    data loaded last is kept and reloading is tried again next time.
+
+    Parameters
+    ----------
+    paths : list of str
+        files or folders the data is loaded from. None entries are ignored.
+    load : function
+        called without arguments to load the data
+    """
+
+    def __init__(self, paths, load):
+        self.paths = [p for p in paths if p is not None]
+        self.load = load
+        self.data = None
+        self.stamps = None
+        self.loaded_at = None
+        self.n_loads = 0
+        self._lock = threading.Lock()
+        self.get()
+
+    def get(self):
+        """The data, reloaded first if a file changed since it was loaded"""
+        with self._lock:
+            stamps = [stamp(p) for p in self.paths]
+            if stamps != self.stamps:
+                try:
+                    data = self.load()
+                except Exception:
+                    if self.data is None:
+                        raise
+                    traceback.print_exc()
+                    print('Failed to reload data, keeping what was loaded at %s' % (time.ctime(self.loaded_at),))
+                else:
+                    self.data = data
+                    self.stamps = stamps
+                    self.loaded_at = time.time()
+                    self.n_loads += 1
+            return self.data
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Calls the server's route for a path with the request's JSON body
+    (None for GET) and replies with what it returns, as JSON. Routes raise
+    ValueError for bad requests."""
+
+    def do_GET(self):
+        self._reply(None)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self._send(400, {'error': 'Request body is not JSON: %s' % (e,)})
+            return
+        self._reply(body)
+
+    def _reply(self, body):
+        route = self.server.routes.get((self.command, self.path))
+        if route is None:
+            self._send(404, {'error': 'No such path: %s %s' % (self.command, self.path)})
+            return
+        try:
+            self._send(200, route(body))
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            traceback.print_exc()
+            self._send(500, {'error': repr(e)})
+
+    def _send(self, code, response):
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """HTTP over a Unix socket, which replaces any stale socket file"""
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(routes, host='127.0.0.1', port=8000, socket_path=None):
+    """Create a server answering one request at a time. Call its
+    serve_forever() method to start it.
+
+    Parameters
+    ----------
+    routes : dict
+        maps (method, path) to a function taking the request's JSON body and
+        returning the JSON response, e.g. ('POST', '/minimize')
+    host, port : str, int
+        address to listen on. Port 0 picks a free port.
+    socket_path : str or None
+        listen on this Unix socket instead of host and port
+    """
+    if socket_path is not None:
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = http.server.HTTPServer((host, port), Handler)
+    server.routes = routes
+    return server
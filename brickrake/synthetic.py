@@ -0,0 +1,138 @@
+"""
+Seeded synthetic parts lists, price guides and store lists shaped like
+BrickLink's, for benchmarks and tests
+"""
+import random
+
+from . import color
+
+# (country name, country id), most stores first
+COUNTRIES = [
+    ('USA', 'US'),
+    ('Germany', 'DE'),
+    ('United Kingdom', 'UK'),
+    ('Canada', 'CA'),
+    ('Netherlands', 'NL'),
+    ('France', 'FR'),
+    ('Australia', 'AU'),
+    ('Japan', 'JP'),
+]
+
+
+def parts_list(n_items, seed=0):
+    """A wanted list of n_items different parts in real colors. Most parts
+    are wanted a few at a time and a few in bulk."""
+    r = random.Random(seed)
+    colors = sorted(color.COLORS)
+    keys = set()
+    while len(keys) < n_items:
+        keys.add((str(3000 + r.randrange(10 * n_items)), r.choice(colors)))
+
+    return [{
+        'ItemID': item_id,
+        'ItemTypeID': 'P',
+        'ColorID': color_id,
+        'Qty': min(int(r.paretovariate(1.0) * 4), 500),
+        'ItemName': item_id,
+        'ColorName': color.name(color_id),
+    } for (item_id, color_id) in sorted(keys)]
+
+
+def price_guide(wanted_parts, n_stores, seed=0, alpha=1.2, substitution=0.2):
+    """Lots for sale of every wanted part
+
+    Store sizes follow a power law: most stores have a few of the wanted
+    parts and a few have most of them. Popular parts are in more stores.
+    Every part is sold by enough stores in total that the list can be
+    bought.
+
+    Parameters
+    ----------
+    wanted_parts : list of dict
+        wanted lots
+    n_stores : int
+        number of stores, with ids 0 to n_stores - 1
+    alpha : float
+        power law exponent of store sizes. Smaller means more big stores.
+    substitution : float
+        fraction of lots in a similar color instead of the wanted one
+    """
+    r = random.Random(seed)
+    n_items = len(wanted_parts)
+
+    # how common and how expensive each part is
+    popularity = [1.0 / (rank + 1) ** 0.8 for rank in r.sample(range(n_items), n_items)]
+    base_price = [r.lognormvariate(-2.5, 1.0) for _ in range(n_items)]
+
+    def lot(i, store_id, markup):
+        item = wanted_parts[i]
+        color_id = item['ColorID']
+        if r.random() < substitution:
+            color_id = r.choice(color.similar_to(color_id, n=4)[1:])
+        return {
+            'item_id': item['ItemID'],
+            'wanted_color_id': item['ColorID'],
+            'color_id': color_id,
+            'store_id': store_id,
+            'quantity_available': max(1, int(r.paretovariate(1.0) * max(5, item['Qty'] / 4.0))),
+            'cost_per_unit': max(round(base_price[i] * markup * r.lognormvariate(0, 0.2), 3), 0.001),
+        }
+
+    result = []
+    markups = [r.lognormvariate(0, 0.3) for _ in range(n_stores)]
+    for store_id in range(n_stores):
+        n_stocked = min(n_items, int(r.paretovariate(alpha) * (1 + n_items / 20.0)))
+
+        # weighted sampling without replacement
+        stocked = sorted(range(n_items), key=lambda i: -r.random() ** (1.0 / popularity[i]))[:n_stocked]
+        for i in stocked:
+            for _ in range(r.choice([1, 1, 1, 2, 3])):
+                result.append(lot(i, store_id, markups[store_id]))
+
+    # make sure every part can be bought
+    available = [0] * n_items
+    index = dict(((e['ItemID'], e['ColorID']), i) for (i, e) in enumerate(wanted_parts))
+    for e in result:
+        available[index[(e['item_id'], e['wanted_color_id'])]] += e['quantity_available']
+    for (i, item) in enumerate(wanted_parts):
+        while available[i] < item['Qty']:
+            store_id = r.randrange(n_stores)
+            result.append(lot(i, store_id, markups[store_id]))
+            available[i] += result[-1]['quantity_available']
+    return result
+
+
+def store_list(store_ids, seed=0, min_buy_fraction=0.3):
+    """Metadata for stores, a fraction of which have a minimum purchase"""
+    r = random.Random(seed)
+    result = []
+    for store_id in store_ids:
+        country_name, country_id = COUNTRIES[min(int(r.expovariate(0.6)), len(COUNTRIES) - 1)]
+        if r.random() < 0.6:
+            ships = ['All Countries WorldWide']
+        else:
+            ships = sorted(set([country_name] + [c[0] for c in r.sample(COUNTRIES, r.randint(0, 4))]))
+        result.append({
+            'store_id': store_id,
+            'store_name': 'Store %s' % (store_id,),
+            'seller_name': 'seller%s' % (store_id,),
+            'country_name': country_name,
+            'country_id': country_id,
+            'feedback': int(r.paretovariate(0.8) * 10) - 10,
+            'minimum_buy': float(r.choice([5, 10, 15, 20, 25])) if r.random() < min_buy_fraction else 0.0,
+            'ships': ships,
+        })
+    return result
+
+
+def workload(n_items, n_stores, seed=0):
+    """A wanted list, a price guide for it and metadata of every store in it
+
+    Returns
+    -------
+    (wanted_parts, price_guide, stores) : tuple
+    """
+    wanted_parts = parts_list(n_items, seed)
+    lots = price_guide(wanted_parts, n_stores, seed)
+    stores = store_list(sorted(set(e['store_id'] for e in lots)), seed)
+    return (wanted_parts, lots, stores)
@@ -0,0 +1,73 @@
+"""
+Tests for brickrake.cache
+"""
+import os
+import time
+
+from brickrake.cache import *
+
+URL = 'http://www.bricklink.com/catalogPG.asp?itemType=P&itemNo=3001&colorId=5'
+
+
+def test_normalize():
+    assert normalize(URL) == normalize('https://WWW.bricklink.com/catalogPG.asp?colorId=5&itemNo=3001&itemType=P')
+    assert normalize(URL) != normalize(URL.replace('colorId=5', 'colorId=6'))
+    assert kind(URL) == 'price_guide'
+    assert kind('https://www.bricklink.com/store.asp?p=someone') == 'store'
+
+
+def test_get_put(tmp_path):
+    cache = PageCache(str(tmp_path))
+    assert cache.get(URL) is None
+    cache.put(URL, '<html>3001</html>')
+    assert cache.get(URL) == '<html>3001</html>'
+
+    # stale pages are only served offline
+    path = cache.path(URL)
+    old = time.time() - TTL['price_guide'] - 1
+    os.utime(path, (old, old))
+    assert cache.get(URL) is None
+    assert PageCache(str(tmp_path), offline=True).get(URL) == '<html>3001</html>'
+
+
+def test_offline_miss(tmp_path):
+    cache = PageCache(str(tmp_path), offline=True)
+    try:
+        cache.get(URL)
+        assert False
+    except OfflineError:
+        pass
+
+
+def test_evict(tmp_path):
+    cache = PageCache(str(tmp_path), max_bytes=250)
+    for i in range(5):
+        url = URL + '&i=%d' % i
+        cache.put(url, 100 * 'x')
+        os.utime(cache.path(url), (i, time.time()))
+
+    # only the 2 most recently used pages fit
+    assert [cache.get(URL + '&i=%d' % i) is not None for i in range(5)] == [False, False, False, True, True]
+
+
+def test_evict_low_water(tmp_path, monkeypatch):
+    cache = PageCache(str(tmp_path), max_bytes=1000, low_water=0.5)
+    urls = [URL + '&i=%d' % i for i in range(11)]
+    for url in urls[:10]:
+        cache.put(url, 100 * 'x')
+    cache.get(urls[0])
+
+    # evicting goes by what the cache recorded, without walking the folder,
+    # and makes room for more than one page
+    def walk(*args):
+        raise AssertionError('walked the cache folder')
+    monkeypatch.setattr(os, 'walk', walk)
+    cache.put(urls[10], 100 * 'x')
+    monkeypatch.undo()
+    kept = [i for (i, url) in enumerate(urls) if os.path.exists(cache.path(url))]
+    assert kept == [0, 7, 8, 9, 10]
+
+    # reopening the cache picks up when pages were last read
+    cache = PageCache(str(tmp_path), max_bytes=400, low_water=1.0)
+    cache.put(URL, 100 * 'x')
+    assert [i for (i, url) in enumerate(urls) if os.path.exists(cache.path(url))] == [0, 9, 10]
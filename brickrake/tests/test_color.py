@@ -0,0 +1,59 @@
+"""
+Tests for brickrake.color
+"""
+import io
+import os
+
+import numpy as np
+import pytest
+
+from brickrake.color import *
+
+
+def test_delta_e_cie2000():
+    color_diff_matrix = pytest.importorskip('colormath.color_diff_matrix')
+    labs = np.array([COLORS[k]['lab'] for k in sorted(COLORS)])
+    distances = delta_e_cie2000(labs, labs)
+    for (j, lab) in enumerate(labs):
+        expected = [color_diff_matrix.delta_e_cie2000(lab2, np.array([lab]))[0] for lab2 in labs]
+        assert np.allclose(distances[:, j], expected)
+
+
+def test_similarity_table():
+    # the shipped table is up to date
+    table = similarity_table()
+    for (color_id, ranking) in table.items():
+        assert similar_to(color_id) == [e[0] for e in ranking]
+
+
+def test_load_similarity_table():
+    # the shipped table was made from the current colors
+    with open(os.path.join(DATA, 'similar_colors.json')) as f:
+        table = load_similarity_table(f, key=colors_key())
+    assert table == load_similarity_table(open(os.path.join(DATA, 'similar_colors.json')))
+
+    # changing a color's Lab value, but not the set of ids, makes it stale
+    colors = dict(COLORS)
+    colors[5] = dict(colors[5], lab=[x + 1.0 for x in colors[5]['lab']])
+    assert set(colors) == set(COLORS)
+    assert colors_key(colors) != colors_key()
+
+    f = io.StringIO()
+    save_similarity_table(f, similarity_table(colors), key=colors_key(colors))
+    f.seek(0)
+    with pytest.raises(ValueError):
+        load_similarity_table(f, key=colors_key())
+    f.seek(0)
+    assert load_similarity_table(f, key=colors_key(colors)) == load_similarity_table(io.StringIO(f.getvalue()))
+
+
+def test_similar_to():
+    assert similar_to(5)[0] == 5
+    assert similar_to(0) == similar_to(9)
+    assert len(similar_to(5)) == len(COLORS)
+    assert similar_to(5, n=3) == similar_to(5)[:3]
+
+    nearby = similar_to(5, max_distance=10.0)
+    assert 0 < len(nearby) < len(COLORS)
+    assert all(distance(COLORS[c]['lab'], COLORS[5]['lab']) <= 10.0 for c in nearby)
+    assert similar_to(5, n=1, max_distance=10.0) == [5]
@@ -0,0 +1,103 @@
+"""
+Tests for brickrake.ilp
+"""
+import numpy as np
+import pytest
+
+from brickrake.ilp import *
+from brickrake.minimizer import integer_program, is_valid_solution
+from brickrake.synthetic import workload
+from brickrake.tests.test_minimizer import WANTED_PARTS, JUST_RIGHT
+
+STORES = [
+    {'store_id': 'one', 'minimum_buy': 0.0},
+    {'store_id': 'two', 'minimum_buy': 5.0},
+]
+
+
+def test_build():
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES, shipping_cost=10.0)
+    assert model.store_ids == ['one', 'two']
+    assert model.n_variables == 4 + 2
+    assert model.n_constraints == 4 + 3 + 2
+    assert model.objective.tolist() == [0.05, 0.10, 0.25, 0.20, 10.0, 10.0]
+    # store two has a minimum purchase, so its lots must be bought whole
+    assert model.integrality.tolist() == [0, 0, 1, 0, 1, 1]
+
+    A = model.matrix().toarray()
+    # lot 3 can only be bought if store one is used
+    assert A[3].tolist() == [0, 0, 0, 1, -10, 0]
+    # wanted lot 1 can come from lots 1 and 2
+    assert A[4 + 1].tolist() == [0, 1, 1, 0, 0, 0]
+    assert model.constraint_lower[4 + 1] == 50
+    # store two's minimum purchase
+    assert A[4 + 3 + 1].tolist() == [0, 0, 0.25, 0, 0, -5.0]
+
+    assert model.variable_names == []
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES, names=True)
+    assert model.variable_names[-1] == 'use-store=two'
+    assert model.constraint_names[4] == 'wantedamount-item=123-color=1'
+
+
+def test_lot_bounds():
+    # nothing beyond what's wanted is worth buying from store one, or beyond
+    # what's wanted plus its minimum purchase once it has one
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES)
+    assert model.upper[:4].tolist() == [100, 30, 25, 10]
+    stores = [dict(STORES[0], minimum_buy=0.5), STORES[1]]
+    model = build(WANTED_PARTS, JUST_RIGHT, stores)
+    assert model.upper[:4].tolist() == [100 + 10, 30, 25, 10]
+    assert model.integrality.tolist() == [1, 1, 1, 1, 1, 1]
+
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES, integral_lots=False)
+    assert model.integrality.tolist() == [0, 0, 0, 0, 1, 1]
+    # fractional quantities are rounded up, so the purchase still covers
+    # everything it did
+    purchase = solution(model, [100, 29.9999, 20.4, 10, 1, 1], verbose=False)
+    assert [e['quantity'] for e in purchase['allocation']] == [100, 30, 21, 10]
+
+
+def test_highs():
+    pytest.importorskip('scipy')
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES)
+    solution = solve(model, 'highs', gap=0.0)
+    assert is_valid_solution(WANTED_PARTS, solution['allocation'], STORES)
+    assert sorted(solution['store_ids']) == ['one', 'two']
+    assert np.isclose(solution['cost'], 100 * 0.05 + 30 * 0.10 + 20 * 0.25 + 10 * 0.20)
+
+    # store two's minimum purchase can't be met
+    stores = [STORES[0], dict(STORES[1], minimum_buy=100.0)]
+    assert solve(build(WANTED_PARTS, JUST_RIGHT, stores), 'highs') is None
+
+
+def test_empty():
+    # nothing left to buy from, e.g. after presolve
+    assert solve(build([], [])) == {'cost': 0, 'allocation': [], 'store_ids': []}
+    assert solve(build(WANTED_PARTS, [])) is None
+
+
+def test_start():
+    pytest.importorskip('scipy')
+    model = build(WANTED_PARTS, JUST_RIGHT, STORES)
+    solution = solve(model, 'highs', gap=0.0)
+    x = from_allocation(model, solution['allocation'])
+    assert model.is_feasible(x)
+    assert np.isclose(np.dot(model.objective, x), solution['cost'] + 2 * 10.0)
+
+    # the start is reported before the solver runs
+    incumbents = []
+    assert solve(model, 'highs', start=x, on_incumbent=incumbents.append) == solution
+    assert incumbents == [solution]
+
+    x[0] -= 1
+    assert not model.is_feasible(x)
+
+
+def test_minimum_buy_rounding():
+    pytest.importorskip('scipy')
+    # the store chosen here has a $20 minimum purchase, which its lots add up
+    # to only up to rounding
+    wanted_parts, price_guide, stores = workload(10, 25, seed=14)
+    for gap in [0.01, 0.0]:
+        solution = integer_program(wanted_parts, price_guide, stores, gap=gap)[0]
+        assert is_valid_solution(wanted_parts, solution['allocation'], stores)
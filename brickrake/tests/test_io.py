@@ -0,0 +1,108 @@
+"""
+Tests for brickrake.io
+"""
+import pickle
+
+import pytest
+
+from brickrake.io import *
+from brickrake.minimizer import integer_program, is_valid_solution, presolve
+from brickrake.synthetic import workload
+from brickrake.tests.test_minimizer import JUST_RIGHT, NOT_ENOUGH_INVENTORY
+
+
+def test_price_guide_columns(tmp_path):
+    path = str(tmp_path / 'price_guide')
+    save_price_guide_columns(path, JUST_RIGHT)
+    assert is_price_guide_columns(path)
+    assert not is_price_guide_columns(str(tmp_path))
+
+    columns = load_price_guide_columns(path)
+    assert len(columns) == len(JUST_RIGHT)
+    assert columns.to_records() == JUST_RIGHT
+    assert sorted(columns.store_ids()) == ['one', 'two']
+    assert columns.select(['two']).to_records() == [e for e in JUST_RIGHT if e['store_id'] == 'two']
+    assert PriceGuideColumns.from_records(NOT_ENOUGH_INVENTORY).to_records() == NOT_ENOUGH_INVENTORY
+
+
+def test_price_guide_journal(tmp_path):
+    path = str(tmp_path / 'price_guide.json.journal')
+    journal = PriceGuideJournal(open(path, 'a'), sync_every=2)
+    journal.append('123', 1, JUST_RIGHT[0:1])
+    journal.append('123', 2, JUST_RIGHT[1:3])
+    journal.close()
+
+    # a crash left half a line behind
+    with open(path, 'a') as f:
+        f.write('{"item_id": "456", "wanted_co')
+
+    assert sorted(load_price_guide_journal(open(path)).keys()) == [('123', 1), ('123', 2)]
+    assert compact_price_guide_journal(open(path)) == JUST_RIGHT[0:3]
+
+    # appending again doesn't get mixed up with the truncated line
+    journal = PriceGuideJournal(open(path, 'a'))
+    journal.append('456', 80, JUST_RIGHT[3:4])
+    journal.close()
+    assert compact_price_guide_journal(open(path)) == JUST_RIGHT
+
+
+def test_store_table():
+    stores = StoreTable([
+        {'store_id': 1, 'country_name': 'USA', 'feedback': 10, 'ships': ['USA', 'Canada']},
+        {'store_id': 2, 'country_name': 'Germany', 'feedback': 500, 'ships': ['All Countries WorldWide']},
+        {'store_id': 3, 'country_name': 'USA', 'feedback': 0, 'ships': ['USA']},
+        {'store_id': 4, 'country_name': 'Canada', 'feedback': 50, 'ships': []},
+    ])
+    assert len(stores) == 4
+    assert stores.ids() == set([1, 2, 3, 4])
+    assert stores.ids(source_country='USA') == set([1, 3])
+    assert stores.ids(source_country='Mars') == set()
+    assert stores.ids(target_country='Canada') == set([1, 2])
+    assert stores.ids(feedback=10) == set([1, 2, 4])
+    assert stores.ids(feedback=0) == set([1, 2, 3, 4])
+    assert stores.ids(exclude=[2, 3]) == set([1, 4])
+    assert stores.filter(target_country='USA', feedback=10, exclude=[2]) == [stores.metadata[0]]
+
+
+def test_lot(tmp_path):
+    lot = Lot.from_dict(JUST_RIGHT[0])
+    assert lot == JUST_RIGHT[0] and JUST_RIGHT[0] == lot
+    assert dict(lot) == JUST_RIGHT[0]
+    assert lot['cost_per_unit'] == 0.05
+    lot['quantity_available'] = 1
+    assert lot != JUST_RIGHT[0]
+    for key in ['quantity', 'keys', 'from_dict', 'extra', '__class__']:
+        assert key not in lot
+        with pytest.raises(KeyError):
+            lot[key]
+        assert lot.get(key) is None
+
+    # other fields are kept too
+    extra = Lot.from_dict(dict(JUST_RIGHT[0], quantity=1))
+    assert isinstance(extra, Lot)
+    assert extra == dict(JUST_RIGHT[0], quantity=1) and extra['quantity'] == 1 and len(extra) == 7
+    assert pickle.loads(pickle.dumps(extra)) == extra
+    lot['wanted_list_id'] = 'a'
+    assert lot['wanted_list_id'] == 'a' and 'wanted_list_id' in lot
+
+    path = str(tmp_path / 'price_guide.json')
+    save_price_guide(open(path, 'w'), [lot, extra] + JUST_RIGHT[1:])
+    price_guide = load_price_guide(open(path))
+    assert all(isinstance(e, Lot) for e in price_guide)
+    assert price_guide == [lot, extra] + JUST_RIGHT[1:]
+    # lots of the same item share its id
+    assert price_guide[0]['item_id'] is price_guide[2]['item_id']
+
+
+def test_unknown_minimum_buy(tmp_path):
+    wanted_parts, price_guide, stores = workload(10, 15)
+    stores[0]['minimum_buy'] = None
+
+    path = str(tmp_path / 'stores.json')
+    save_store_metadata(open(path, 'w'), stores)
+    stores = load_store_metadata(open(path))
+    assert stores[0]['minimum_buy'] == 0.0
+
+    lots, stats = presolve(wanted_parts, price_guide, stores)
+    solution = integer_program(wanted_parts, lots, stores)[0]
+    assert is_valid_solution(wanted_parts, solution['allocation'], stores)
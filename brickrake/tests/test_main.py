@@ -0,0 +1,110 @@
+"""
+Tests for the commands in main.py
+"""
+import argparse
+import multiprocessing
+import os
+
+import pytest
+
+import main
+from brickrake import color
+from brickrake import io
+from brickrake import minimizer
+from brickrake import synthetic
+from brickrake.tests.test_scraper import PAGES, fake_bricklink, store_page
+
+
+def test_store_list_resume(tmp_path, monkeypatch):
+    requested = fake_bricklink(monkeypatch)
+    output = str(tmp_path / 'stores.json')
+    args = argparse.Namespace(max_requests_per_second=None, no_cache=True, offline=False, retries=0, timeout=1.0,
+                              country=None, n_workers=1, previous=None, changelog=None, output=output)
+
+    # store c's page can't be understood, so the partial list is kept
+    main.store_list(args)
+    assert [e['seller_name'] for e in io.load_store_metadata(open(output))] == ['a', 'b']
+    assert os.path.exists(output + '.partial')
+
+    # running again only fetches store c
+    monkeypatch.setitem(PAGES, 'https://www.bricklink.com/store.asp?p=c', store_page(3, 'c'))
+    del requested[:]
+    main.store_list(args)
+    assert [url for url in requested if 'store.asp' in url] == ['https://www.bricklink.com/store.asp?p=c']
+    assert [e['seller_name'] for e in io.load_store_metadata(open(output))] == ['a', 'b', 'c']
+    assert not os.path.exists(output + '.partial')
+
+    # offline without a cache would have nothing to read
+    args.offline = True
+    del requested[:]
+    with pytest.raises(SystemExit):
+        main.store_list(args)
+    assert requested == []
+
+
+def save_parts_list(path, wanted_parts):
+    with open(path, 'w') as f:
+        f.write('<INVENTORY>\n')
+        for e in wanted_parts:
+            f.write('<ITEM><ITEMTYPE>P</ITEMTYPE><ITEMID>%s</ITEMID><COLOR>%d</COLOR><MINQTY>%d</MINQTY></ITEM>\n'
+                    % (e['ItemID'], e['ColorID'], e['Qty']))
+        f.write('</INVENTORY>\n')
+
+
+def test_batch(tmp_path, capsys, monkeypatch, request):
+    # two parts lists bought from the same stores
+    lists = [synthetic.parts_list(10, seed=1), synthetic.parts_list(15, seed=2)]
+    lots = synthetic.price_guide(lists[0] + lists[1], 30, seed=1)
+    stores = synthetic.store_list(sorted(set(e['store_id'] for e in lots)), seed=1)
+    paths = []
+    for (i, wanted_parts) in enumerate(lists):
+        paths.append(str(tmp_path / ('list%d.xml' % (i,))))
+        save_parts_list(paths[-1], wanted_parts)
+    io.save_price_guide(open(str(tmp_path / 'price_guide.json'), 'w'), lots)
+    io.save_store_metadata(open(str(tmp_path / 'stores.json'), 'w'), stores)
+
+    # workers share the price guide the batch loaded, without pickling it,
+    # whatever the default way of starting processes is
+    def unpicklable(*args):
+        raise AssertionError('the price guide was pickled')
+    if 'fork' in multiprocessing.get_all_start_methods():
+        monkeypatch.setattr(minimizer.PriceGuide, '__reduce_ex__', unpicklable, raising=False)
+        start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method('spawn', force=True)
+        request.addfinalizer(lambda: multiprocessing.set_start_method(start_method, force=True))
+
+    # greedy only computes a bound when asked for one
+    for (n_workers, bound) in [(1, None), (2, 'lagrangian')]:
+        output = str(tmp_path / ('output%d' % (n_workers,)))
+        args = argparse.Namespace(price_guide=str(tmp_path / 'price_guide.json'),
+                                  store_list=str(tmp_path / 'stores.json'), source_country=None,
+                                  target_country=None, feedback=None, exclude=None, parts_lists=paths,
+                                  output=output, n_workers=n_workers, algorithm='greedy', max_n_stores=5,
+                                  n_jobs=1, shipping_cost=10.0, mip_gap=0.01, bound=bound,
+                                  time_limit=None, no_warm_start=False, threads=None, no_presolve=False,
+                                  top_k_lots=None)
+        main.batch(args)
+
+        out = capsys.readouterr().out
+        assert 'Minimized 2 of 2 parts lists' in out
+        for (i, wanted_parts) in enumerate(lists):
+            name = 'list%d' % (i,)
+            solution = io.load_solution(open(os.path.join(output, name + '.json')))
+            bought = set((e['item_id'], e['wanted_color_id']) for e in solution['allocation'])
+            assert bought == set((e['ItemID'], e['ColorID']) for e in wanted_parts)
+            log = open(os.path.join(output, name + '.log')).read()
+            assert 'Loaded %d different parts' % (len(wanted_parts),) in log
+            assert ('Lower bound' in log) == (bound is not None)
+            assert any(line.startswith(name + ' ') for line in out.splitlines())
+
+
+def test_color_table(tmp_path):
+    # the table goes where it's asked to, not into the package
+    shipped = open(os.path.join(color.DATA, 'similar_colors.json')).read()
+    output = tmp_path / 'cache' / 'similar_colors.json'
+    main.color_table(argparse.Namespace(output=str(output)))
+    with open(output) as f:
+        table = color.load_similarity_table(f, key=color.colors_key())
+    expected = color.similarity_table()
+    assert [[c for (c, d) in table[k]] for k in table] == [[c for (c, d) in expected[k]] for k in expected]
+    assert open(os.path.join(color.DATA, 'similar_colors.json')).read() == shipped
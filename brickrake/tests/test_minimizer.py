@@ -1,8 +1,11 @@
 """
 Tests for brickrake.minimizer
 """
+import itertools
 from unittest import TestCase
 
+import pytest
+
 from brickrake.minimizer import *
 
 WANTED_PARTS = [
@@ -157,5 +160,165 @@ def test_brute_force():
     assert brute_force(WANTED_PARTS, JUST_RIGHT, 2) == [{
         'cost': sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION),
         'allocation': ALLOCATION,
-        'store_ids': ('two', 'one')
+        'store_ids': ('one', 'two')
     }]
+
+
+def brute_force_exhaustively(wanted_parts, price_guide, k):
+    """(cost, store_ids) of every combination of k stores that covers the
+    wanted parts and costs less than every smaller combination it contains"""
+    availability = Availability(wanted_parts, price_guide)
+    result = []
+    for stores in itertools.combinations(range(len(availability.store_ids)), k):
+        cost = availability.cost(stores)
+        if cost == float('inf'):
+            continue
+        smaller = [s for m in range(1, k) for s in itertools.combinations(stores, m)]
+        if all(availability.cost(s) > cost + 1e-9 for s in smaller):
+            result.append((cost, tuple(availability.store_ids[i] for i in stores)))
+    return result
+
+
+def test_brute_force_exhaustive():
+    from brickrake.synthetic import workload
+    wanted_parts, price_guide, _ = workload(5, 12, seed=3)
+    for k in [1, 2, 3]:
+        expected = brute_force_exhaustively(wanted_parts, price_guide, k)
+        found = brute_force(wanted_parts, price_guide, k)
+        assert [x['store_ids'] for x in found] == [x[1] for x in expected]
+        assert all(abs(x['cost'] - y[0]) < 1e-6 for (x, y) in zip(found, expected))
+
+        cheapest = sorted(expected)[:5]
+        found = brute_force(wanted_parts, price_guide, k, top=5)
+        assert [x['cost'] for x in found] == pytest.approx([x[0] for x in cheapest])
+        assert all(x['store_ids'] in [y[1] for y in expected] for x in found)
+        assert all(abs(sum(e['quantity'] * e['cost_per_unit'] for e in x['allocation']) - x['cost']) < 1e-6
+                   for x in found)
+    assert len(expected) > 5
+
+
+def test_brute_force_n_jobs():
+    from brickrake.synthetic import workload
+    wanted_parts, price_guide, _ = workload(6, 14, seed=2)
+    assert len(brute_force(wanted_parts, price_guide, 3)) > 0
+    for top in [None, 3]:
+        assert brute_force(wanted_parts, price_guide, 3, top=top, n_jobs=2) == \
+            brute_force(wanted_parts, price_guide, 3, top=top, n_jobs=1)
+
+
+def test_availability():
+    availability = Availability(WANTED_PARTS, JUST_RIGHT)
+    assert availability.store_ids == ['one', 'two']
+    assert availability.keys == [('123', 1), ('123', 2), ('456', 80)]
+    assert availability.quantities.tolist() == [[120, 30, 10], [0, 25, 0]]
+    assert availability.cheapest[1].tolist() == [float('inf'), 0.25, float('inf')]
+    assert availability.covers()
+    assert not availability.covers(availability.stores(['one']))
+    assert availability.coverage(availability.needed).tolist() == [140, 25]
+    assert availability.min_cost() == min_cost(WANTED_PARTS, JUST_RIGHT)
+    assert abs(availability.cost() - min_cost(WANTED_PARTS, JUST_RIGHT)[0]) < 1e-9
+    assert availability.cost(availability.stores(['two'])) == float('inf')
+    assert availability.ladder_starts.tolist() == [0, 1, 3, 4]
+    assert availability.ladder_prices.tolist() == [0.05, 0.10, 0.25, 0.20]
+
+
+def test_price_guide():
+    price_guide = PriceGuide(JUST_RIGHT + NOT_ENOUGH_INVENTORY[3:])
+    assert len(price_guide) == 5
+    assert list(price_guide) == JUST_RIGHT + NOT_ENOUGH_INVENTORY[3:]
+    assert PriceGuide.wrap(price_guide) is price_guide
+    assert price_guide.by_store == {'one': [0, 1, 3, 4], 'two': [2]}
+    assert price_guide.by_item[('123', 2)] == [1, 2]
+    assert price_guide.by_lot[('one', '456', 81, 81, 0.05)] == [4]
+    assert price_guide.positions([('456', 80), ('123', 2)]) == [1, 2, 3]
+    assert price_guide.positions([('123', 2)], store_ids=['two']) == [2]
+    assert price_guide.select(store_ids=['two']).lots == [JUST_RIGHT[2]]
+
+    # the same as a list of lots, everywhere
+    availability = Availability(WANTED_PARTS, price_guide)
+    assert availability.min_cost() == min_cost(WANTED_PARTS, JUST_RIGHT)
+    assert presolve(WANTED_PARTS, price_guide) == presolve(WANTED_PARTS, list(price_guide))
+    assert greedy(WANTED_PARTS, price_guide) == greedy(WANTED_PARTS, JUST_RIGHT)
+
+
+def test_greedy():
+    solution = greedy(WANTED_PARTS, JUST_RIGHT)[0]
+    assert is_valid_solution(WANTED_PARTS, solution['allocation'])
+    assert sorted(solution['store_ids']) == ['one', 'two']
+    assert [e['quantity'] for e in solution['allocation']] == [100, 30, 10, 20]
+
+
+def test_presolve():
+    extra = [
+        # identical to a lot in store one
+        dict(JUST_RIGHT[0], quantity_available=5),
+        # pricier than the lot in store one that covers everything wanted
+        dict(JUST_RIGHT[0], cost_per_unit=0.5),
+        # not wanted
+        dict(JUST_RIGHT[0], item_id='789'),
+        # store one has all of it for less
+        dict(JUST_RIGHT[3], store_id='four', quantity_available=5, cost_per_unit=0.5),
+    ]
+    lots, stats = presolve(WANTED_PARTS, JUST_RIGHT + extra)
+    assert stats['n_unwanted'] == 1
+    assert stats['n_merged'] == 1
+    assert stats['n_dominated_lots'] == 1
+    assert stats['n_dominated_stores'] == 1
+    assert lots == [dict(JUST_RIGHT[0], quantity_available=125)] + JUST_RIGHT[1:]
+
+    # a store with a minimum purchase can't stand in for another
+    stores = [{'store_id': 'one', 'minimum_buy': 10.0}]
+    lots, stats = presolve(WANTED_PARTS, JUST_RIGHT + extra, stores)
+    assert stats['n_dominated_lots'] == 0
+    assert stats['n_dominated_stores'] == 0
+
+    lots, stats = presolve(WANTED_PARTS, JUST_RIGHT, top_k=1)
+    assert stats['n_beyond_top_k'] == 1
+    assert lots == JUST_RIGHT[0:2] + JUST_RIGHT[3:]
+
+
+def test_lns():
+    pytest.importorskip('scipy')
+    solution = lns(WANTED_PARTS, JUST_RIGHT, time_limit=5.0, max_stale=2)[0]
+    assert is_valid_solution(WANTED_PARTS, solution['allocation'])
+    assert sorted(solution['store_ids']) == ['one', 'two']
+    assert abs(solution['cost'] - sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION)) < 1e-9
+
+    # a valid start is kept even if no move finishes in time
+    start = greedy(WANTED_PARTS, JUST_RIGHT)[0]
+    solution = lns(WANTED_PARTS, JUST_RIGHT, time_limit=0.0, start=start['allocation'])[0]
+    assert solution['cost'] == start['cost'] and sorted(solution['store_ids']) == sorted(start['store_ids'])
+
+
+def test_lower_bound():
+    cost = sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION)
+    # both stores are needed, so the best purchase costs cost + 2 * 10.0
+    assert lower_bound(WANTED_PARTS, JUST_RIGHT, shipping_cost=10.0) <= cost + 20.0 + 1e-9
+    assert abs(lower_bound(WANTED_PARTS, JUST_RIGHT, shipping_cost=0.0) - cost) < 1e-6
+    assert lower_bound(WANTED_PARTS, NOT_ENOUGH_INVENTORY) == float('inf')
+    assert optimality_gap(40.0, 30.0) == 0.25
+
+    pytest.importorskip('scipy')
+    assert lower_bound(WANTED_PARTS, JUST_RIGHT, shipping_cost=10.0, method='lp') <= cost + 20.0 + 1e-9
+
+
+def test_lower_bound_synthetic():
+    pytest.importorskip('scipy')
+    from brickrake.synthetic import workload
+    for seed in [14, 16, 21]:
+        wanted_parts, price_guide, stores = workload(10, 25, seed=seed)
+        lp = lower_bound(wanted_parts, price_guide, stores, method='lp')
+        bound = lower_bound(wanted_parts, price_guide, stores, method='best')
+        solution = integer_program(wanted_parts, price_guide, stores, gap=0.0)[0]
+        assert lp <= bound <= solution['cost'] + 10.0 * len(solution['store_ids']) + 1e-6
+
+    # without minimum purchases, the lagrangian bound can get as tight as the
+    # linear relaxation
+    wanted_parts, price_guide, stores = workload(25, 40, seed=21)
+    lp = lower_bound(wanted_parts, price_guide, method='lp')
+    assert lower_bound(wanted_parts, price_guide, method='lagrangian') >= lp - 0.01 * abs(lp)
+
+    # a relaxation that runs out of time falls back to the lagrangian bound
+    lagrangian = lower_bound(wanted_parts, price_guide, stores)
+    assert lower_bound(wanted_parts, price_guide, stores, method='lp', time_limit=0.0) == lagrangian
+    assert lower_bound(wanted_parts, price_guide, stores, method='best', time_limit=0.0) == lagrangian
@@ -0,0 +1,45 @@
+"""
+Tests for brickrake.profiling
+"""
+import json
+import os
+
+from brickrake.minimizer import greedy, integer_program
+from brickrake.profiling import *
+from brickrake.synthetic import workload
+
+
+def test_profiler(tmp_path):
+    wanted_parts, price_guide, stores = workload(10, 15, seed=0)
+
+    # without a profiler, phases and counts do nothing
+    with phase('nothing'):
+        count(n=1)
+    greedy(wanted_parts, price_guide)
+
+    with Profiler(cprofile_dir=str(tmp_path)) as profiler:
+        with phase('outer'):
+            count(n=1)
+            with phase('inner'):
+                count(n=2)
+        integer_program(wanted_parts, price_guide, stores)
+        integer_program(wanted_parts, price_guide, stores)
+    report = json.loads(json.dumps(profiler.report()))
+
+    names = [e['name'] for e in report['phases']]
+    solving = ['integer_program', 'integer_program/build', 'integer_program/solve']
+    assert names == ['outer', 'outer/inner'] + solving + solving
+    assert report['phases'][0]['counters'] == {'n': 1}
+    assert report['phases'][1]['counters'] == {'n': 2}
+    assert report['totals']['integer_program']['calls'] == 2
+    assert report['counters']['n_variables'] > 0 and report['counters']['n_constraints'] > 0
+    assert all(e['seconds'] >= 0 for e in report['phases'])
+
+    assert len(report['solves']) == 2
+    assert report['solves'][0]['phase'] == 'integer_program/solve'
+    assert report['solves'][0]['objective'] is not None
+
+    # only outermost phases are run under cProfile
+    assert sorted(os.listdir(str(tmp_path))) == ['integer_program.2.prof', 'integer_program.prof', 'outer.prof']
+    assert len(report['phases'][2]['hot_functions']) > 0
+    assert 'cprofile' not in report['phases'][1]
@@ -0,0 +1,189 @@
+"""
+Tests for brickrake.scraper
+"""
+import os
+import re
+import threading
+import time
+
+from bs4 import BeautifulSoup as BS
+
+from brickrake import utils
+from brickrake.scraper import *
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def parse_price_guide_bs(html):
+    """How price guide pages used to be parsed, with a Beautiful Soup tree"""
+    page = BS(html, "html.parser")
+    if len(page.find_all(text='Currently Available')) == 0:
+        return None
+
+    rows = []
+    for td in page.find_all('td'):
+        if td.find('a', recursive=False, href=re.compile('/store.asp')) is not None:
+            store_url = td.find('a')['href']
+            store_id = int(utils.get_params(store_url)['sID'])
+            quantity = int(td.next_sibling.text)
+            cost_per_unit = float(re.findall('[0-9.]+', td.next_sibling.next_sibling.text)[0])
+            rows.append((store_id, quantity, cost_per_unit))
+    return rows
+
+
+def test_parse_price_guide():
+    for name in sorted(os.listdir(DATA)):
+        if name.startswith('catalogPG'):
+            html = open(os.path.join(DATA, name), encoding='latin-1').read()
+            assert parse_price_guide(html) == parse_price_guide_bs(html), name
+
+
+def test_parse_price_guide_rows():
+    html = open(os.path.join(DATA, 'catalogPG_3001_5.html'), encoding='latin-1').read()
+    rows = parse_price_guide(html)
+    assert len(rows) == 75
+    assert all(isinstance(s, int) and q > 0 and p > 0 for (s, q, p) in rows)
+
+    html = open(os.path.join(DATA, 'catalogPG_3001_160.html'), encoding='latin-1').read()
+    assert parse_price_guide(html) is None
+
+    # quantities and prices wrapped in nested tables, and a store row nested in a cell
+    html = open(os.path.join(DATA, 'catalogPG_3004_11.html'), encoding='latin-1').read()
+    assert parse_price_guide(html) == [(101762, 2400, 0.04), (146023, 310, 0.0412),
+                                       (268737, 75, 0.05), (290219, 1200, 0.035),
+                                       (324745, 18, 0.09), (335318, 60, 0.02)]
+
+
+def test_stores_to_refresh():
+    previous = [
+        {'store_id': 1, 'link': 'store.asp?p=a', 'last_checked': 1000.0},
+        {'store_id': 2, 'link': 'store.asp?p=b', 'last_checked': 10.0},
+        {'store_id': 3, 'link': 'store.asp?p=c', 'last_checked': 1000.0},
+        {'store_id': 4},
+    ]
+    links = ['store.asp?p=a', 'store.asp?p=b', 'store.asp?p=d']
+    to_fetch, kept = stores_to_refresh(previous, links, max_age=100.0, now=1050.0)
+    assert to_fetch == ['store.asp?p=b', 'store.asp?p=d']
+    assert list(kept.keys()) == ['store.asp?p=a']
+
+
+def test_store_changes():
+    old = [
+        {'store_id': 1, 'seller_name': 'a', 'feedback': 10, 'last_checked': 1.0},
+        {'store_id': 2, 'seller_name': 'b', 'feedback': 10, 'last_checked': 1.0},
+    ]
+    new = [
+        {'store_id': 2, 'seller_name': 'b', 'feedback': 12, 'last_checked': 2.0},
+        {'store_id': 3, 'seller_name': 'c', 'feedback': 0, 'last_checked': 2.0},
+    ]
+    changes = store_changes(old, new)
+    assert changes['added'] == [new[1]]
+    assert changes['removed'] == [old[0]]
+    assert changes['changed'] == [{'store_id': 2, 'seller_name': 'b', 'changes': {'feedback': [10, 12]}}]
+
+
+def store_page(store_id, username, min_buy=''):
+    """A store's page, with just the script store_page_info reads"""
+    return ("<html><script>\n"
+            "StoreFront.store = {\n"
+            "\t\tid: %d,\n"
+            "\t\tname: 'Store %s',\n"
+            "\t\tusername: '%s',\n"
+            "\t\tcountryName: 'Canada',\n"
+            "\t\tcountryID: 'CA',\n"
+            "\t\tfeedbackScore: 42,\n"
+            "\t\tminBuy: '%s',\n"
+            "\t\tshipsToBuyer: true\n"
+            "};\n"
+            "</script></html>") % (store_id, username, username, min_buy)
+
+
+BROWSE_PAGE = ('<div class="column rightbuy">'
+               '<a href="/browseStores.asp?countryID=CA">Canada</a>'
+               '<a href="/browseStores.asp?countryID=DE">Germany</a></div>')
+
+PAGES = {
+    'https://www.bricklink.com/browse.asp': BROWSE_PAGE,
+    'https://www.bricklink.com/browseStores.asp?countryID=CA':
+        '<a href="store.asp?p=a">a</a><a href="store.asp?p=b">b</a>',
+    'https://www.bricklink.com/browseStores.asp?countryID=DE': '<a href="store.asp?p=c">c</a>',
+    'https://www.bricklink.com/store.asp?p=a': store_page(1, 'a'),
+    'https://www.bricklink.com/store.asp?p=b': store_page(2, 'b', 'US $10.00'),
+    'https://www.bricklink.com/store.asp?p=c': '<html>Not found</html>',
+}
+
+
+class Response(object):
+    def __init__(self, url):
+        self.status_code = 200 if url in PAGES else 404
+        self.text = PAGES.get(url, '')
+
+
+def fake_bricklink(monkeypatch):
+    """Serve PAGES in place of bricklink.com, and return the list of urls
+    requested"""
+    requested = []
+
+    def get(url, **kwargs):
+        requested.append(url)
+        return Response(url)
+    monkeypatch.setattr(utils.requests, 'get', get)
+    return requested
+
+
+def test_store_links(monkeypatch):
+    fake_bricklink(monkeypatch)
+    assert store_links(n_workers=2) == ['store.asp?p=a', 'store.asp?p=b', 'store.asp?p=c']
+    assert store_links(country='CA') == ['store.asp?p=a', 'store.asp?p=b']
+
+
+def test_iter_store_info(monkeypatch):
+    fake_bricklink(monkeypatch)
+    # store c's page can't be understood, so it's skipped
+    stores = dict(iter_store_info(['store.asp?p=a', 'store.asp?p=b', 'store.asp?p=c'], n_workers=2))
+    assert sorted(stores) == ['store.asp?p=a', 'store.asp?p=b']
+    assert stores['store.asp?p=a'] == {
+        'store_name': 'Store a',
+        'store_id': 1,
+        'country_name': 'Canada',
+        'country_id': 'CA',
+        'seller_name': 'a',
+        'feedback': 42,
+        'minimum_buy': 0.0,
+        'ships': True,
+    }
+    assert stores['store.asp?p=b']['minimum_buy'] >= 10.0
+
+
+def test_price_guides(monkeypatch):
+    # later items are fetched faster, and item 3 fails
+    lock = threading.Lock()
+    in_flight = [0, 0]  # now, most at once
+
+    def fetch(url, **kwargs):
+        assert (kwargs['retries'], kwargs['timeout']) == (2, 5.0)
+        item_id = utils.get_params(url)['itemNo']
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.01 * (8 - int(item_id)))
+        with lock:
+            in_flight[0] -= 1
+        if item_id == '3':
+            raise IOError('connection reset')
+        return item_id
+    monkeypatch.setattr(utils, 'fetch', fetch)
+
+    items = [{'ItemID': str(i), 'ItemTypeID': 'S', 'ColorID': 0, 'Qty': 1} for i in range(8)]
+    parse = lambda html: [(int(html), 1, 0.10)]
+    results = list(price_guides(items, n_workers=3, retries=2, timeout=5.0, parse=parse))
+
+    # in the order asked for, with errors passed along instead of raised
+    assert [x[0] for x in results] == items
+    for (item, lots, error) in results:
+        if item['ItemID'] == '3':
+            assert lots is None and isinstance(error, IOError)
+        else:
+            assert error is None
+            assert [e['store_id'] for e in lots] == [int(item['ItemID'])]
+    assert in_flight[1] == 3
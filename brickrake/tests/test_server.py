@@ -0,0 +1,58 @@
+"""
+Tests for brickrake.server
+"""
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+from brickrake.server import *
+
+
+def test_data_files(tmp_path):
+    path = str(tmp_path / 'numbers.json')
+    with open(path, 'w') as f:
+        json.dump([1, 2], f)
+    data = DataFiles([path, None], lambda: json.load(open(path)))
+    assert data.get() == [1, 2]
+    assert data.get() == [1, 2]
+    assert data.n_loads == 1
+
+    with open(path, 'w') as f:
+        json.dump([1, 2, 3], f)
+    os.utime(path, ns=(0, 0))
+    assert data.get() == [1, 2, 3]
+    assert data.n_loads == 2
+
+    # a half written file keeps the last good data
+    with open(path, 'w') as f:
+        f.write('[1, 2')
+    assert data.get() == [1, 2, 3]
+    assert data.n_loads == 2
+
+
+def test_server():
+    def add(body):
+        if 'a' not in body:
+            raise ValueError('no a')
+        return {'sum': body['a'] + body.get('b', 0)}
+
+    httpd = make_server({('POST', '/add'): add, ('GET', '/status'): lambda _: {'ok': True}}, port=0)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    post = lambda path, body: urllib.request.urlopen(url + path, json.dumps(body).encode('utf-8'))
+    try:
+        assert json.load(urllib.request.urlopen(url + '/status')) == {'ok': True}
+        assert json.load(post('/add', {'a': 1, 'b': 2})) == {'sum': 3}
+        for (path, code) in [('/add', 400), ('/subtract', 404)]:
+            try:
+                post(path, {'b': 2})
+                assert False
+            except urllib.error.HTTPError as e:
+                assert e.code == code
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
@@ -0,0 +1,17 @@
+"""
+Tests for brickrake.synthetic
+"""
+from brickrake.minimizer import covers
+from brickrake.synthetic import *
+
+
+def test_workload():
+    wanted_parts, price_guide, stores = workload(20, 30, seed=1)
+    assert workload(20, 30, seed=1) == (wanted_parts, price_guide, stores)
+    assert workload(20, 30, seed=2)[1] != price_guide
+
+    assert len(set((e['ItemID'], e['ColorID']) for e in wanted_parts)) == 20
+    assert covers(wanted_parts, price_guide)
+    assert any(e['color_id'] != e['wanted_color_id'] for e in price_guide)
+    assert sorted(s['store_id'] for s in stores) == sorted(set(e['store_id'] for e in price_guide))
+    assert any(s['minimum_buy'] > 0 for s in stores)
@@ -0,0 +1,113 @@
+"""
+Tests for brickrake.utils
+"""
+import requests
+
+from brickrake import utils
+from brickrake.cache import PageCache
+from brickrake.utils import *
+
+URL = 'http://www.bricklink.com/catalogPG.asp?itemType=P&itemNo=3001&colorId=5'
+
+
+class Response(object):
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('%d error' % (self.status_code,), response=self)
+
+
+def fake_get(monkeypatch, responses):
+    """Make requests.get answer with responses in turn, and return the list
+    of urls it's called with"""
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    monkeypatch.setattr(requests, 'get', get)
+    return calls
+
+
+def test_fetch_cache(tmp_path, monkeypatch):
+    cache = PageCache(str(tmp_path))
+    calls = fake_get(monkeypatch, [Response(404, 'not found'), Response(200, '<html>3001</html>')])
+
+    # error pages aren't cached
+    assert fetch(URL, cache=cache) == 'not found'
+    assert cache.get(URL) is None
+    assert fetch(URL, cache=cache) == '<html>3001</html>'
+    assert fetch(URL, cache=cache) == '<html>3001</html>'
+    assert len(calls) == 2
+
+
+def test_fetch_retries(monkeypatch):
+    calls = fake_get(monkeypatch, [Response(503, 'busy'), requests.Timeout('slow'), Response(200, 'ok')])
+    assert fetch(URL, retries=2, backoff=0.0) == 'ok'
+    assert calls == [URL] * 3
+
+    # the last failure is raised once retries run out
+    fake_get(monkeypatch, [Response(503, 'busy'), Response(429, 'slow down')])
+    try:
+        fetch(URL, retries=1, backoff=0.0)
+        assert False
+    except requests.HTTPError as e:
+        assert e.response.status_code == 429
+
+    fake_get(monkeypatch, [requests.Timeout('slow')])
+    try:
+        fetch(URL, backoff=0.0)
+        assert False
+    except requests.Timeout:
+        pass
+
+
+def test_fetch_timeout(monkeypatch):
+    timeouts = []
+
+    def get(url, **kwargs):
+        timeouts.append(kwargs['timeout'])
+        return Response(200, 'ok')
+    monkeypatch.setattr(requests, 'get', get)
+    fetch(URL)
+    fetch(URL, timeout=5.0)
+    assert timeouts == [30.0, 5.0]
+
+
+class Clock(object):
+    """Stands in for the time module, only moving forward when slept"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(utils, 'time', clock)
+    limiter = RateLimiter(max_per_second=2.0)
+
+    # requests to the same host are half a second apart, other hosts don't wait
+    times = []
+    for url in ['http://a.com/1', 'http://a.com/2', 'http://b.com/1', 'http://a.com/3', 'http://b.com/2']:
+        limiter.wait(url)
+        times.append(clock.now - 1000.0)
+    assert times == [0.0, 0.5, 0.5, 1.0, 1.0]
+    assert limiter.n_requests == 5
+
+    # without a limit, nothing waits
+    limiter = RateLimiter()
+    limiter.wait('http://a.com/1')
+    limiter.wait('http://a.com/2')
+    assert clock.now == 1001.0
@@ -3,6 +3,8 @@ Utility methods
 """
 import itertools
 import math
+import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.parse
@@ -22,9 +24,82 @@ hdr = {
     'Connection': 'keep-alive'}
 
 
-def beautiful_soup(url):
-    """Fetch a web page and return its contents as parsed by Beautiful Soup"""
-    return BS(requests.get(url, headers=hdr).text, "html.parser")
+class RateLimiter(object):
+    """Limit the number of requests per second sent to each host.
+
+    Safe to share between threads. Also counts how many requests went through
+    it, for throughput reports."""
+
+    def __init__(self, max_per_second=None):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self.n_requests = 0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        """Block until a request to url's host is allowed"""
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            self.n_requests += 1
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch(url, limiter=None, cache=None, retries=0, backoff=1.0, timeout=30.0):
+    """Fetch a web page and return its contents as text
+
+    Parameters
+    ----------
+    url : str
+        page to fetch
+    limiter : RateLimiter or None
+        throttle requests going over the network
+    cache : brickrake.cache.PageCache or None
+        serve the page from here if possible, and save it here otherwise
+    retries : int
+        number of times to try again if the connection fails or the server
+        is overloaded
+    backoff : float
+        seconds to wait before the first retry. Doubles with every retry.
+    timeout : float
+        seconds to wait for the server before giving up on an attempt, which
+        is retried like a failed connection
+    """
+    if cache is not None:
+        text = cache.get(url)
+        if text is not None:
+            return text
+
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait(url)
+        try:
+            response = requests.get(url, headers=hdr, timeout=timeout)
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt == retries:
+                response.raise_for_status()
+        except requests.RequestException:
+            # includes timeouts
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+    text = response.text
+
+    # error and block pages would stand in for the real page until they expire
+    if cache is not None and response.status_code == 200:
+        cache.put(url, text)
+    return text
+
+
+def beautiful_soup(url, **kwargs):
+    """Fetch a web page and return its contents as parsed by Beautiful Soup
+
+    Keyword arguments are passed on to fetch()."""
+    return BS(fetch(url, **kwargs), "html.parser")
 
 
 def get_params(url):
@@ -35,9 +110,12 @@ def get_params(url):
 
 
 def groupby(arr, kf=lambda x: x):
-    """Create a dictionary mapping keys to objects with the same key"""
-    result = itertools.groupby(sorted(arr, key=kf), kf)
-    return dict((k, tuple(v)) for (k, v) in result)
+    """Create a dictionary mapping keys to objects with the same key. Keys
+    and objects keep the order they come in."""
+    result = {}
+    for e in arr:
+        result.setdefault(kf(e), []).append(e)
+    return dict((k, tuple(v)) for (k, v) in result.items())
 
 
 def flatten(arr):
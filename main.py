@@ -1,15 +1,41 @@
 import argparse
+import contextlib
+import multiprocessing
 import os
 import sys
+import tempfile
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 
+from brickrake import cache
 from brickrake import color
+from brickrake import ilp
 from brickrake import io
 from brickrake import minimizer
+from brickrake import profiling
 from brickrake import scraper
+from brickrake import server
 from brickrake import utils
 
 
+# algorithms minimize can pick stores with
+ALGORITHMS = ['ilp', 'ilp-gurobi', 'ilp-highs', 'lns', 'brute-force', 'greedy']
+
+
+def page_cache(args_):
+    """On-disk cache of BrickLink pages, or None if disabled"""
+    if args_.no_cache and args_.offline:
+        print('--offline only uses pages in the cache, so it can\'t be combined with --no-cache')
+        sys.exit(1)
+    if args_.no_cache:
+        return None
+    return cache.PageCache(os.path.expanduser(args_.cache_dir),
+                           max_bytes=int(args_.cache_size * 1024 * 1024),
+                           offline=args_.offline)
+
+
 def price_guide(args_):
     """Scrape pricing information for all wanted parts"""
     # load in wanted parts
@@ -32,131 +58,354 @@ def price_guide(args_):
     else:
         old_parts = {}
 
-    available_parts = []
+    # lots are journaled as soon as they're found. Items already in the journal,
+    # left behind by an interrupted run, aren't fetched again.
+    journal_path = args_.output + '.journal'
+    if os.path.exists(journal_path):
+        journaled = io.load_price_guide_journal(open(journal_path))
+        print('Resuming with %d items from %s' % (len(journaled), journal_path))
+    else:
+        journaled = {}
+    journal = io.PriceGuideJournal(open(journal_path, 'a'))
+
+    # fetch everything we don't already have enough of, several items at a time
+    def needs_fetching(item):
+        if (item['ItemID'], item['ColorID']) in journaled:
+            return False
+        matching = old_parts.get((item['ItemID'], item['ColorID']), [])
+        return sum(e['quantity_available'] for e in matching) < item['Qty']
+
+    limiter = utils.RateLimiter(args_.max_requests_per_second)
+    pages = page_cache(args_)
+    fetched = scraper.price_guides(
+        [item for item in wanted_parts if needs_fetching(item)],
+        max_cost_quantile=args_.max_price_quantile,
+        max_colors=args_.max_colors,
+        max_color_distance=args_.max_color_distance,
+        n_workers=args_.n_workers,
+        n_parsers=args_.n_parsers,
+        limiter=limiter,
+        cache=pages,
+        retries=args_.retries,
+        timeout=args_.timeout
+    )
+    start = time.time()
+    n_fetched = 0
+    n_failed = 0
 
     # for each wanted lot
     for (i, item) in enumerate(wanted_parts):
         # skip this item if we already have enough
-        matching = old_parts.get((item['ItemID'], item['ColorID']), [])
+        key = (item['ItemID'], item['ColorID'])
+        matching = journaled.get(key, old_parts.get(key, []))
         quantity_found = sum(e['quantity_available'] for e in matching)
 
         print(fmt.format(i=i, status="seeking", name=item['ItemName'], color=item['ColorName'], quantity=item['Qty']))
 
-        if quantity_found >= item['Qty']:
+        if not needs_fetching(item):
             colors = [color.name(c_id) for c_id in set(e['color_id'] for e in matching)]
             print(fmt.format(i=i, status="passing", name=item['ItemName'], color=",".join(colors),
                              quantity=quantity_found))
-            available_parts.extend(matching)
+            if key not in journaled:
+                journal.append(item['ItemID'], item['ColorID'], list(matching))
         else:
-            try:
-                # fetch price data for this item in the closest available color
-                new = scraper.price_guide(item, max_cost_quantile=args_.max_price_quantile)
-                available_parts.extend(new)
+            # price data for this item in the closest available color
+            _, new, error = next(fetched)
+            n_fetched += 1
+            if error is not None:
+                print('Catastrophic Failure! :(')
+                traceback.print_exception(type(error), error, error.__traceback__)
+                n_failed += 1
+                continue
 
-                # print out status message
-                total_quantity = sum(e['quantity_available'] for e in new)
-                colors = [color.name(c_id) for c_id in set(e['color_id'] for e in new)]
-                print(fmt.format(i=i, status="found", name=item['ItemName'], color=",".join(colors),
-                                 quantity=total_quantity))
+            journal.append(item['ItemID'], item['ColorID'], new)
 
-                if total_quantity < item['Qty']:
-                    print('WARNING! Couldn\'t find enough parts!')
+            # print out status message
+            total_quantity = sum(e['quantity_available'] for e in new)
+            colors = [color.name(c_id) for c_id in set(e['color_id'] for e in new)]
+            print(fmt.format(i=i, status="found", name=item['ItemName'], color=",".join(colors),
+                             quantity=total_quantity))
 
-            except Exception as e:
-                print('Catastrophic Failure! :(')
-                traceback.print_exc()
+            if total_quantity < item['Qty']:
+                print('WARNING! Couldn\'t find enough parts!')
+    journal.close()
+
+    elapsed = time.time() - start
+    print('Fetched %d items (%d pages) in %.1fs: %.2f items/s, %.2f pages/s' % (
+        n_fetched, limiter.n_requests, elapsed,
+        n_fetched / max(elapsed, 1e-9), limiter.n_requests / max(elapsed, 1e-9)))
+    if pages is not None:
+        print('Page cache: %d hits, %d misses' % (pages.n_hits, pages.n_misses))
 
     # save price data
+    available_parts = io.compact_price_guide_journal(open(journal_path))
     io.save_price_guide(open(args_.output, 'w'), available_parts)
+    if n_failed == 0:
+        os.remove(journal_path)
+    else:
+        print('WARNING: failed to fetch %d items. Run again to retry them.' % (n_failed,))
 
 
-def minimize(args_):
-    """Minimize the cost of a purchase"""
-    # ------------ Loading ------------
-    # load in wanted parts lists
-    if args_.parts_list.endswith(".bsx"):
-        wanted_parts = io.load_bsx(open(args_.parts_list))
+def load_parts_list(path):
+    """Load a wanted list from a BSX file or BrickLink XML"""
+    if path.endswith(".bsx"):
+        return io.load_bsx(open(path))
     else:
-        wanted_parts = io.load_xml(open(args_.parts_list))
-    print('Loaded %d different parts' % len(wanted_parts))
-
-    # load in pricing data
-    available_parts = io.load_price_guide(open(args_.price_guide))
-    n_available = len(available_parts)
-    n_stores = len(set(e['store_id'] for e in available_parts))
+        return io.load_xml(open(path))
+
+
+def filter_stores(args_, stores):
+    """Stores allowed by the source country, target country, feedback and
+    exclude options in args_
+
+    Parameters
+    ----------
+    stores : io.StoreTable
+        metadata of every store
+
+    Returns
+    -------
+    allowed_stores : list of dict
+        metadata of the allowed stores
+    """
+    # ------- Filtering Stores ------------
+    # select which stores to get parts from
+    if args_.source_country is not None:
+        print('Only allowing stores from %s' % (args_.source_country,))
+
+    if args_.target_country is not None:
+        print('Only allowing stores that ship to %s' % (args_.target_country,))
+
+    if args_.feedback is not None and args_.feedback > 0:
+        print('Only allowing stores with feedback >= %d' % (args_.feedback,))
+
+    excludes = None
+    if args_.exclude is not None:
+        excludes = set(args_.exclude.strip().split(","))
+        excludes = [int(x) for x in excludes]
+        print('Forcing exclusion of: %s' % (excludes,))
+
+    return stores.filter(source_country=args_.source_country, target_country=args_.target_country,
+                         feedback=args_.feedback, exclude=excludes)
+
+
+def load_market(args_):
+    """Load the price guide and store metadata, keeping only the stores
+    args_ allows
+
+    Returns
+    -------
+    (available_parts, allowed_stores) : tuple
+        lots for sale as a minimizer.PriceGuide, and metadata of the allowed
+        stores, or None if there's no store list
+    """
+    # load in pricing data. Columnar price guides are only turned into dicts
+    # once we know which stores we're interested in.
+    with profiling.phase('load_price_guide'):
+        if io.is_price_guide_columns(args_.price_guide):
+            columns = io.load_price_guide_columns(args_.price_guide)
+            n_available = len(columns)
+            n_stores = len(columns.store_ids())
+        else:
+            columns = None
+            available_parts = minimizer.PriceGuide(io.load_price_guide(open(args_.price_guide)))
+            n_available = len(available_parts)
+            n_stores = len(available_parts.by_store)
+        profiling.count(n_lots_loaded=n_available, n_stores_loaded=n_stores)
     print('Loaded %d available lots from %d stores' % (n_available, n_stores))
 
     # load in store metadata
+    allowed_stores = None
     if args_.store_list is not None:
-        store_metadata = io.load_store_metadata(open(args_.store_list))
+        with profiling.phase('load_store_list'):
+            store_metadata = io.StoreTable(io.load_store_metadata(open(args_.store_list)))
         print('Loaded metadata for %d stores' % len(store_metadata))
 
-        # ------- Filtering Stores ------------
-        # select which stores to get parts from
-        allowed_stores = list(store_metadata)
-        if args_.source_country is not None:
-            print('Only allowing stores from %s' % (args_.source_country,))
-            allowed_stores = [x for x in allowed_stores if x['country_name'] == args_.source_country]
-
-        if args_.target_country is not None:
-            print('Only allowing stores that ship to %s' % (args_.target_country,))
-            allowed_stores = [s for s in allowed_stores
-                              if args_.target_country in s['ships']
-                              or (len(s['ships']) == 1 and s['ships'][0] == 'All Countries WorldWide')]
-
-        if args_.feedback is not None and args_.feedback > 0:
-            print('Only allowing stores with feedback >= %d' % (args_.feedback,))
-            allowed_stores = [x for x in allowed_stores if x['feedback'] >= args_.feedback]
-
-        if args_.exclude is not None:
-            excludes = set(args_.exclude.strip().split(","))
-            excludes = [int(x) for x in excludes]
-            print('Forcing exclusion of: %s' % (excludes,))
-            allowed_stores = [x for x in allowed_stores if not (x['store_id'] in excludes)]
-
-        store_ids = [x['store_id'] for x in allowed_stores]
-        store_ids = list(set(store_ids))
+        with profiling.phase('filter_stores'):
+            allowed_stores = filter_stores(args_, store_metadata)
+            store_ids = set(x['store_id'] for x in allowed_stores)
+            profiling.count(n_stores_allowed=len(store_ids))
         print('Using %d stores' % len(store_ids))
 
-        available_parts = [x for x in available_parts if x['store_id'] in store_ids]
+        with profiling.phase('select_lots'):
+            if columns is not None:
+                available_parts = minimizer.PriceGuide(columns.select(store_ids).to_records())
+            else:
+                available_parts = available_parts.select(store_ids=store_ids)
+            profiling.count(n_lots_allowed=len(available_parts))
+
+    elif columns is not None:
+        with profiling.phase('select_lots'):
+            available_parts = minimizer.PriceGuide(columns.to_records())
+
+    return (available_parts, allowed_stores)
 
-        solution = minimizer.greedy(wanted_parts, available_parts)[0]
-        if not minimizer.is_valid_solution(wanted_parts, solution['allocation']):
-            print(("You're too restrictive. There's no way to buy what " +
-                   "you want with these stores"))
-            sys.exit(1)
+
+def minimize(args_):
+    """Minimize the cost of a purchase"""
+    profiler = None
+    if args_.profile is not None or args_.cprofile_dir is not None:
+        profiler = profiling.Profiler(cprofile_dir=args_.cprofile_dir)
+
+    try:
+        with profiler if profiler is not None else contextlib.nullcontext():
+            # ------------ Loading ------------
+            # load in wanted parts lists
+            with profiling.phase('load_parts_list'):
+                wanted_parts = load_parts_list(args_.parts_list)
+                profiling.count(n_wanted_items=len(wanted_parts), n_wanted_parts=sum(e['Qty'] for e in wanted_parts))
+            print('Loaded %d different parts' % len(wanted_parts))
+
+            available_parts, allowed_stores = load_market(args_)
+            solution, _ = optimize(args_, wanted_parts, available_parts, allowed_stores)
+    finally:
+        if profiler is not None:
+            print(profiler.summary())
+            if args_.profile is not None:
+                with open(args_.profile, 'w') as f:
+                    profiler.save(f)
+                print('Saved profile to %s' % (args_.profile,))
+    if solution is None:
+        sys.exit(1)
+
+
+def optimize(args_, wanted_parts, available_parts, allowed_stores):
+    """Find stores to buy a wanted list from with the algorithm args_ asks
+    for, and save recommendations to args_.output
+
+    Returns
+    -------
+    (solution, bound) : tuple
+        cheapest solution found, or None if there is none, and the lower
+        bound on its cost, counting shipping, or None if greedy ran without
+        --bound
+    """
+    # only the ILP and LNS respect minimum purchases
+    minimums = None
+    if allowed_stores is not None and args_.algorithm.startswith(('ilp', 'lns')):
+        minimums = allowed_stores
+
+    # drop lots and stores that can't be part of the cheapest purchase
+    if not args_.no_presolve:
+        available_parts, stats = minimizer.presolve(wanted_parts, available_parts, minimums, top_k=args_.top_k_lots)
+        print('Presolve kept %d of %d lots (%.1f%%) and %d of %d stores (%.1f%%)' % (
+            stats['n_lots'], stats['n_lots_before'], 100.0 * stats['n_lots'] / max(stats['n_lots_before'], 1),
+            stats['n_stores'], stats['n_stores_before'], 100.0 * stats['n_stores'] / max(stats['n_stores_before'], 1)))
+
+    # index what every store has of every wanted item once, for all algorithms
+    with profiling.phase('availability'):
+        availability = minimizer.Availability(wanted_parts, available_parts)
+        profiling.count(n_items=len(availability.keys), n_stores=len(availability.store_ids),
+                        n_lots=len(availability.lots))
+    with profiling.phase('covers'):
+        covered = allowed_stores is None or availability.covers()
+    if not covered:
+        print(("You're too restrictive. There's no way to buy what " +
+               "you want with these stores"))
+        return (None, float('inf'))
+
+    # greedy's cheap solution steers the lower bound and is where the ILP and
+    # LNS start
+    greedy_solution = minimizer.greedy(wanted_parts, available_parts, availability=availability)[0]
+
+    # the cheapest any purchase could be, to tell how good solutions are.
+    # Greedy doesn't need one, so it only gets one if asked.
+    bound = None
+    if args_.algorithm != 'greedy' or args_.bound is not None:
+        upper_bound = greedy_solution['cost'] + args_.shipping_cost * len(greedy_solution['store_ids'])
+        bound = minimizer.lower_bound(wanted_parts, available_parts, minimums, shipping_cost=args_.shipping_cost,
+                                      method=args_.bound or 'lagrangian', upper_bound=upper_bound,
+                                      availability=availability)
+        print('Lower bound: $%.2f, counting $%.2f shipping per store' % (bound, args_.shipping_cost))
+    gap = lambda cost, n_stores: minimizer.optimality_gap(cost + args_.shipping_cost * n_stores, bound)
 
     # -------------- Minimization --------------
-    if args_.algorithm in ['ilp', 'greedy']:
-        if args_.algorithm == 'ilp':
+    if args_.algorithm in ['ilp', 'ilp-gurobi', 'ilp-highs', 'lns', 'greedy']:
+        stores = allowed_stores
+
+        # keep the best solution so far on disk, in case the solver is stopped
+        def save_incumbent(solution):
+            path = args_.output + ".json"
+            with open(path + '.tmp', 'w') as f:
+                io.save_solution(f, solution)
+            os.replace(path + '.tmp', path)
+            print('Saved solution costing $%.2f with %d stores' % (solution['cost'], len(solution['store_ids'])))
+
+        if args_.algorithm.startswith('ilp'):
             # Integer Linear Programming
-            solution = minimizer.gurobi(
+            if args_.algorithm == 'ilp':
+                backend = ilp.default_backend()
+            else:
+                backend = args_.algorithm[len('ilp-'):]
+            print('Solving with %s' % (backend,))
+
+            # start from the greedy solution, which is cheap to find
+            start = None
+            if not args_.no_warm_start:
+                start = greedy_solution['allocation']
+
+            solutions = minimizer.integer_program(
                 wanted_parts,
                 available_parts,
-                allowed_stores,
-                shipping_cost=args_.shipping_cost
-            )[0]
-            assert minimizer.is_valid_solution(wanted_parts, solution['allocation'], allowed_stores)
+                stores,
+                shipping_cost=args_.shipping_cost,
+                backend=backend,
+                gap=args_.mip_gap,
+                time_limit=args_.time_limit,
+                threads=args_.threads,
+                start=start,
+                on_incumbent=save_incumbent
+            )
+            if len(solutions) == 0:
+                return (None, bound)
+            solution = solutions[0]
+            assert minimizer.is_valid_solution(wanted_parts, solution['allocation'], stores)
+        elif args_.algorithm == 'lns':
+            # ---- Large Neighborhood Search ----
+            solutions = minimizer.lns(
+                wanted_parts,
+                available_parts,
+                stores,
+                shipping_cost=args_.shipping_cost,
+                time_limit=args_.time_limit if args_.time_limit is not None else 60.0,
+                n_jobs=args_.n_jobs,
+                backend=ilp.default_backend(),
+                start=greedy_solution['allocation'],
+                availability=availability,
+                on_incumbent=save_incumbent,
+                lower_bound=bound,
+                gap=args_.mip_gap
+            )
+            if len(solutions) == 0:
+                return (None, bound)
+            solution = solutions[0]
         elif args_.algorithm == 'greedy':
             # ---- Greedy Set Cover ----
-            solution = minimizer.greedy(wanted_parts, available_parts)[0]
+            solution = greedy_solution
 
         # check and save
-        io.save_solution(open(args_.output + ".json", 'w'), solution)
+        with profiling.phase('save'):
+            io.save_solution(open(args_.output + ".json", 'w'), solution)
 
-        # print outs
-        stores = set(e['store_id'] for e in solution['allocation'])
-        cost = solution['cost']
-        unsatisified = minimizer.unsatisified(wanted_parts, solution['allocation'])
-        print('Total cost: $%.2f | n_stores: %d | remaining lots: %d' % (cost, len(stores), len(unsatisified)))
+            # print outs
+            stores = set(e['store_id'] for e in solution['allocation'])
+            cost = solution['cost']
+            unsatisified = minimizer.unsatisified(wanted_parts, solution['allocation'])
+        print('Total cost: $%.2f | n_stores: %d | remaining lots: %d' % (cost, len(stores), len(unsatisified)) +
+              ('' if bound is None else ' | gap: %.1f%%' % (100 * gap(cost, len(stores)),)))
+        return (solution, bound)
 
     elif args_.algorithm == 'brute-force':
+        # the cheapest the parts alone could be, whichever stores are used
+        parts_bound = availability.cost()
+        best = float('inf')
+        best_solution = None
+
         # for each possible number of stores
         for k in range(1, args_.max_n_stores):
             # find all possible solutions using k stores
-            solutions = minimizer.brute_force(wanted_parts, available_parts, k)
-            solutions = list(sorted(solutions, key=lambda x: x['cost']))
-            solutions = solutions[0:10]
+            solutions = minimizer.brute_force(wanted_parts, available_parts, k, top=10, n_jobs=args_.n_jobs,
+                                              availability=availability)
 
             # save output
             output_folder = os.path.join(args_.output, str(k))
@@ -165,19 +414,248 @@ def minimize(args_):
             except OSError:
                 pass
 
-            for (i, solution) in enumerate(solutions):
-                output_path = os.path.join(output_folder, "%02d.json" % i)
-                with open(output_path, 'w') as f:
-                    io.save_solution(f, solution)
+            with profiling.phase('save'):
+                for (i, solution) in enumerate(solutions):
+                    output_path = os.path.join(output_folder, "%02d.json" % i)
+                    with open(output_path, 'w') as f:
+                        io.save_solution(f, solution)
 
             # print outs
             if len(solutions) > 0:
-                print('%8s %40s' % ('Cost', 'Store IDs'))
+                print('%8s %6s %40s' % ('Cost', 'Gap', 'Store IDs'))
                 for sol in solutions:
-                    print('$%7.2f %40s' % (sol['cost'], ",".join(str(s) for s in sol['store_ids'])))
+                    print('$%7.2f %5.1f%% %40s' % (sol['cost'], 100 * gap(sol['cost'], k),
+                                                  ",".join(str(s) for s in sol['store_ids'])))
+                    if sol['cost'] + args_.shipping_cost * k < best:
+                        best = sol['cost'] + args_.shipping_cost * k
+                        best_solution = sol
             else:
                 print("No solutions using %d stores" % k)
 
+            # stop early if more stores can't help, or can't help much
+            if parts_bound + args_.shipping_cost * (k + 1) >= best:
+                print('Using more stores would cost more in shipping than it could save')
+                break
+            if minimizer.optimality_gap(best, bound) <= args_.mip_gap:
+                print('Within %.1f%% of the lower bound' % (100 * args_.mip_gap,))
+                break
+        return (best_solution, bound)
+
+
+# price guide, store metadata and options shared by batch workers
+_BATCH = {}
+
+
+def _init_batch(args_, available_parts, allowed_stores):
+    _BATCH['args'] = args_
+    _BATCH['available_parts'] = available_parts
+    _BATCH['allowed_stores'] = allowed_stores
+
+
+def _minimize_one(path):
+    """Minimize the cost of one parts list in a batch, logging to a file
+    next to its recommendations"""
+    kf2 = lambda x: (x['ItemID'], x['ColorID'])
+
+    args_ = argparse.Namespace(**vars(_BATCH['args']))
+    name = os.path.splitext(os.path.basename(path))[0]
+    args_.output = os.path.join(_BATCH['args'].output, name)
+
+    result = {'name': name, 'cost': None, 'n_stores': None, 'gap': None, 'error': None}
+    start = time.time()
+    with open(args_.output + '.log', 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            wanted_parts = load_parts_list(path)
+            available_parts = _BATCH['available_parts'].select(items=[kf2(e) for e in wanted_parts])
+            print('Loaded %d different parts and %d available lots' % (len(wanted_parts), len(available_parts)))
+
+            solution, bound = optimize(args_, wanted_parts, available_parts, _BATCH['allowed_stores'])
+            if solution is None:
+                result['error'] = 'no solution'
+            else:
+                n_stores = len(solution['store_ids'])
+                result['cost'] = solution['cost']
+                result['n_stores'] = n_stores
+                if bound is not None:
+                    result['gap'] = minimizer.optimality_gap(solution['cost'] + args_.shipping_cost * n_stores, bound)
+        except Exception as e:
+            traceback.print_exc()
+            result['error'] = repr(e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def batch(args_):
+    """Minimize the cost of many purchases against the same price guide"""
+    names = [os.path.splitext(os.path.basename(p))[0] for p in args_.parts_lists]
+    if len(set(names)) < len(names):
+        print('Parts lists must have different file names, their recommendations are saved by name')
+        sys.exit(1)
+
+    # load and index the price guide once, for every parts list
+    available_parts, allowed_stores = load_market(args_)
+    print('Indexed %d lots of %d different parts' % (len(available_parts), len(available_parts.by_item)))
+
+    if not os.path.exists(args_.output):
+        os.makedirs(args_.output)
+
+    settings = argparse.Namespace(**dict((k, v) for (k, v) in vars(args_).items() if k != 'func'))
+    initargs = (settings, available_parts, allowed_stores)
+    start = time.time()
+    if args_.n_workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # forked workers share the parent's price guide copy-on-write, rather
+        # than each unpickling a copy of it
+        _init_batch(*initargs)
+        pool = ProcessPoolExecutor(args_.n_workers, mp_context=multiprocessing.get_context('fork'))
+        results = pool.map(_minimize_one, args_.parts_lists)
+    elif args_.n_workers > 1:
+        pool = ProcessPoolExecutor(args_.n_workers, initializer=_init_batch, initargs=initargs)
+        results = pool.map(_minimize_one, args_.parts_lists)
+    else:
+        pool = None
+        _init_batch(*initargs)
+        results = map(_minimize_one, args_.parts_lists)
+
+    print('%-30s %9s %8s %6s %8s' % ('Parts list', 'Cost', 'n_stores', 'Gap', 'Seconds'))
+    n_solved = 0
+    for result in results:
+        if result['error'] is not None:
+            print('%-30s failed: %s' % (result['name'], result['error']))
+            continue
+        n_solved += 1
+        gap = '' if result['gap'] is None else '%.1f%%' % (100 * result['gap'],)
+        print('%-30s %9s %8d %6s %8.1f' % (result['name'], '$%.2f' % result['cost'], result['n_stores'],
+                                          gap, result['seconds']))
+    if pool is not None:
+        pool.shutdown()
+
+    print('Minimized %d of %d parts lists in %.1fs' % (n_solved, len(args_.parts_lists), time.time() - start))
+    if n_solved < len(args_.parts_lists):
+        sys.exit(1)
+
+
+# fields of a serve request that override serve's own options, and how to
+# read them
+REQUEST_OPTIONS = {
+    'source_country': str,
+    'target_country': str,
+    'feedback': int,
+    'exclude': lambda x: x if isinstance(x, str) else ",".join(str(e) for e in x),
+    'shipping_cost': float,
+    'algorithm': str,
+    'mip_gap': float,
+    'time_limit': float,
+    'max_n_stores': int,
+    'top_k_lots': int,
+}
+
+
+def serve(args_):
+    """Answer minimize requests over HTTP, keeping the price guide and store
+    metadata loaded"""
+    kf2 = lambda x: (x['ItemID'], x['ColorID'])
+
+    def load():
+        if io.is_price_guide_columns(args_.price_guide):
+            available_parts = minimizer.PriceGuide(io.load_price_guide_columns(args_.price_guide).to_records())
+        else:
+            available_parts = minimizer.PriceGuide(io.load_price_guide(open(args_.price_guide)))
+        print('Loaded %d available lots of %d different parts' % (len(available_parts), len(available_parts.by_item)))
+        store_metadata = None
+        if args_.store_list is not None:
+            store_metadata = io.StoreTable(io.load_store_metadata(open(args_.store_list)))
+            print('Loaded metadata for %d stores' % len(store_metadata))
+        return {
+            'available_parts': available_parts,
+            'n_lots': len(available_parts),
+            'n_stores': len(available_parts.by_store),
+            'stores': store_metadata
+        }
+
+    # reloaded whenever the price guide or store list change on disk
+    data = server.DataFiles([args_.price_guide, args_.store_list], load)
+
+    def minimize_request(request):
+        if not isinstance(request, dict) or 'parts_list' not in request:
+            raise ValueError('Requests need a parts_list, the contents of a BrickLink XML wanted list')
+        unknown = set(request) - set(REQUEST_OPTIONS) - set(['parts_list'])
+        if len(unknown) > 0:
+            raise ValueError('Unknown options: %s' % (", ".join(sorted(unknown)),))
+
+        settings = dict((k, v) for (k, v) in vars(args_).items() if k != 'func')
+        try:
+            for (k, v) in request.items():
+                if k in REQUEST_OPTIONS and v is not None:
+                    settings[k] = REQUEST_OPTIONS[k](v)
+            wanted_parts = io.load_xml(StringIO(request['parts_list']))
+        except (TypeError, SyntaxError) as e:
+            raise ValueError('Bad request: %s' % (e,))
+        if settings['algorithm'] not in ALGORITHMS:
+            raise ValueError('Unknown algorithm: %s' % (settings['algorithm'],))
+        request_args = argparse.Namespace(**settings)
+
+        market = data.get()
+        log = StringIO()
+        start = time.time()
+        with tempfile.TemporaryDirectory() as folder, contextlib.redirect_stdout(log):
+            request_args.output = os.path.join(folder, 'solution')
+            allowed_stores = store_ids = None
+            if market['stores'] is not None:
+                allowed_stores = filter_stores(request_args, market['stores'])
+                store_ids = set(x['store_id'] for x in allowed_stores)
+            available_parts = market['available_parts'].select([kf2(e) for e in wanted_parts], store_ids)
+            print('Loaded %d different parts and %d available lots' % (len(wanted_parts), len(available_parts)))
+            solution, bound = optimize(request_args, wanted_parts, available_parts, allowed_stores)
+
+        result = {'solution': solution, 'bound': None, 'gap': None,
+                  'seconds': time.time() - start, 'log': log.getvalue()}
+        if bound is not None and bound < float('inf'):
+            result['bound'] = bound
+        if solution is not None:
+            n_stores = len(solution['store_ids'])
+            if bound is not None:
+                result['gap'] = minimizer.optimality_gap(solution['cost'] + request_args.shipping_cost * n_stores,
+                                                         bound)
+            print('Minimized %d parts in %.1fs: $%.2f with %d stores' %
+                  (len(wanted_parts), result['seconds'], solution['cost'], n_stores))
+        else:
+            print('Found no solution for %d parts in %.1fs' % (len(wanted_parts), result['seconds']))
+        return result
+
+    def status(_):
+        market = data.get()
+        return {'n_lots': market['n_lots'], 'n_stores': market['n_stores'],
+                'loaded_at': data.loaded_at, 'n_loads': data.n_loads}
+
+    routes = {('POST', '/minimize'): minimize_request, ('GET', '/status'): status}
+    httpd = server.make_server(routes, args_.host, args_.port, args_.socket)
+    if args_.socket is not None:
+        print('Listening on %s' % (args_.socket,))
+    else:
+        print('Listening on http://%s:%d' % httpd.server_address[:2])
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def convert(args_):
+    """Convert a price guide between JSON and the columnar format"""
+    if io.is_price_guide_columns(args_.input):
+        price_guide = io.load_price_guide_columns(args_.input)
+    else:
+        price_guide = io.load_price_guide(open(args_.input))
+
+    if args_.output.endswith('.json'):
+        if isinstance(price_guide, io.PriceGuideColumns):
+            price_guide = price_guide.to_records()
+        io.save_price_guide(open(args_.output, 'w'), price_guide)
+    else:
+        io.save_price_guide_columns(args_.output, price_guide)
+    print('Converted %d lots' % len(price_guide))
+
 
 def wanted_list(args_):
     """Create BrickLink Wanted Lists for each store"""
@@ -187,58 +665,233 @@ def wanted_list(args_):
     io.save_xml_per_vendor(args_.output, recommendation, store_metadata)
 
 
+def color_table(args_):
+    """Recompute the table of similar colors"""
+    table = color.similarity_table()
+    output = os.path.expanduser(args_.output)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        color.save_similarity_table(f, table)
+    print('Ranked similar colors for %d colors in %s' % (len(table), output))
+
+
 def store_list(args_):
     """Get metadata for stores"""
-    info = scraper.store_info(country=args_.country)
-    io.save_store_metadata(open(args_.output, 'w'), info)
+    fetch_args = {
+        'limiter': utils.RateLimiter(args_.max_requests_per_second),
+        'cache': page_cache(args_),
+        'retries': args_.retries,
+        'timeout': args_.timeout,
+    }
+    links = scraper.store_links(country=args_.country, n_workers=args_.n_workers, **fetch_args)
+    print('Found %d stores' % len(links))
+
+    # only fetch stores that are new or haven't been checked in a while
+    if args_.previous is not None:
+        previous = io.load_store_metadata(open(args_.previous))
+        if args_.country is not None:
+            others = [e for e in previous if e['country_id'] != args_.country]
+            previous = [e for e in previous if e['country_id'] == args_.country]
+        else:
+            others = []
+        max_age = args_.max_age * 24 * 60 * 60
+        to_fetch, kept = scraper.stores_to_refresh(previous, links, max_age)
+        print('Refreshing %d new or stale stores, keeping %d' % (len(to_fetch), len(kept)))
+
+        # don't let the page cache serve pages older than we want
+        if fetch_args['cache'] is not None:
+            fetch_args['cache'].ttl['store'] = min(fetch_args['cache'].ttl['store'], max_age)
+    else:
+        previous, others = [], []
+        to_fetch, kept = links, {}
+
+    # stores are saved to a partial list as soon as they're fetched, so an
+    # interrupted crawl picks up where it left off
+    partial_path = args_.output + '.partial'
+    if os.path.exists(partial_path):
+        done = io.load_partial_store_metadata(open(partial_path))
+        print('Resuming with %d stores from %s' % (len(done), partial_path))
+    else:
+        done = {}
+
+    start = time.time()
+    n_fetched = 0
+    with open(partial_path, 'a') as partial:
+        remaining = [link for link in to_fetch if link not in done]
+        for (link, entry) in scraper.iter_store_info(remaining, n_workers=args_.n_workers, **fetch_args):
+            entry['link'] = link
+            entry['last_checked'] = time.time()
+            print(entry)
+            io.append_store_metadata(partial, link, entry)
+            done[link] = entry
+            n_fetched += 1
+
+    elapsed = time.time() - start
+    print('Fetched %d stores in %.1fs: %.2f stores/s' % (
+        n_fetched, elapsed, n_fetched / max(elapsed, 1e-9)))
+
+    # stores that couldn't be fetched again keep their old metadata
+    if args_.previous is not None:
+        stale = dict((e['link'], e) for e in previous if 'link' in e)
+        missing = [link for link in to_fetch if link not in done and link in stale]
+        kept.update((link, stale[link]) for link in missing)
+
+    info = [done.get(link, kept.get(link)) for link in links if link in done or link in kept]
+    io.save_store_metadata(open(args_.output, 'w'), info + others)
+    if all(link in done for link in to_fetch):
+        os.remove(partial_path)
+    else:
+        print('WARNING: missing %d stores. Run again to retry them.' % (
+            len([link for link in to_fetch if link not in done]),))
+
+    if args_.previous is not None:
+        changes = scraper.store_changes(previous, info)
+        print('%d stores added, %d removed, %d changed' % (
+            len(changes['added']), len(changes['removed']), len(changes['changed'])))
+        if args_.changelog is not None:
+            io.save_store_changes(open(args_.changelog, 'w'), changes)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Brickrake: the BrickLink Store Recommendation Engine")
     subparsers = parser.add_subparsers()
 
-    parser_pg = subparsers.add_parser("price_guide",
+    # options shared by every command that downloads from BrickLink
+    parser_cache = argparse.ArgumentParser(add_help=False)
+    parser_cache.add_argument('--cache-dir', default='~/.cache/brickrake',
+                              help='Folder to cache downloaded BrickLink pages in')
+    parser_cache.add_argument('--cache-size', default=1024.0, type=float,
+                              help='Maximum size of the page cache, in MB')
+    parser_cache.add_argument('--no-cache', action='store_true',
+                              help='Always download pages, never use the page cache')
+    parser_cache.add_argument('--offline', action='store_true',
+                              help='Only use pages in the cache, even if they are out of date')
+    parser_cache.add_argument('--timeout', default=30.0, type=float,
+                              help='Seconds to wait for BrickLink before retrying a request')
+
+    parser_pg = subparsers.add_parser("price_guide", parents=[parser_cache],
                                       help="Download pricing information from BrickLink")
     parser_pg.add_argument('--parts-list', required=True,
                            help='BSX file containing desired parts')
     parser_pg.add_argument('--max-price-quantile', default=1.0, type=float,
                            help=('Ignore lots that cost more than this quantile' +
                                  ' of the price distribution per item'))
+    parser_pg.add_argument('--max-colors', default=None, type=int,
+                           help='Try at most this many similar colors per item, closest first')
+    parser_pg.add_argument('--max-color-distance', default=None, type=float,
+                           help='Ignore colors further than this from the wanted color (CIEDE2000)')
     parser_pg.add_argument('--resume', default=None,
                            help='Resume a previously run price_guide search')
+    parser_pg.add_argument('--n-workers', default=8, type=int,
+                           help='Maximum number of items to fetch at the same time')
+    parser_pg.add_argument('--n-parsers', default=0, type=int,
+                           help='Number of processes parsing downloaded pages. By default pages are parsed in the fetching threads')
+    parser_pg.add_argument('--max-requests-per-second', default=4.0, type=float,
+                           help='Maximum number of requests per second sent to BrickLink')
+    parser_pg.add_argument('--retries', default=3, type=int,
+                           help='Number of times to retry a failed request, backing off exponentially')
     parser_pg.add_argument('--output', required=True,
                            help='Location to save price guide for wanted list')
     parser_pg.set_defaults(func=price_guide)
 
-    parser_mn = subparsers.add_parser("minimize",
+    # options shared by every command that picks stores to buy from
+    parser_solve = argparse.ArgumentParser(add_help=False)
+    parser_solve.add_argument('--price-guide', required=True,
+                              help=('Pricing information output by "brickrake price_guide", ' +
+                                    'or converted to columns by "brickrake convert"'))
+    parser_solve.add_argument('--store-list', default=None,
+                              help='JSON file containing store metadata. Needed to respect minimum purchases')
+    parser_solve.add_argument('--source-country', default=None,
+                              help='limit search to stores in a particular country')
+    parser_solve.add_argument('--target-country', default=None,
+                              help='limit search to stores that ship to a particular country')
+    parser_solve.add_argument('--feedback', default=0, type=int,
+                              help='limit search to stores with enough feedback')
+    parser_solve.add_argument('--exclude', default=None,
+                              help='Force exclusion of the following comma-separated store IDs')
+    parser_solve.add_argument('--algorithm', default='ilp',
+                              choices=ALGORITHMS,
+                              help=('Algorithm used to select vendors. ilp uses Gurobi if it is ' +
+                                    'installed and HiGHS otherwise. lns is faster than ilp for ' +
+                                    'long lists and many stores, but not exact'))
+    parser_solve.add_argument('--max-n-stores', default=5, type=int,
+                              help=('Maximum number of different stores in a proposed solution.' +
+                                    'Only used if algorithm=brute-force.'))
+    parser_solve.add_argument('--n-jobs', default=1, type=int,
+                              help=('Number of processes to search with. ' +
+                                    'Only used if algorithm=brute-force or lns.'))
+    parser_solve.add_argument('--shipping-cost', default=10.0, type=float,
+                              help=('Estimated cost of shipping per store. ' +
+                                    'Only used if algorithm=ilp or lns'))
+    parser_solve.add_argument('--mip-gap', default=0.01, type=float,
+                              help=('Stop once the solution is provably within this fraction of optimal. ' +
+                                    'Used by algorithm=ilp, lns and brute-force'))
+    parser_solve.add_argument('--bound', default=None, choices=['best', 'lagrangian', 'lp'],
+                              help=('How to compute the lower bound on cost that solutions are compared ' +
+                                    'against. lp needs scipy and is slower on big price guides; best is ' +
+                                    'the larger of lagrangian and lp, or lagrangian alone without scipy. ' +
+                                    'Defaults to lagrangian, or no bound for algorithm=greedy'))
+    parser_solve.add_argument('--time-limit', default=None, type=float,
+                              help=('Stop after this many seconds with the best solution so far. ' +
+                                    'Every better solution found is saved as soon as it is found. ' +
+                                    'Only used if algorithm=ilp or lns, which defaults to 60'))
+    parser_solve.add_argument('--no-warm-start', action='store_true',
+                              help=('Do not start the solver from the greedy solution. ' +
+                                    'Only used if algorithm=ilp'))
+    parser_solve.add_argument('--threads', default=None, type=int,
+                              help=('Number of threads the solver may use. ' +
+                                    'Only used if algorithm=ilp-gurobi; HiGHS uses one'))
+    parser_solve.add_argument('--no-presolve', action='store_true',
+                              help='Keep lots and stores that cannot be part of the cheapest purchase')
+    parser_solve.add_argument('--top-k-lots', default=None, type=int,
+                              help=('Only consider this many cheapest lots of each part. ' +
+                                    'Faster, but may miss the cheapest purchase'))
+
+    parser_mn = subparsers.add_parser("minimize", parents=[parser_solve],
                                       help="Find a small set of vendors to buy parts from")
     parser_mn.add_argument('--parts-list', required=True,
                            help='BSX file containing desired parts')
-    parser_mn.add_argument('--price-guide', required=True,
-                           help='Pricing information output by "brickrake price_guide"')
-    parser_mn.add_argument('--store-list', default=None,
-                           help='JSON file containing store metadata. If using algorithm=ilp, this is required')
-    parser_mn.add_argument('--source-country', default=None,
-                           help='limit search to stores in a particular country')
-    parser_mn.add_argument('--target-country', default=None,
-                           help='limit search to stores that ship to a particular country')
-    parser_mn.add_argument('--feedback', default=0, type=int,
-                           help='limit search to stores with enough feedback')
-    parser_mn.add_argument('--exclude', default=None,
-                           help='Force exclusion of the following comma-separated store IDs')
-    parser_mn.add_argument('--algorithm', default='ilp',
-                           choices=['ilp', 'brute-force', 'greedy'],
-                           help='Algorithm used to select vendors')
-    parser_mn.add_argument('--max-n-stores', default=5, type=int,
-                           help=('Maximum number of different stores in a proposed solution.' +
-                                 'Only used if algorithm=brute-force.'))
-    parser_mn.add_argument('--shipping-cost', default=10.0, type=float,
-                           help=('Estimated cost of shipping per store. ' +
-                                 'Only used if algorithm=ilp'))
     parser_mn.add_argument('--output', required=True,
                            help='Directory to save purchase recommendations')
+    parser_mn.add_argument('--profile', default=None,
+                           help=('Save a JSON report of how long each phase took, the memory it used, ' +
+                                 'problem sizes and solver statistics to this file'))
+    parser_mn.add_argument('--cprofile-dir', default=None,
+                           help='Also save cProfile stats of each phase to this folder, for snakeviz or pstats')
     parser_mn.set_defaults(func=minimize)
 
+    parser_bt = subparsers.add_parser("batch", parents=[parser_solve],
+                                      help="Find vendors for many parts lists, loading the price guide once")
+    parser_bt.add_argument('--parts-lists', required=True, nargs='+',
+                           help='BSX or XML files containing desired parts, one purchase each')
+    parser_bt.add_argument('--n-workers', default=1, type=int,
+                           help='Number of parts lists to minimize at the same time')
+    parser_bt.add_argument('--output', required=True,
+                           help=('Directory to save purchase recommendations in. Each parts list ' +
+                                 'gets recommendations and a log named after it'))
+    parser_bt.set_defaults(func=batch)
+
+    parser_sv = subparsers.add_parser("serve", parents=[parser_solve],
+                                      help=("Answer minimize requests over HTTP, keeping the price guide " +
+                                            "and store list loaded"))
+    parser_sv.add_argument('--host', default='127.0.0.1',
+                           help='Address to listen on')
+    parser_sv.add_argument('--port', default=8000, type=int,
+                           help='Port to listen on')
+    parser_sv.add_argument('--socket', default=None,
+                           help='Listen on this Unix socket instead of a port')
+    parser_sv.set_defaults(func=serve)
+
+    parser_cv = subparsers.add_parser("convert",
+                                      help="Convert a price guide between JSON and the columnar format")
+    parser_cv.add_argument('--input', required=True,
+                           help='Price guide to convert, as JSON or a columnar price guide folder')
+    parser_cv.add_argument('--output', required=True,
+                           help='Where to save the price guide. Saved as JSON if this ends in .json, '
+                                'otherwise as a columnar price guide folder')
+    parser_cv.set_defaults(func=convert)
+
     parser_wl = subparsers.add_parser("wanted_list",
                                       help="Create a BrickLink Wanted List")
     parser_wl.add_argument("--recommendation", required=True,
@@ -249,13 +902,32 @@ if __name__ == '__main__':
                            help="Folder to create BrickLink Wanted List XML in")
     parser_wl.set_defaults(func=wanted_list)
 
-    parser_st = subparsers.add_parser("stores",
+    parser_st = subparsers.add_parser("stores", parents=[parser_cache],
                                       help="Download metadata about stores")
     parser_st.add_argument("--country", default=None,
                            help="Only gather metadata for stores from this country")
+    parser_st.add_argument('--previous', default=None,
+                           help='Store list from an earlier run. Only new and stale stores are fetched again')
+    parser_st.add_argument('--max-age', default=7.0, type=float,
+                           help='With --previous, fetch stores again if checked more than this many days ago')
+    parser_st.add_argument('--changelog', default=None,
+                           help='With --previous, save added, removed and changed stores to this JSON file')
+    parser_st.add_argument('--n-workers', default=8, type=int,
+                           help='Maximum number of stores to fetch at the same time')
+    parser_st.add_argument('--max-requests-per-second', default=4.0, type=float,
+                           help='Maximum number of requests per second sent to BrickLink')
+    parser_st.add_argument('--retries', default=3, type=int,
+                           help='Number of times to retry a failed request, backing off exponentially')
     parser_st.add_argument("--output", required=True,
                            help="Folder to create BrickLink Wanted List XML in")
     parser_st.set_defaults(func=store_list)
 
+    parser_co = subparsers.add_parser("colors",
+                                      help="Recompute the similar color table after editing data/colors.json")
+    parser_co.add_argument('--output', default=os.path.join(color.CACHE, 'similar_colors.json'),
+                           help='Where to save the table. It is used instead of the one shipped with brickrake '
+                                'while it matches data/colors.json')
+    parser_co.set_defaults(func=color_table)
+
     args = parser.parse_args()
     args.func(args)